@@ -3,53 +3,187 @@
 # input: input.fal
 # output: output.txt
 
+import argparse
+import contextlib
 import json
 import os
 import platform
-import time
+import sys
 
 import constants
+import instrumentation
+from assembler_api import preprocessed_lines
+from assembly_cache import AssemblyCache
 from blueprint_generator import Blueprint
-from blueprint_import_export import bp_compress, bp_encode_base64
+from blueprint_import_export import CompactExport, bp_write_stream
+from exceptions import AssemblyError
+from include_cache import use_directory
 from insr_to_signals import inst_to_signals
-from instruction import Instruction
+from peephole import optimize as peephole_optimize
+from rom_banks import RomBanks
 from token_parser import token_parser
 from tokenizer import tokenize_file
 
+DEFAULT_PROFILE_FILE = "profile.json"
+
+
+@contextlib.contextmanager
+def atomic_open(filename):
+    """Opens a temporary file for writing, which replaces filename once closed, so readers never see half a file"""
+    tmp_filename = filename + ".tmp"
+    try:
+        with open(tmp_filename, "w") as f:
+            yield f
+    except BaseException:
+        # an error while writing leaves the previous file as it was, opening may have failed before creating it
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+
+
+def assemble(file_in, file_preprocessed, file_out, cache=None, export=None, banks=None, optimize=False,
+             included=None):
+    """
+    Assembles file_in, writes the preprocessed program and the blueprint string.
+    cache is an optional AssemblyCache, export an optional SegmentedExport or CompactExport,
+    see AssemblyCache.write_blueprint. banks is an optional RomBanks, to write a banked PROM instead,
+    generated without the cache. With optimize, the peephole optimizer runs on the parsed program and prints
+    what it saved. included is an optional set, the paths of the files included are added to it.
+    Each step is an instrumentation phase.
+    Returns the number of instructions. Raises AssemblyError with the errors found, warnings are printed.
+    """
+    with instrumentation.phase("tokenize"):
+        if cache is not None:
+            lines_of_tokens = cache.tokenize_file(file_in)
+        else:
+            lines_of_tokens = tokenize_file(file_in)
+        instrumentation.count("lines", len(lines_of_tokens))
+        instrumentation.count("tokens", sum(map(len, lines_of_tokens)))
+
+    with instrumentation.phase("parse"):
+        instructions = token_parser(lines_of_tokens, file_in, included)
+
+    if optimize:
+        with instrumentation.phase("optimize"):
+            instructions, report = peephole_optimize(instructions)
+            instrumentation.count("removed", report.instructions_before - report.instructions_after)
+        print(report)
+
+    with instrumentation.phase("preprocessed"):
+        with atomic_open(file_preprocessed) as f:
+            for line in preprocessed_lines(instructions):
+                f.write(line + "\n")
+
+    if banks is not None:
+        with instrumentation.phase("encode"):
+            combinator_signals = cache.inst_to_signals(instructions) if cache is not None \
+                else inst_to_signals(instructions)
+            instrumentation.count("instructions", len(instructions))
+        # the banks are generated, encoded and compressed together
+        with instrumentation.phase("banks"):
+            with atomic_open(file_out) as f:
+                banks.write(combinator_signals, f)
+                f.write("\n")
+    elif cache is not None:
+        # only the changed rows of the previous blueprint are encoded and replaced
+        with instrumentation.phase("encode"):
+            combinator_signals = cache.inst_to_signals(instructions)
+            instrumentation.count("instructions", len(instructions))
+        with instrumentation.phase("blueprint"):
+            cache.update_blueprint(combinator_signals)
+        with instrumentation.phase("export"):
+            with atomic_open(file_out) as f:
+                cache.write_blueprint(f, export)
+                f.write("\n")
+    else:
+        with instrumentation.phase("encode"):
+            combinator_signals = inst_to_signals(instructions)
+            instrumentation.count("instructions", len(instructions))
 
-def main():
-    file_in = constants.DEFAULT_INPUT_FILE
-    file_preprocessed = constants.DEFAULT_PREPROCESSED_FILE
-    file_out = constants.DEFAULT_OUTPUT_FILE
-
-    print(file_in)
-    time.sleep(0.005)  # If print to stderr, let stdout output first
-
-    lines_of_tokens = tokenize_file(file_in)
+        # create blueprint
 
-    instructions = token_parser(lines_of_tokens)
+        with instrumentation.phase("blueprint"):
+            bp = Blueprint()
+            bp.generate_rom_entities(len(combinator_signals))
+            bp.insert_signals(combinator_signals)
 
-    with open(file_preprocessed, "w") as f:
-        for inst in instructions:
-            assert isinstance(inst, Instruction)
-            line = inst.opcode.text.ljust(5) + " "
-            line += " ".join([str(_.text) for _ in inst.operands])
-            f.write(line + "\n")
-    
-    combinator_signals = inst_to_signals(instructions)
+        # export, streamed through the compressor into the file
+        with instrumentation.phase("export"):
+            with atomic_open(file_out) as f:
+                if export is not None:
+                    export.write(bp.json_dict, f)
+                else:
+                    bp_write_stream(bp.json_dict, f)
+                f.write("\n")
+    return len(instructions)
 
-    # create blueprint
 
-    bp = Blueprint()
-    bp.generate_rom_entities(len(combinator_signals))
-    bp.insert_signals(combinator_signals)
+def main():
+    parser = argparse.ArgumentParser(description="Assembles {} into a blueprint string in {}".format(
+        constants.DEFAULT_INPUT_FILE, constants.DEFAULT_OUTPUT_FILE))
+    parser.add_argument("--profile", nargs="?", const=DEFAULT_PROFILE_FILE, metavar="FILE",
+                        help="write the time, counts and memory peak of each phase as JSON to FILE, "
+                             "default " + DEFAULT_PROFILE_FILE)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="with --profile, leave out the memory peaks, which slow down the assembler")
+    parser.add_argument("--compact", action="store_true",
+                        help="write the smallest blueprint string, for sharing, slower to export")
+    parser.add_argument("--bank-size", type=int, metavar="ROWS",
+                        help="split the PROM into banks of ROWS rows, placed side by side, generated in parallel")
+    parser.add_argument("--book", action="store_true",
+                        help="with --bank-size, a blueprint book of one bank each, without the wires between banks, "
+                             "which are to be added by hand when placed")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="with --bank-size, number of processes, default all cores")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="run the peephole optimizer, leaving out instructions which change nothing")
+    parser.add_argument("--cache", action="store_true",
+                        help="reuse the results of the previous run for unchanged lines, kept in "
+                             + constants.DEFAULT_CACHE_FILE)
+    args = parser.parse_args()
+    if args.bank_size is not None and args.bank_size < 1:
+        parser.error("--bank-size must be positive")
+    if args.bank_size is None and (args.book or args.workers is not None):
+        parser.error("--book and --workers need --bank-size")
+    if args.bank_size is not None and args.compact:
+        parser.error("--compact can not be combined with --bank-size")
 
-    # export
-    json_string = json.dumps(bp.json_dict)
-    output = bp_encode_base64(bp_compress(json_string))
+    file_in = constants.DEFAULT_INPUT_FILE
+    file_preprocessed = constants.DEFAULT_PREPROCESSED_FILE
+    file_out = constants.DEFAULT_OUTPUT_FILE
 
-    with open(file_out, "w") as f:
-        f.write(output+"\n")
+    print(file_in, flush=True)  # before any warning or error on stderr
+    use_directory(constants.DEFAULT_INCLUDE_CACHE_DIR)
+
+    profiler = None
+    if args.profile is not None:
+        profiler = instrumentation.Profiler(trace_memory=not args.no_memory)
+        instrumentation.add_hook(profiler)
+
+    with instrumentation.phase("assemble"):
+        cache = None
+        if args.cache:
+            with instrumentation.phase("cache_load"):
+                cache = AssemblyCache.load()
+        banks = RomBanks(args.bank_size, args.book, args.workers) if args.bank_size is not None else None
+        try:
+            assemble(file_in, file_preprocessed, file_out, cache, CompactExport() if args.compact else None, banks,
+                     args.optimize)
+        except AssemblyError as e:
+            sys.stdout.flush()
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        if cache is not None:
+            with instrumentation.phase("cache_save"):
+                cache.save()
+
+    if profiler is not None:
+        instrumentation.remove_hook(profiler)
+        profiler.close()
+        with open(args.profile, "w") as f:
+            json.dump(profiler.report(), f, indent=2)
+        print("Profile saved as " + args.profile)
 
     # paste to clipboard, clip on Windows
     if platform.system() == "Windows":
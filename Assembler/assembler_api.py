@@ -0,0 +1,255 @@
+# Assembler as a library, from source in memory to a blueprint string, without files
+# usage:
+#     from assembler_api import AssemblyOptions, assemble
+#     result = assemble("MOV R1, 5\n", AssemblyOptions(optimize=True))
+#     result.blueprint_string
+# The source can be a string, a file object, a path, or any iterable of lines.
+# Files named by #include are found relative to the file of the source, else to the working directory.
+# The blueprint, its string and the preprocessed listing are only made when first asked for.
+# Errors raise exceptions.AssemblyError with every error found, as Diagnostic, warnings are kept in the result.
+# Nothing is shared between runs, programs can be assembled by many threads at once.
+
+import io
+import os
+from functools import cached_property
+from typing import Iterable, TextIO, Union
+
+import instrumentation
+from blueprint_generator import Blueprint
+from blueprint_import_export import CompactExport, bp_write_stream
+from disassembler import load_blueprint
+from exceptions import AssemblyError, collecting
+from insr_to_signals import inst_to_signals
+from peephole import optimize as peephole_optimize
+from rom_banks import RomBanks
+from token_parser import token_parser
+from tokenizer import tokenize_lines
+
+Source = Union[str, os.PathLike, TextIO, Iterable[str]]
+
+
+class AssemblyOptions:
+    """
+    How to assemble: with the peephole optimizer, as the compact blueprint string (see CompactExport),
+    or as a banked PROM of bank_size rows (see RomBanks) made of a blueprint book, by some processes.
+    """
+
+    def __init__(self, optimize=False, compact=False, bank_size=None, book=False, workers=None):
+        if bank_size is None and (book or workers is not None):
+            raise ValueError("book and workers need a bank_size")
+        if bank_size is not None and compact:
+            raise ValueError("compact can not be combined with bank_size")
+        self.optimize = optimize
+        self.compact = compact
+        self.bank_size = bank_size
+        self.book = book
+        self.workers = workers
+
+    def rom_banks(self):
+        return None if self.bank_size is None else RomBanks(self.bank_size, self.book, self.workers)
+
+
+class AssemblyResult:
+    """The instructions and ROM signals of an assembled program, and what is made from them when asked for"""
+
+    def __init__(self, instructions, signals, options, optimizer_report=None, warnings=(), included=()):
+        self.instructions = instructions
+        self.signals = signals  # of each ROM row, see inst_to_signals
+        self.options = options
+        self.optimizer_report = optimizer_report  # peephole.OptimizerReport, with options.optimize
+        self.warnings = list(warnings)  # exceptions.Diagnostic
+        self.included = sorted(included)  # absolute paths of the files included
+
+    @cached_property
+    def preprocessed(self):
+        """The program after macros, definitions and labels, one instruction per line"""
+        return "".join(line + "\n" for line in preprocessed_lines(self.instructions))
+
+    @cached_property
+    def blueprint(self):
+        """The JSON dict of the blueprint, or of the blueprint book of PROM banks"""
+        if self.options.bank_size is not None:
+            # the banks are only ever made as a string
+            return load_blueprint(self.blueprint_string)
+        with instrumentation.phase("blueprint"):
+            bp = Blueprint()
+            bp.generate_rom_entities(len(self.signals))
+            bp.insert_signals(self.signals)
+        return bp.json_dict
+
+    @cached_property
+    def blueprint_string(self):
+        out = io.StringIO()
+        self.write_blueprint(out)
+        return out.getvalue()
+
+    def write_blueprint(self, out):
+        """Writes the blueprint string to a file object, without a newline"""
+        if "blueprint_string" in self.__dict__:
+            out.write(self.blueprint_string)
+            return
+        banks = self.options.rom_banks()
+        if banks is not None:
+            with instrumentation.phase("banks"):
+                banks.write(self.signals, out)
+            return
+        bp_json_dict = self.blueprint
+        with instrumentation.phase("export"):
+            if self.options.compact:
+                CompactExport().write(bp_json_dict, out)
+            else:
+                bp_write_stream(bp_json_dict, out)
+
+    def write_preprocessed(self, out):
+        for line in preprocessed_lines(self.instructions):
+            out.write(line + "\n")
+
+
+def preprocessed_lines(instructions):
+    """Each instruction as a line of the preprocessed listing"""
+    for inst in instructions:
+        yield inst.opcode.text.ljust(5) + " " + " ".join([str(_.text) for _ in inst.operands])
+
+
+def source_lines(source: Source):
+    """The lines of the source, a string of the whole program, a path, a file object or an iterable of lines"""
+    if isinstance(source, str):
+        return source.splitlines(keepends=True)
+    if isinstance(source, os.PathLike):
+        with open(source) as f:
+            return f.readlines()
+    return source
+
+
+def source_filename(source: Source):
+    """The name of the file of the source, None for source in memory"""
+    if isinstance(source, os.PathLike):
+        return os.fspath(source)
+    name = getattr(source, "name", None)
+    return name if isinstance(name, str) and os.path.isfile(name) else None
+
+
+def assemble(source: Source, options: AssemblyOptions = None) -> AssemblyResult:
+    """Assembles a program, each step is an instrumentation phase. Raises AssemblyError."""
+    if options is None:
+        options = AssemblyOptions()
+    included = set()
+    with collecting() as diagnostics:
+        with instrumentation.phase("tokenize"):
+            lines_of_tokens = tokenize_lines(source_lines(source))
+            instrumentation.count("lines", len(lines_of_tokens))
+            instrumentation.count("tokens", sum(map(len, lines_of_tokens)))
+
+        with instrumentation.phase("parse"):
+            try:
+                instructions = token_parser(lines_of_tokens, source_filename(source), included)
+            except AssemblyError as e:
+                # the errors may come from an included file
+                e.included = sorted(included)
+                raise
+
+        report = None
+        if options.optimize:
+            with instrumentation.phase("optimize"):
+                instructions, report = peephole_optimize(instructions)
+                instrumentation.count("removed", report.instructions_before - report.instructions_after)
+
+        with instrumentation.phase("encode"):
+            signals = inst_to_signals(instructions)
+            instrumentation.count("instructions", len(instructions))
+    return AssemblyResult(instructions, signals, options, report, diagnostics.warnings, included)
+
+
+def _test():
+    import glob
+    import pathlib
+    import sys
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from assembler import assemble as assemble_files
+    from disassembler import disassemble
+
+    print("Running test on assembler API...")
+    test_error_count = 0
+
+    def check(what, result, expected):
+        nonlocal test_error_count
+        if result != expected:
+            print("{}: {!r}, expected {!r}".format(what, result, expected), file=sys.stderr)
+            test_error_count += 1
+
+    # the same as the files written by the assembler, from every kind of source
+    filename = "examples/demo_quicksort.fal"
+    with tempfile.TemporaryDirectory() as directory:
+        file_preprocessed = os.path.join(directory, "preprocessed.fal")
+        file_out = os.path.join(directory, "output.txt")
+        assemble_files(filename, file_preprocessed, file_out)
+        with open(file_preprocessed) as f:
+            preprocessed = f.read()
+        with open(file_out) as f:
+            blueprint_string = f.read().rstrip("\n")
+    with open(filename) as f:
+        text = f.read()
+    with open(filename) as f:
+        sources = {"string": text, "path": pathlib.Path(filename), "file object": f,
+                   "lines without newlines": text.split("\n")}
+        for kind, source in sources.items():
+            result = assemble(source)
+            check(kind + " preprocessed", result.preprocessed, preprocessed)
+            check(kind + " blueprint string", result.blueprint_string, blueprint_string)
+
+    # the other blueprint strings read back as the same program
+    program = disassemble(blueprint_string)
+    for options in [AssemblyOptions(compact=True), AssemblyOptions(bank_size=16, workers=1),
+                    AssemblyOptions(bank_size=16, book=True, workers=1)]:
+        result = assemble(text, options)
+        check("{} disassembled".format(vars(options)), disassemble(result.blueprint_string), program)
+        if options.bank_size is not None:
+            check("{} blueprint".format(vars(options)), "blueprint_book" in result.blueprint, options.book)
+
+    result = assemble("MOV R1, 5\nADD R1, R1, 0\n", AssemblyOptions(optimize=True))
+    check("optimized", result.preprocessed, "MOV   R1 , 5\nHLTG  \n")
+    check("report", result.optimizer_report.instructions_after, 2)
+
+    # every error of a pass is raised together, warnings are kept in the result
+    try:
+        assemble("MOV R1, 5\nFOO R1\nMOV R1, 1x\nADD R1, R2\n")
+        check("errors", None, "AssemblyError")
+    except AssemblyError as e:
+        check("error lines", [(d.kind, d.line, d.column) for d in e.diagnostics],
+              [("SyntaxError", 2, 0), ("SyntaxError", 3, 8), ("SyntaxError", 4, 0)])
+    result = assemble("label: PUSH R1\n")
+    check("warnings", [(d.line, d.msg) for d in result.warnings],
+          [(None, "Unused label: label"), (1, "PUSH used before stack pointer initialized. Undefined behavior.")])
+
+    # many programs assembled by a pool of threads, the same as one at a time
+    sources = list()
+    for i, filename in enumerate(sorted(glob.glob("examples/demo_*.fal")) * 4):
+        with open(filename) as f:
+            sources.append(f.read() + "MOV R1, {}\n".format(i) + ("FOO R{}\n".format(i) if i % 5 == 0 else ""))
+
+    def outcome(source):
+        # each thread measures only its own phases
+        with instrumentation.hooked(instrumentation.Profiler()) as profiler:
+            try:
+                result = assemble(source, AssemblyOptions(compact=len(source) % 2 == 0))
+                result.blueprint_string
+            except AssemblyError as e:
+                return "errors", [str(d) for d in e.diagnostics]
+        counts = {name: (stats.calls, stats.counts) for name, stats in profiler.phases.items()}
+        return result.preprocessed, result.blueprint_string, [str(d) for d in result.warnings], counts
+
+    expected = [outcome(source) for source in sources]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(outcome, sources))
+    check("threads", results, expected)
+    check("failed sources", sum(1 for result in expected if result[0] == "errors"), 12)
+
+    if test_error_count == 0:
+        print("All tests succeeded")
+    else:
+        print("{} test{} failed".format(test_error_count, "" if test_error_count == 1 else "s"))
+
+
+if __name__ == "__main__":
+    _test()
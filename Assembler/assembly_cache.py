@@ -0,0 +1,183 @@
+# On-disk cache of the previous assembly, so an edit only redoes the work for the lines that changed
+
+import hashlib
+import json
+import os
+import pickle
+import sys
+
+import constants
+from blueprint_generator import Blueprint, ROM_ROW_ENTITY_NAMES, set_combinator_signals
+from blueprint_import_export import bp_write_stream
+from insr_to_signals import inst_to_signals
+from tokenizer import tokenize_file
+
+CACHE_VERSION = 1
+
+# positions of the entities within a ROM row, see ROM_ROW_ENTITY_NAMES
+ROM_ROW_CONSTANT_COMBINATOR = 2
+ROM_ROW_WIRED_ENTITIES = (0, 1, 3)  # arithmetic combinator, lamp and decider, wired to the next row
+
+# the cached results are only valid for the same encoding and PROM template
+_FINGERPRINT_FILES = ["opcode_map.py", "opcode_tables.py", "registers.py", "insr_to_signals.py",
+                      "blueprint_generator.py", "tokenizer.py"]
+
+
+class AssemblyCache:
+    """
+    Holds the results of the previous run:
+    the token records of each source line, the signals of each resolved instruction,
+    and the blueprint, as the signals of each ROM row and the JSON of each entity.
+    """
+
+    def __init__(self, filename, fingerprint):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.token_lines = dict()  # raw source line => token records, see tokenize_file
+        self.signals = dict()  # (opcode, operand texts) => signals, see inst_to_signals
+        self.rom_signals = list()  # signals of each ROM row in the blueprint
+        self.entity_json = list()  # JSON of each blueprint entity
+        self.header_entities = 0  # number of entities before the first ROM row
+
+    @staticmethod
+    def load(filename=constants.DEFAULT_CACHE_FILE):
+        """Loads the cache file, or starts an empty cache if it is missing, outdated or unreadable"""
+        fingerprint = cache_fingerprint()
+        try:
+            with open(filename, "rb") as f:
+                cache = pickle.load(f)
+            if isinstance(cache, AssemblyCache) and cache.fingerprint == fingerprint:
+                cache.filename = filename
+                return cache
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("Warning: Could not read assembly cache {}, starting over ({})".format(filename, e),
+                  file=sys.stderr)
+        return AssemblyCache(filename, fingerprint)
+
+    def save(self):
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, self.filename)
+
+    def tokenize_file(self, filename):
+        """Same as tokenizer.tokenize_file, only lines not seen in the last run are tokenized"""
+        lines_of_tokens = tokenize_file(filename, self.token_lines)
+        # keep only the lines of this run, so the cache does not grow with every edit
+        used = set(line[0].file_raw_text for line in lines_of_tokens if len(line) > 0)
+        self.token_lines = {k: v for k, v in self.token_lines.items() if k.strip("\n") in used}
+        return lines_of_tokens
+
+    def inst_to_signals(self, instructions):
+        """Same as insr_to_signals.inst_to_signals, only instructions not seen in the last run are encoded"""
+        signal_cache = self.signals
+        rom_signals = inst_to_signals(instructions, signal_cache)
+        used_keys = set((inst.opcode.text.upper(),) + tuple(t.text for t in inst.operands)
+                        for inst in instructions)
+        self.signals = {k: v for k, v in signal_cache.items() if k in used_keys}
+        return rom_signals
+
+    def update_blueprint(self, rom_signals):
+        """
+        Brings the cached blueprint up to date with the signals of each ROM row.
+        Only the constant combinators of rows with different signals are replaced, and only rows past the
+        end of the cached ROM are generated. The blueprint is kept as the JSON of each entity.
+        """
+        if 0 < len(rom_signals) < len(self.rom_signals):
+            self.remove_rows(len(rom_signals))
+        if len(rom_signals) < len(self.rom_signals) or len(self.entity_json) == 0:
+            # no ROM left, start over with an empty ROM
+            bp = Blueprint()
+            self.header_entities = len(bp.entities)
+            self.entity_json = [json.dumps(e) for e in bp.entities]
+            self.rom_signals = list()
+        old_rows = len(self.rom_signals)
+
+        for row in range(min(old_rows, len(rom_signals))):
+            if self.rom_signals[row] != rom_signals[row]:
+                i = self.row_entity_index(row, ROM_ROW_CONSTANT_COMBINATOR)
+                combinator = json.loads(self.entity_json[i])
+                set_combinator_signals(combinator, rom_signals[row])
+                self.entity_json[i] = json.dumps(combinator)
+
+        if len(rom_signals) > old_rows:
+            bp = Blueprint()
+            if old_rows > 0:
+                # the first new row is wired to the last cached row
+                last_row = [self.row_entity_index(old_rows - 1, k) for k in ROM_ROW_WIRED_ENTITIES]
+            else:
+                # the first row is wired to the input and output lamps
+                last_row = [None, bp.prev_PC_entity["entity_number"] - 1, bp.prev_OUT_entity["entity_number"] - 1]
+            last_row_entities = [json.loads(self.entity_json[i]) if i is not None else None for i in last_row]
+            bp.continue_rom(old_rows, last_row_entities, len(self.entity_json) + 1)
+            bp.generate_rom_entities(len(rom_signals) - old_rows)
+            bp.insert_signals(rom_signals[old_rows:])
+            for i, e in zip(last_row, last_row_entities):
+                if i is not None:
+                    self.entity_json[i] = json.dumps(e)
+            self.entity_json += [json.dumps(e) for e in bp.entities]
+
+        self.rom_signals = list(rom_signals)
+
+    def remove_rows(self, rom_lines):
+        """Removes the ROM rows past the first rom_lines, and the wires from the new last row to them"""
+        del self.entity_json[self.row_entity_index(rom_lines, 0):]
+        del self.rom_signals[rom_lines:]
+        last_entity_number = len(self.entity_json)  # entities are numbered from 1, in order
+        for k in ROM_ROW_WIRED_ENTITIES:
+            i = self.row_entity_index(rom_lines - 1, k)
+            entity = json.loads(self.entity_json[i])
+            remove_wires_beyond(entity, last_entity_number)
+            self.entity_json[i] = json.dumps(entity)
+
+    def row_entity_index(self, row, k):
+        """Index of the kth entity in a ROM row, the rows follow the initial entities of the blueprint"""
+        return self.header_entities + len(ROM_ROW_ENTITY_NAMES) * row + k
+
+    def write_blueprint(self, out, export=None):
+        """
+        Writes the blueprint string to out, from the cached JSON of each entity.
+        export is an optional SegmentedExport, kept between runs, to only compress the changed parts again.
+        """
+        json_dict = Blueprint().json_dict
+        json_dict["blueprint"]["entities"] = self.entity_json
+
+        def encode(obj):
+            # the entities are already encoded
+            return obj if isinstance(obj, str) else json.dumps(obj)
+
+        if export is not None:
+            export.write(json_dict, out, encode)
+        else:
+            bp_write_stream(json_dict, out, encode)
+
+
+def remove_wires_beyond(entity, last_entity_number):
+    """
+    Removes the wires to entities numbered above last_entity_number, and the sides and colors left without wires,
+    so the entity is the same as one generated without the removed entities
+    """
+    connections = entity.get("connections", dict())
+    for side in list(connections):
+        for color in list(connections[side]):
+            wires = [w for w in connections[side][color] if w["entity_id"] <= last_entity_number]
+            if len(wires) > 0:
+                connections[side][color] = wires
+            else:
+                del connections[side][color]
+        if len(connections[side]) == 0:
+            del connections[side]
+    if "connections" in entity and len(connections) == 0:
+        del entity["connections"]
+
+
+def cache_fingerprint():
+    """Hash of the cache version, the PROM template and the modules the cached results depend on"""
+    h = hashlib.sha1(str(CACHE_VERSION).encode("utf-8"))
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    for filename in [constants.PROM_SINGLE_LINE_TEMPLATE] + [os.path.join(module_dir, f) for f in _FINGERPRINT_FILES]:
+        with open(filename, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
@@ -0,0 +1,371 @@
+# Local assembly service, an HTTP server for the tools assembling programs over and over
+# usage: python assembly_service.py [--port PORT | --unix PATH] [-j WORKERS] [--cache-size N]
+#     POST /assemble[?optimize=1&compact=1]   the program as the body, answers JSON with the blueprint string
+#     GET /metrics                            counts, cache hits, throughput and latency, as JSON
+# Programs are assembled by a pool of processes. Requests for a program already being assembled wait for it,
+# instead of assembling it again, and the latest results are kept in an LRU cache, both keyed by source hash.
+# A cached result is only used while the files the program includes are unchanged.
+# #include paths are relative to the working directory of the service.
+# Binds to localhost by default, nothing leaves the machine.
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import constants
+from assembler_api import AssemblyOptions, assemble
+from batch_assembler import start_worker, warm_up
+from exceptions import AssemblyError
+from include_cache import FileStamp
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_SIZE = 256  # results
+LATENCY_WINDOW = 1000  # requests the latency percentiles are taken over
+MAX_BODY_SIZE = 64 << 20  # bytes
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 422: "Unprocessable Entity"}
+
+
+def diagnostic_dict(diagnostic):
+    return dict(diagnostic.to_dict(), text=str(diagnostic))
+
+
+def assemble_job(source, optimize, compact):
+    """Assembles in a worker process, returns the response as a dict"""
+    try:
+        result = assemble(source, AssemblyOptions(optimize=optimize, compact=compact))
+        return {"ok": True, "blueprint": result.blueprint_string, "instructions": len(result.instructions),
+                "warnings": [diagnostic_dict(d) for d in result.warnings], "included": result.included}
+    except AssemblyError as e:
+        return {"ok": False, "errors": [diagnostic_dict(d) for d in e.diagnostics], "included": e.included}
+
+
+def source_key(source, optimize, compact):
+    """Hash of the source and the options, results are shared by requests with the same key"""
+    digest = hashlib.sha256(source.encode("utf-8"))
+    digest.update(bytes([optimize, compact]))
+    return digest.hexdigest()
+
+
+class ServiceMetrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.cache_hits = 0
+        self.coalesced = 0  # requests which waited for the same program being assembled
+        self.assembled = 0
+        self.failed = 0  # programs with errors
+        self.assembly_seconds = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # seconds of the latest requests
+
+    def to_dict(self, in_flight, cached, workers):
+        uptime = time.perf_counter() - self.start
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e3 if latencies else None
+
+        return {"uptime_seconds": uptime, "requests": self.requests, "requests_per_second": self.requests / uptime,
+                "cache_hits": self.cache_hits, "coalesced": self.coalesced, "assembled": self.assembled,
+                "failed": self.failed, "assembly_seconds": self.assembly_seconds, "in_flight": in_flight,
+                "cached": cached, "workers": workers,
+                "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99),
+                               "max": latencies[-1] * 1e3 if latencies else None}}
+
+
+class AssemblyService:
+    """
+    Assembles programs in a pool of worker processes, one job per distinct program at a time,
+    with an LRU cache of the results. Call close() when done, or use it as an async context manager.
+    """
+
+    def __init__(self, workers=None, cache_size=DEFAULT_CACHE_SIZE, include_cache_dir=None):
+        warm_up()  # forked workers start with the PROM template loaded
+        # include_cache_dir is where the workers keep the parsed #include files, None for each in its memory
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=start_worker,
+                                            initargs=(include_cache_dir,))
+        # the workers are forked now, as workers forked on the first request would inherit its open connection
+        self.executor.submit(warm_up).result()
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # key => response and FileStamp of each included file, least recently used first
+        self.in_flight = dict()  # key => future of the response
+        self.metrics = ServiceMetrics()
+
+    async def assemble(self, source, optimize=False, compact=False):
+        """The response dict of the program, from the cache, the same program being assembled, or a worker"""
+        start = time.perf_counter()
+        self.metrics.requests += 1
+        key = source_key(source, optimize, compact)
+        response = self._cache_get(key)
+        if response is not None:
+            self.metrics.cache_hits += 1
+        elif key in self.in_flight:
+            self.metrics.coalesced += 1
+            # shielded, a request which is cancelled does not cancel the others waiting
+            response = await asyncio.shield(self.in_flight[key])
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.in_flight[key] = future
+            try:
+                response = await self._run_job(source, optimize, compact)
+                self._cache_put(key, response)
+                future.set_result(response)
+            except BaseException as e:
+                # raised to the requests waiting on the future, and to this one
+                future.set_exception(e)
+                future.exception()  # marks it as retrieved, when nothing was waiting
+                raise
+            finally:
+                del self.in_flight[key]
+        self.metrics.latencies.append(time.perf_counter() - start)
+        return response
+
+    async def _run_job(self, source, optimize, compact):
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(self.executor, assemble_job, source, optimize, compact)
+        self.metrics.assembly_seconds += time.perf_counter() - start
+        self.metrics.assembled += 1
+        if not response["ok"]:
+            self.metrics.failed += 1
+        return response
+
+    def _cache_get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        response, stamps = entry
+        if not all(stamp.matches(path) for path, stamp in stamps):
+            # an included file changed
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return response
+
+    def _cache_put(self, key, response):
+        if self.cache_size <= 0:
+            return
+        try:
+            stamps = [(path, FileStamp.of(path)) for path in response.get("included", ())]
+        except OSError:
+            return
+        self.cache[key] = (response, stamps)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def metrics_dict(self):
+        return self.metrics.to_dict(len(self.in_flight), len(self.cache), self.workers)
+
+    def close(self):
+        self.executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def handle_connection(self, reader, writer):
+        """Answers the HTTP/1.1 requests of a connection, kept open between requests unless asked otherwise"""
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                status, response = await self.respond(method, target, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                write_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except HttpError as e:
+            write_response(writer, e.status, {"ok": False, "error": str(e)}, False)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target, body):
+        """The status and JSON response of a request"""
+        url = urlsplit(target)
+        if url.path == "/assemble":
+            if method != "POST":
+                return 405, {"ok": False, "error": "POST the program to /assemble"}
+            query = parse_qs(url.query)
+            flags = [query.get(name, ["0"])[-1] not in ("0", "", "false") for name in ("optimize", "compact")]
+            try:
+                source = body.decode("utf-8")
+            except UnicodeDecodeError:
+                return 400, {"ok": False, "error": "The program must be UTF-8"}
+            response = await self.assemble(source, *flags)
+            return 200 if response["ok"] else 422, response
+        if url.path == "/metrics":
+            if method != "GET":
+                return 405, {"ok": False, "error": "GET /metrics"}
+            return 200, self.metrics_dict()
+        return 404, {"ok": False, "error": "Unknown path " + url.path}
+
+
+class HttpError(Exception):
+    def __init__(self, status, msg):
+        super().__init__(msg)
+        self.status = status
+
+
+async def read_request(reader):
+    """Method, target, headers (lower case names) and body of the next request, None once the client is done"""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, target, version = request_line.decode("latin-1").split()
+    except ValueError:
+        raise HttpError(400, "Invalid request line")
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HttpError(400, "Invalid Content-Length")
+    if length > MAX_BODY_SIZE:
+        raise HttpError(413, "The program is larger than {} bytes".format(MAX_BODY_SIZE))
+    body = await reader.readexactly(length) if length > 0 else b""
+    return method, target, headers, body
+
+
+def write_response(writer, status, response, keep_alive):
+    body = json.dumps(response).encode("utf-8")
+    writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n"
+                 .format(status, HTTP_REASONS[status], len(body), "keep-alive" if keep_alive else "close")
+                 .encode("latin-1") + body)
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None, workers=None, cache_size=DEFAULT_CACHE_SIZE,
+                include_cache_dir=None):
+    async with AssemblyService(workers, cache_size, include_cache_dir) as service:
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(service.handle_connection, unix_path)
+            where = unix_path
+        else:
+            server = await asyncio.start_server(service.handle_connection, host, port)
+            where = "http://{}:{}".format(host, server.sockets[0].getsockname()[1])
+        print("Assembling at {} with {} workers, Ctrl+C to stop".format(where, service.workers), flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local HTTP service assembling programs into blueprint strings")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="default " + DEFAULT_HOST + ", this machine only")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="default {}".format(DEFAULT_PORT))
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes, default all cores")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help="results kept, default {}".format(DEFAULT_CACHE_SIZE))
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.cache_size,
+                          constants.DEFAULT_INCLUDE_CACHE_DIR))
+    except KeyboardInterrupt:
+        pass
+
+
+def _test():
+    import sys
+    import tempfile
+
+    print("Running test on assembly service...")
+    test_error_count = 0
+
+    def check(what, result, expected):
+        nonlocal test_error_count
+        if result != expected:
+            print("{}: {!r}, expected {!r}".format(what, result, expected), file=sys.stderr)
+            test_error_count += 1
+
+    async def request(port, method, target, body=b""):
+        reader, writer = await asyncio.open_connection(DEFAULT_HOST, port)
+        writer.write("{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+                     .format(method, target, len(body)).encode("latin-1") + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        response = (await reader.read()).split(b"\r\n\r\n", 1)[1]
+        writer.close()
+        return status, json.loads(response)
+
+    async def run():
+        with open("examples/demo_quicksort.fal") as f:
+            text = f.read()
+        expected = assemble(text).blueprint_string
+        async with AssemblyService(workers=2, cache_size=2) as service:
+            server = await asyncio.start_server(service.handle_connection, DEFAULT_HOST, 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                # identical requests at once are assembled once
+                responses = await asyncio.gather(*[request(port, "POST", "/assemble", text.encode())
+                                                   for _ in range(5)])
+                check("statuses", [status for status, response in responses], [200] * 5)
+                check("blueprints", {response["blueprint"] for status, response in responses}, {expected})
+                check("assembled", service.metrics.assembled, 1)
+                check("coalesced", service.metrics.coalesced, 4)
+
+                # then come from the cache, other options are another result
+                status, response = await request(port, "POST", "/assemble", text.encode())
+                check("cache hits", service.metrics.cache_hits, 1)
+                status, response = await request(port, "POST", "/assemble?compact=1", text.encode())
+                check("compact", response["blueprint"], assemble(text, AssemblyOptions(compact=True))
+                      .blueprint_string)
+
+                status, response = await request(port, "POST", "/assemble", b"MOV R1, 5\nFOO\nMOV R1, 1x\n")
+                check("error status", status, 422)
+                check("errors", [(e["line"], e["message"]) for e in response["errors"]],
+                      [(2, "Unknown opcode FOO"), (3, "Unknown register 1x")])
+                # the cache holds the 2 latest
+                check("cached", len(service.cache), 2)
+                check("not found", (await request(port, "GET", "/nothing"))[0], 404)
+                check("method", (await request(port, "GET", "/assemble"))[0], 405)
+
+                status, metrics = await request(port, "GET", "/metrics")
+                check("requests", metrics["requests"], 8)
+                check("failed", metrics["failed"], 1)
+                check("in flight", metrics["in_flight"], 0)
+                check("latency", metrics["latency_ms"]["max"] >= metrics["latency_ms"]["p50"] > 0, True)
+
+                # an error in an included file is not answered from the cache once the file is fixed
+                with tempfile.TemporaryDirectory() as directory:
+                    lib = os.path.join(directory, "lib.fal")
+                    with open(lib, "w") as f:
+                        f.write("#macro inc 1\n")
+                    program = '#include "{}"\ninc R1\n'.format(lib).encode()
+                    status, response = await request(port, "POST", "/assemble", program)
+                    check("error in included file", (status, response["included"]), (422, [lib]))
+                    with open(lib, "w") as f:
+                        f.write("#macro inc 1\nADD $0, $0, 1\n#endm\n")
+                    status, response = await request(port, "POST", "/assemble", program)
+                    check("included file fixed", (status, response["included"]), (200, [lib]))
+
+    asyncio.run(run())
+    if test_error_count == 0:
+        print("All tests succeeded")
+    else:
+        print("{} test{} failed".format(test_error_count, "" if test_error_count == 1 else "s"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# Assembles many program files at once, across a pool of processes
+# usage: python batch_assembler.py [-o OUTPUT_DIR] [-j WORKERS] [-O] [--compact | --bank-size ROWS [--book]] files...
+# Each input gets one blueprint string, OUTPUT_DIR/<name>.txt, and a failing file does not stop the batch.
+# The files are assembled by assembler_api, with the same options as assembler.py.
+
+import argparse
+import glob
+import os
+import pathlib
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import constants
+from assembler import atomic_open
+from assembler_api import AssemblyOptions, assemble
+from blueprint_generator import get_rom_row_template
+from exceptions import AssemblyError
+from include_cache import use_directory
+
+DEFAULT_OUTPUT_DIR = "batch_output"
+
+
+def warm_up():
+    """Loads the PROM template, once per worker process. The opcode tables are compiled when imported."""
+    get_rom_row_template(constants.PROM_SINGLE_LINE_TEMPLATE)
+
+
+def start_worker(include_cache_dir=None):
+    """Initializer of the worker processes, include_cache_dir is where they keep the parsed #include files"""
+    warm_up()
+    use_directory(include_cache_dir)
+
+
+def output_filename(file_in, output_dir):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(file_in))[0] + ".txt")
+
+
+def assemble_file(file_in, file_out, options=None):
+    """
+    Assembles one file into a blueprint string file, with the assembler_api.AssemblyOptions.
+    Returns a dict with the input and output names, ok, the error and warning messages, and the time taken.
+    """
+    result = {"input": file_in, "output": file_out, "ok": False, "error": None, "warnings": "", "seconds": 0.0}
+    start = time.perf_counter()
+    try:
+        assembled = assemble(pathlib.Path(file_in), options)
+        with atomic_open(file_out) as f:
+            assembled.write_blueprint(f)
+            f.write("\n")
+        result["ok"] = True
+        result["warnings"] = "".join(str(warning) + "\n" for warning in assembled.warnings)
+    except AssemblyError as e:
+        result["error"] = str(e)
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def _assemble_job(job):
+    return assemble_file(*job)
+
+
+def expand_sources(patterns):
+    """Files matching each pattern, in order, without duplicates"""
+    files = dict()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        files.update(dict.fromkeys(matches))
+    return list(files)
+
+
+def batch_assemble(sources, output_dir=DEFAULT_OUTPUT_DIR, workers=None, include_cache_dir=None, options=None):
+    """
+    Assembles each source file in a process pool, returns the result of each file in order, see assemble_file.
+    include_cache_dir is the directory of the parsed #include files shared by the workers, None to parse them in each.
+    options are the assembler_api.AssemblyOptions of every file, banks are generated by the worker of their file.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(file_in, output_filename(file_in, output_dir), options) for file_in in sources]
+    outputs = [file_out for file_in, file_out, options in jobs]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Input files with the same name would write the same output file")
+    # warm up before the workers start, so forked workers share the loaded template
+    warm_up()
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker, initargs=(include_cache_dir,)) as executor:
+        return list(executor.map(_assemble_job, jobs, chunksize=max(1, len(jobs) // (8 * (os.cpu_count() or 1)))))
+
+
+def print_report(results):
+    total = 0.0
+    for result in results:
+        status = "ok" if result["ok"] else "FAILED"
+        print(status.ljust(8), "{:.3f} s".format(result["seconds"]).rjust(10), " ", result["input"])
+        total += result["seconds"]
+    for result in results:
+        if not result["ok"]:
+            print("\n" + result["input"] + "\n" + result["error"].rstrip("\n"), file=sys.stderr)
+        elif result["warnings"]:
+            print("\n" + result["input"] + "\n" + result["warnings"].rstrip("\n"), file=sys.stderr)
+    failed = sum(1 for result in results if not result["ok"])
+    print("{} files, {} failed, {:.3f} s assembling".format(len(results), failed, total))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assembles many program files into blueprint strings")
+    parser.add_argument("sources", nargs="+", help="program files or glob patterns, like examples/*.fal")
+    parser.add_argument("-o", "--output-dir", default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes, default all cores")
+    parser.add_argument("-O", "--optimize", action="store_true", help="run the peephole optimizer, see assembler.py")
+    parser.add_argument("--compact", action="store_true", help="write the smallest blueprint strings, see assembler.py")
+    parser.add_argument("--bank-size", type=int, metavar="ROWS", help="split each PROM into banks of ROWS rows")
+    parser.add_argument("--book", action="store_true", help="with --bank-size, a blueprint book of one bank each")
+    args = parser.parse_args()
+    if args.bank_size is not None and args.bank_size < 1:
+        parser.error("--bank-size must be positive")
+    if args.bank_size is None and args.book:
+        parser.error("--book needs --bank-size")
+    if args.bank_size is not None and args.compact:
+        parser.error("--compact can not be combined with --bank-size")
+    # the files are already assembled in parallel, the banks of each file by its own worker
+    options = AssemblyOptions(args.optimize, args.compact, args.bank_size, args.book,
+                              1 if args.bank_size is not None else None)
+
+    sources = expand_sources(args.sources)
+    start = time.perf_counter()
+    results = batch_assemble(sources, args.output_dir, args.workers, constants.DEFAULT_INCLUDE_CACHE_DIR, options)
+    print_report(results)
+    print("Done in {:.3f} s. Blueprint strings saved in {}".format(time.perf_counter() - start, args.output_dir))
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
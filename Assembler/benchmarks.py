@@ -0,0 +1,718 @@
+# Benchmarks for the different stages of the assembler
+# Run from within the Assembler directory: python benchmarks.py [names]
+# The stages benchmark can be saved as a JSON baseline, and later runs compared against it:
+#   python benchmarks.py stages --save baseline.json
+#   python benchmarks.py stages --compare baseline.json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+from macro import Macro
+from macro_expander import expand_macros
+from tokenizer import tokenize_file
+
+
+def bench_macro_expansion(call_site_counts=(1_000, 10_000, 100_000, 1_000_000)):
+    """Times macro expansion on programs with an increasing number of macro call sites"""
+    print("Macro expansion, nested macro call sites")
+    filename = "abcdefgh_bench_macros.txt"
+    with open(filename, "w") as f:
+        f.write("#macro inner 1\nADD R1, R1, $0\n#endm\n")
+        f.write("#macro outer 2\ninner $0\nSUB R2, R2, $1\n#endm\n")
+        f.write("outer 1 2\n")
+    try:
+        lines_of_tokens = tokenize_file(filename)
+    finally:
+        os.remove(filename)
+    # parse the two macros once, then reuse the call site line for each call
+    program = lines_of_tokens[:-1]
+    call_site = lines_of_tokens[-1]
+    macros = dict()
+    for i, line in enumerate(program):
+        if line[0].text == "#macro":
+            m = Macro(line[1].text, int(line[2].text), i, line[0])
+            macros[m.name] = m
+        elif line[0].text != "#endm":
+            m.lines_of_inst.append(line)
+
+    print("call sites".rjust(12), "seconds".rjust(10), "us per call site".rjust(18))
+    for n in call_site_counts:
+        lines = [call_site] * n
+        start = time.perf_counter()
+        expanded = 0
+        for _ in expand_macros(lines, macros):
+            expanded += 1
+        elapsed = time.perf_counter() - start
+        assert expanded == 2 * n
+        print(str(n).rjust(12), "{:.3f}".format(elapsed).rjust(10), "{:.3f}".format(elapsed / n * 1e6).rjust(18))
+    print()
+
+
+def bench_rom_generation(line_counts=(1_000, 10_000, 100_000)):
+    """Times stamping out PROM rows from the template, and generating the full ROM entities"""
+    import json
+    import constants
+    from blueprint_generator import Blueprint, get_rom_row_template
+
+    print("PROM row generation")
+    with open(constants.PROM_SINGLE_LINE_TEMPLATE) as f:
+        single_line_json = f.read()
+    template = get_rom_row_template(constants.PROM_SINGLE_LINE_TEMPLATE)
+
+    print("lines".rjust(12), "json.loads".rjust(12), "template".rjust(12), "generate_rom".rjust(14))
+    for n in line_counts:
+        start = time.perf_counter()
+        for _ in range(n):
+            json.loads(single_line_json)["entities"]
+        parse_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(n):
+            template.new_row()
+        template_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        Blueprint().generate_rom_entities(n)
+        generate_time = time.perf_counter() - start
+        print(str(n).rjust(12), "{:.3f}".format(parse_time).rjust(12), "{:.3f}".format(template_time).rjust(12),
+              "{:.3f}".format(generate_time).rjust(14))
+    print()
+
+
+def bench_export(line_counts=(1_000, 10_000, 30_000)):
+    """Compares time and extra peak memory of the one-shot and the streaming blueprint export"""
+    import json
+    import tracemalloc
+    from blueprint_generator import Blueprint
+    from blueprint_import_export import bp_compress, bp_encode_base64, bp_write_stream
+
+    print("Blueprint export, one-shot vs streaming")
+    print("lines".rjust(12), "one-shot s".rjust(12), "one-shot MB".rjust(12), "stream s".rjust(12),
+          "stream MB".rjust(12))
+    for n in line_counts:
+        bp = Blueprint()
+        bp.generate_rom_entities(n)
+        bp.insert_signals([{"copper-plate": 9, "signal-U": 3, "signal-K": 1, "signal-0": 4}] * n)
+        results = list()
+        null_out = open(os.devnull, "w")
+        for export in (lambda: bp_encode_base64(bp_compress(json.dumps(bp.json_dict))),
+                       lambda: bp_write_stream(bp.json_dict, null_out)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            export()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results += ["{:.3f}".format(elapsed).rjust(12), "{:.1f}".format(peak / 2**20).rjust(12)]
+        null_out.close()
+        print(str(n).rjust(12), *results)
+    print()
+
+
+def bench_numeric_labels(label_count=100_000, sampled_references=1_000):
+    """Times resolving numeric label references, linear search against the label index"""
+    import random
+    import label as lb
+
+    print("Numeric label lookup, {} local labels".format(label_count))
+    labels = [lb.NumericLabel(i % 10, i, i + 1) for i in range(label_count)]
+    references = [(random.randrange(10), random.randrange(label_count)) for _ in range(label_count)]
+
+    start = time.perf_counter()
+    index = lb.NumericLabelIndex(labels)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for digit, pc_adr in references:
+        try:
+            index.find_back_label(digit, pc_adr)
+        except lb.AsmSyntaxError:
+            pass
+    index_time = time.perf_counter() - start
+
+    # the linear search is too slow for every reference, extrapolate from a sample
+    start = time.perf_counter()
+    for digit, pc_adr in references[:sampled_references]:
+        lb.find_numeric_labels(labels, digit, pc_adr)
+    linear_time = (time.perf_counter() - start) * label_count / sampled_references
+
+    print("{} references: linear search {:.1f} s (extrapolated), index {:.3f} s (+ {:.3f} s to build)"
+          .format(label_count, linear_time, index_time, build_time))
+    print()
+
+
+def bench_tokenizer(megabytes=4):
+    """Times each tokenizer backend on a multi-megabyte source file"""
+    import gc
+    from tokenizer import TOKENIZER_BACKENDS
+
+    print("Tokenizer backends, {} MB source".format(megabytes))
+    filename = "abcdefgh_bench_tokenizer.txt"
+    with open("examples/demo_quicksort.fal") as f:
+        sample = f.read()
+    with open(filename, "w") as f:
+        for i in range(megabytes * 2**20 // (2 * len(sample))):
+            f.write(sample)
+            # and as many unique lines
+            for j in range(len(sample) // 48):
+                f.write("label_{}_{}: STORE R{}, [R3, {}] ; store\n".format(i, j, j % 32, i))
+    try:
+        timings = dict()
+        for backend in TOKENIZER_BACKENDS:
+            gc.collect()
+            start = time.perf_counter()
+            tokenize_file(filename, backend=backend)
+            timings[backend] = time.perf_counter() - start
+    finally:
+        os.remove(filename)
+    slowest = max(timings.values())
+    for backend, elapsed in timings.items():
+        print(backend.rjust(12), "{:.3f} s".format(elapsed).rjust(10), "{:.1f}x".format(slowest / elapsed).rjust(8))
+    print()
+
+
+def bench_emulator(runs=200):
+    """Times the emulator on the quicksort demo, in emulated instructions per second"""
+    from emulator import Emulator, load_program
+
+    print("Emulator, demo_quicksort.fal")
+    rom_signals = load_program("examples/demo_quicksort.fal")
+    start = time.perf_counter()
+    emu = Emulator(rom_signals)
+    decode_time = time.perf_counter() - start
+    steps = 0
+    start = time.perf_counter()
+    for _ in range(runs):
+        emu.reset()
+        emu.run()
+        steps += emu.steps
+    elapsed = time.perf_counter() - start
+    print("{} runs, {} instructions: {:.3f} s, {:.0f} instructions per second (+ {:.3f} ms to decode)"
+          .format(runs, steps, elapsed, steps / elapsed, decode_time * 1e3))
+    print()
+
+
+def bench_translator(runs=200):
+    """Compares the emulator and the translated program on the quicksort demo"""
+    from emulator import Emulator, load_program
+    from translator import TranslatedEmulator
+
+    print("Emulator against translated program, demo_quicksort.fal")
+    rom_signals = load_program("examples/demo_quicksort.fal")
+    timings = dict()
+    setup_times = dict()
+    for emulator_class in (Emulator, TranslatedEmulator):
+        start = time.perf_counter()
+        emu = emulator_class(rom_signals)
+        setup_time = time.perf_counter() - start
+        best = None
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(runs):
+                emu.reset()
+                emu.run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[emulator_class.__name__] = best
+        setup_times[emulator_class.__name__] = setup_time
+        print(emulator_class.__name__.rjust(20), "{:.3f} s for {} runs".format(best, runs).rjust(22),
+              "{:.0f} instructions per second".format(emu.steps * runs / best).rjust(32),
+              "(+ {:.1f} ms setup)".format(setup_time * 1e3))
+    print("speedup {:.1f}x, {:.1f}x with the setup".format(
+        timings["Emulator"] / timings["TranslatedEmulator"],
+        (timings["Emulator"] + setup_times["Emulator"]) / (timings["TranslatedEmulator"] +
+                                                             setup_times["TranslatedEmulator"])))
+    print()
+
+
+def bench_rom_matrix(line_count=100_000):
+    """Compares memory and conversion time of the signal dicts and the ROM matrix"""
+    import tracemalloc
+    from rom_matrix import RomMatrix, np
+
+    print("ROM matrix, {} instructions".format(line_count))
+    if np is None:
+        print("NumPy not installed, skipped")
+        print()
+        return
+    from emulator import load_program
+    sample = load_program("examples/demo_quicksort.fal")
+    tracemalloc.start()
+    # fresh dicts for each row, as inst_to_signals makes them without a signal cache
+    rom_signals = [{k: v + i // len(sample) for k, v in sample[i % len(sample)].items()} for i in range(line_count)]
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    matrix = RomMatrix.from_signals(rom_signals)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    assert matrix.to_signals() == rom_signals
+    convert_time = time.perf_counter() - start
+    start = time.perf_counter()
+    matrix.statistics()
+    matrix.changed_rows(matrix)
+    stats_time = time.perf_counter() - start
+    layouts, packed = matrix.pack()
+
+    print("signal dicts {:.1f} MB, matrix {:.1f} MB, packed {:.1f} MB".format(
+        dict_bytes / 2**20, matrix.nbytes / 2**20, (layouts.nbytes + packed.nbytes) / 2**20))
+    print("from_signals {:.3f} s, to_signals {:.3f} s, statistics and diff {:.3f} s".format(
+        build_time, convert_time, stats_time))
+    print()
+
+
+def bench_encoding(instruction_count=200_000):
+    """Times encoding parsed instructions into ROM signals, in instructions per second"""
+    from insr_to_signals import inst_to_signals
+    from token_parser import token_parser
+
+    print("Instruction encoding, {} instructions".format(instruction_count))
+    sample = list()
+    for filename in ["examples/demo_quicksort.fal", "examples/demo_mem_test.fal", "examples/demo_macros.fal"]:
+        sample += token_parser(tokenize_file(filename))
+    instructions = [sample[i % len(sample)] for i in range(instruction_count)]
+    timings = list()
+    for _ in range(3):
+        start = time.perf_counter()
+        inst_to_signals(instructions)
+        timings.append(time.perf_counter() - start)
+    elapsed = min(timings)
+    print("{:.3f} s, {:,.0f} instructions per second".format(elapsed, instruction_count / elapsed))
+    print()
+
+
+def bench_disassembler(line_counts=(1_000, 10_000, 30_000)):
+    """Times disassembling blueprint strings of increasing size, it should grow linearly"""
+    from blueprint_generator import Blueprint
+    from blueprint_import_export import bp_write_stream
+    from disassembler import disassemble
+    from emulator import load_program
+
+    print("Disassembler")
+    sample = load_program("examples/demo_quicksort.fal")
+    print("lines".rjust(12), "seconds".rjust(10), "us per line".rjust(12))
+    for n in line_counts:
+        bp = Blueprint()
+        bp.generate_rom_entities(n)
+        bp.insert_signals([sample[i % len(sample)] for i in range(n)])
+        stream = io.StringIO()
+        bp_write_stream(bp.json_dict, stream)
+        start = time.perf_counter()
+        lines = disassemble(stream.getvalue())
+        elapsed = time.perf_counter() - start
+        assert sum(1 for line in lines if not line.endswith(":")) == n
+        print(str(n).rjust(12), "{:.3f}".format(elapsed).rjust(10), "{:.1f}".format(elapsed / n * 1e6).rjust(12))
+    print()
+
+
+def bench_compact_export(instruction_counts=(1_000, 10_000)):
+    """Compares size and time of the default and the compact blueprint strings of generated programs"""
+    from blueprint_generator import Blueprint
+    from blueprint_import_export import CompactExport, bp_write_stream
+    from emulator import load_program
+    from program_generator import generate_program
+
+    print("Compact export, generated programs")
+    print("instructions".rjust(12), "default KB".rjust(12), "compact KB".rjust(12), "saved".rjust(8),
+          "default s".rjust(10), "compact s".rjust(10), "  zlib level, strategy")
+    filename = "abcdefgh_bench_compact.fal"
+    for n in instruction_counts:
+        with open(filename, "w") as f:
+            f.write(generate_program(n))
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                rom_signals = load_program(filename)
+        finally:
+            os.remove(filename)
+        bp = Blueprint()
+        bp.generate_rom_entities(len(rom_signals))
+        bp.insert_signals(rom_signals)
+        default = io.StringIO()
+        start = time.perf_counter()
+        bp_write_stream(bp.json_dict, default)
+        default_time = time.perf_counter() - start
+        compact = io.StringIO()
+        export = CompactExport()
+        start = time.perf_counter()
+        export.write(bp.json_dict, compact)
+        compact_time = time.perf_counter() - start
+        default_size, compact_size = len(default.getvalue()), len(compact.getvalue())
+        print(str(n).rjust(12), "{:.1f}".format(default_size / 1024).rjust(12),
+              "{:.1f}".format(compact_size / 1024).rjust(12), "{:.0%}".format(1 - compact_size / default_size).rjust(8),
+              "{:.3f}".format(default_time).rjust(10), "{:.3f}".format(compact_time).rjust(10),
+              "  {}, {}".format(*export.chosen_setting))
+    print()
+
+
+def bench_rom_banks(instruction_count=100_000, bank_size=4096):
+    """Compares generating and exporting a single PROM column with a banked PROM, in one process and on all cores"""
+    from blueprint_generator import Blueprint
+    from blueprint_import_export import bp_write_stream
+    from emulator import load_program
+    from program_generator import generate_program
+    from rom_banks import RomBanks
+
+    print("Banked PROM, {} instructions, {} rows per bank".format(instruction_count, bank_size))
+    filename = "abcdefgh_bench_banks.fal"
+    with open(filename, "w") as f:
+        f.write(generate_program(instruction_count))
+    try:
+        with contextlib.redirect_stderr(io.StringIO()):
+            rom_signals = load_program(filename)
+    finally:
+        os.remove(filename)
+
+    def single_column(rom_signals, out):
+        bp = Blueprint()
+        bp.generate_rom_entities(len(rom_signals))
+        bp.insert_signals(rom_signals)
+        bp_write_stream(bp.json_dict, out)
+
+    timings = dict()
+    for name, build in [("single column", single_column),
+                        ("banks, 1 process", RomBanks(bank_size, workers=1).write),
+                        ("banks, {} processes".format(os.cpu_count()), RomBanks(bank_size).write),
+                        ("book, {} processes".format(os.cpu_count()), RomBanks(bank_size, book=True).write)]:
+        start = time.perf_counter()
+        build(rom_signals, io.StringIO())
+        timings[name] = time.perf_counter() - start
+    for name, elapsed in timings.items():
+        print(name.rjust(20), "{:.3f} s".format(elapsed).rjust(10),
+              "{:.1f}x".format(timings["single column"] / elapsed).rjust(8))
+    print()
+
+
+def bench_peephole(instruction_counts=(1_000, 10_000, 100_000)):
+    """Times the peephole optimizer on generated programs, with what it saved"""
+    from peephole import optimize
+    from program_generator import generate_program
+    from token_parser import token_parser
+    from tokenizer import tokenize_file
+
+    print("Peephole optimizer, generated programs")
+    print("instructions".rjust(12), "removed".rjust(10), "seconds".rjust(10), "us/instr".rjust(10), "  rules")
+    filename = "abcdefgh_bench_peephole.fal"
+    for n in instruction_counts:
+        with open(filename, "w") as f:
+            f.write(generate_program(n))
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                instructions = token_parser(tokenize_file(filename))
+        finally:
+            os.remove(filename)
+        start = time.perf_counter()
+        _, report = optimize(instructions)
+        elapsed = time.perf_counter() - start
+        print(str(n).rjust(12), str(report.instructions_before - report.instructions_after).rjust(10),
+              "{:.3f}".format(elapsed).rjust(10), "{:.1f}".format(elapsed / n * 1e6).rjust(10),
+              "  " + ", ".join("{} {}x".format(name, k) for name, k in report.applied.items()))
+    print()
+
+
+def bench_cost_analyzer(instruction_counts=(1_000, 10_000, 100_000)):
+    """Times the control-flow graph, dominators and loops of the cost analyzer on generated programs"""
+    from cost_analyzer import analyze
+    from program_generator import generate_program
+    from token_parser import token_parser
+    from tokenizer import tokenize_file
+
+    print("Cost analyzer, generated programs")
+    print("instructions".rjust(12), "blocks".rjust(10), "loops".rjust(8), "seconds".rjust(10), "us/instr".rjust(10))
+    filename = "abcdefgh_bench_cost.fal"
+    for n in instruction_counts:
+        with open(filename, "w") as f:
+            f.write(generate_program(n))
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                instructions = token_parser(tokenize_file(filename))
+        finally:
+            os.remove(filename)
+        start = time.perf_counter()
+        report = analyze(instructions)
+        elapsed = time.perf_counter() - start
+        print(str(n).rjust(12), str(len(report.blocks)).rjust(10), str(len(report.loops)).rjust(8),
+              "{:.3f}".format(elapsed).rjust(10), "{:.1f}".format(elapsed / n * 1e6).rjust(10))
+    print()
+
+
+def bench_circuit_simulator(ticks=2000):
+    """Times the circuit simulator on the full computer, started, and on generated PROMs settling"""
+    from blueprint_generator import Blueprint
+    from blueprint_import_export import bp_write_stream
+    from circuit_simulator import FULL_COMPUTER_START, CircuitSimulator
+    from emulator import load_program
+    from program_generator import generate_program
+
+    print("Circuit simulator")
+    with open("../Blueprints/full_computer.txt") as f:
+        blueprint_string = f.read()
+    start = time.perf_counter()
+    simulator = CircuitSimulator.from_string(blueprint_string)
+    load_time = time.perf_counter() - start
+    simulator.run_until_stable()
+    simulator.set_enabled(FULL_COMPUTER_START, True)
+    start = time.perf_counter()
+    simulator.run(ticks)
+    elapsed = time.perf_counter() - start
+    print("full computer: loaded in {:.3f} s, {} ticks in {:.3f} s, {:.0f} ticks/s".format(
+        load_time, ticks, elapsed, ticks / elapsed))
+
+    # the row indexes of a new PROM count up through all rows below, a tick per row
+    filename = "abcdefgh_bench_simulator.fal"
+    for n in (300, 1_000):
+        with open(filename, "w") as f:
+            f.write(generate_program(n))
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                rom_signals = load_program(filename)
+        finally:
+            os.remove(filename)
+        bp = Blueprint()
+        bp.generate_rom_entities(len(rom_signals))
+        bp.insert_signals(rom_signals)
+        out = io.StringIO()
+        bp_write_stream(bp.json_dict, out)
+        start = time.perf_counter()
+        simulator = CircuitSimulator.from_string(out.getvalue())
+        settle_ticks = simulator.run_until_stable()
+        elapsed = time.perf_counter() - start
+        print("PROM of {} rows: loaded and settled in {} ticks, {:.3f} s".format(len(rom_signals), settle_ticks,
+                                                                                 elapsed))
+    print()
+
+
+def bench_threads(program_count=16, instruction_count=500, thread_counts=(1, 2, 4, 8)):
+    """Times assembling many generated programs at once in one process, by a pool of threads"""
+    from concurrent.futures import ThreadPoolExecutor
+    from assembler_api import assemble
+    from program_generator import generate_program
+
+    print("Assembler API, {} programs of {} instructions, blueprint strings".format(program_count,
+                                                                                   instruction_count))
+    sources = [generate_program(instruction_count) + "MOV R1, {}\n".format(i) for i in range(program_count)]
+
+    def blueprint_string(source):
+        return assemble(source).blueprint_string
+
+    print("threads".rjust(8), "seconds".rjust(10), "programs/s".rjust(12))
+    for threads in thread_counts:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(blueprint_string, sources))
+        elapsed = time.perf_counter() - start
+        print(str(threads).rjust(8), "{:.3f}".format(elapsed).rjust(10),
+              "{:.1f}".format(program_count / elapsed).rjust(12))
+    print()
+
+
+def bench_service(request_count=200, distinct_programs=20, instruction_count=300, concurrency=16):
+    """Times the assembly service answering requests for a few programs, most of them repeated"""
+    import asyncio
+    from assembly_service import AssemblyService
+    from program_generator import generate_program
+
+    print("Assembly service, {} requests of {} programs, {} at once".format(request_count, distinct_programs,
+                                                                          concurrency))
+    sources = [generate_program(instruction_count) + "MOV R1, {}\n".format(i) for i in range(distinct_programs)]
+
+    async def run():
+        async with AssemblyService() as service:
+            pending = asyncio.Semaphore(concurrency)
+
+            async def request(source):
+                async with pending:
+                    await service.assemble(source)
+
+            start = time.perf_counter()
+            await asyncio.gather(*[request(sources[i * 7 % distinct_programs]) for i in range(request_count)])
+            elapsed = time.perf_counter() - start
+            metrics = service.metrics_dict()
+        print("{:.3f} s, {:.0f} requests/s, assembled {}, coalesced {}, cache hits {}, latency p50 {:.1f} ms, "
+              "p99 {:.1f} ms".format(elapsed, request_count / elapsed, metrics["assembled"], metrics["coalesced"],
+                                     metrics["cache_hits"], metrics["latency_ms"]["p50"],
+                                     metrics["latency_ms"]["p99"]))
+
+    asyncio.run(run())
+    print()
+
+
+def bench_include(macro_count=2_000, program_count=5):
+    """Times programs including a large macro library, parsed the first time, then taken from the include cache"""
+    import gc
+    import shutil
+    import tempfile
+    from include_cache import ModuleCache
+    from token_parser import token_parser
+
+    print("Include, {} programs including a library of {} macros".format(program_count, macro_count))
+    directory = tempfile.mkdtemp()
+    try:
+        body = "".join("ADD $0, $0, {}\nSUB $1, $1, [R2, {}]\n".format(k, k) for k in range(5))
+        library = "".join("#macro m{} 2\n{}#endm\n".format(i, body) for i in range(macro_count))
+        with open(os.path.join(directory, "library.fal"), "w") as f:
+            f.write(library)
+        programs = list()
+        for i in range(program_count):
+            filename = os.path.join(directory, "program{}.fal".format(i))
+            with open(filename, "w") as f:
+                f.write('#include "library.fal"\nMOV R1, {}\nm{} R1 R2\n'.format(i, i))
+            programs.append(filename)
+        copied = os.path.join(directory, "copied.fal")
+        with open(copied, "w") as f:
+            f.write(library + "MOV R1, 0\nm0 R1 R2\n")
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            start = time.perf_counter()
+            token_parser(tokenize_file(copied), copied)
+            print("library copied into the program: {:.3f} s".format(time.perf_counter() - start))
+            modules = ModuleCache(os.path.join(directory, "cache"))
+            for label, some_programs in [("first program, parsed and saved", programs[:1]),
+                                         ("next programs, from memory", programs[1:-1])]:
+                start = time.perf_counter()
+                for program in some_programs:
+                    token_parser(tokenize_file(program), program, modules=modules)
+                print("{}: {:.3f} s per program".format(label, (time.perf_counter() - start) / len(some_programs)))
+            # as a new process would, without the modules in memory
+            modules = ModuleCache(modules.directory)
+            gc.collect()
+            start = time.perf_counter()
+            token_parser(tokenize_file(programs[-1]), programs[-1], modules=modules)
+            print("new process, from disk: {:.3f} s".format(time.perf_counter() - start))
+    finally:
+        shutil.rmtree(directory)
+    print()
+
+
+STAGE_SCALES = (1_000, 10_000, 50_000)
+MIN_COMPARED_SECONDS = 0.001  # phases faster than this are too noisy to compare
+
+
+def bench_stages(scales=STAGE_SCALES, runs=3):
+    """
+    Times each phase of the assembler on generated programs of increasing size, the best of some runs.
+    Returns instruction count => phase name => seconds, for the baseline.
+    """
+    import assembler
+    import instrumentation
+    from program_generator import generate_program
+
+    print("Assembler stages, generated programs")
+    file_in = "abcdefgh_bench_stages.fal"
+    file_preprocessed = "abcdefgh_bench_stages_preprocessed.fal"
+    file_out = "abcdefgh_bench_stages_output.txt"
+    results = dict()
+    try:
+        for n in scales:
+            with open(file_in, "w") as f:
+                f.write(generate_program(n))
+            best = dict()
+            for _ in range(runs):
+                with instrumentation.hooked(instrumentation.Profiler()) as profiler:
+                    # the generated labels are not all used, keep the warnings out of the results
+                    with contextlib.redirect_stderr(io.StringIO()):
+                        with instrumentation.phase("assemble"):
+                            assembler.assemble(file_in, file_preprocessed, file_out)
+                for name, stats in profiler.phases.items():
+                    best[name] = min(best.get(name, stats.seconds), stats.seconds)
+            results[str(n)] = best
+    finally:
+        for filename in (file_in, file_preprocessed, file_out):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    phases = list(results[str(scales[0])])
+    print("phase".ljust(24), *[str(n).rjust(10) for n in scales], "us per instruction".rjust(20))
+    for name in phases:
+        timings = [results[str(n)].get(name, 0.0) for n in scales]
+        print(name.ljust(24), *["{:.4f}".format(t).rjust(10) for t in timings],
+              "{:.2f}".format(timings[-1] / scales[-1] * 1e6).rjust(20))
+    print()
+    return results
+
+
+def compare_stages(baseline, results, threshold):
+    """Prints the phases slower than the baseline by more than threshold, returns their number"""
+    regressions = 0
+    print("Compared to the baseline ({}), threshold {:.0%}".format(baseline.get("python", "?"), threshold))
+    for n, phases in results.items():
+        if n not in baseline["stages"]:
+            print("{} instructions: not in the baseline".format(n))
+            continue
+        for name, seconds in phases.items():
+            base = baseline["stages"][n].get(name)
+            if base is None or max(base, seconds) < MIN_COMPARED_SECONDS:
+                continue
+            change = seconds / base - 1 if base > 0 else float("inf")
+            if change > threshold:
+                regressions += 1
+                print("REGRESSION {} instructions, {}: {:.4f} s, was {:.4f} s ({:+.0%})"
+                      .format(n, name, seconds, base, change))
+    if regressions == 0:
+        print("no regressions")
+    print()
+    return regressions
+
+
+def main():
+    benchmarks = {
+        "macros": bench_macro_expansion,
+        "rom": bench_rom_generation,
+        "export": bench_export,
+        "labels": bench_numeric_labels,
+        "tokenizer": bench_tokenizer,
+        "emulator": bench_emulator,
+        "translator": bench_translator,
+        "rom_matrix": bench_rom_matrix,
+        "disassembler": bench_disassembler,
+        "encoding": bench_encoding,
+        "compact": bench_compact_export,
+        "banks": bench_rom_banks,
+        "peephole": bench_peephole,
+        "cost": bench_cost_analyzer,
+        "simulator": bench_circuit_simulator,
+        "threads": bench_threads,
+        "service": bench_service,
+        "include": bench_include,
+        "stages": bench_stages,
+    }
+    parser = argparse.ArgumentParser(description="Benchmarks for the different stages of the assembler")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, default all: " + ", ".join(benchmarks))
+    parser.add_argument("--save", metavar="FILE", help="write the stages timings as a JSON baseline to FILE")
+    parser.add_argument("--compare", metavar="FILE", help="compare the stages timings against the baseline in FILE")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="with --compare, a phase slower by more than this fraction is a regression, "
+                             "default 0.2")
+    args = parser.parse_args()
+
+    selected = args.names or list(benchmarks)
+    if (args.save or args.compare) and "stages" not in selected:
+        selected.append("stages")
+    stages = None
+    for name in selected:
+        if name not in benchmarks:
+            print("Unknown benchmark {}, choose from: {}".format(name, ", ".join(benchmarks)), file=sys.stderr)
+            continue
+        result = benchmarks[name]()
+        if name == "stages":
+            stages = result
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "stages": stages}, f,
+                      indent=2)
+        print("Baseline saved as " + args.save)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_stages(baseline, stages, args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
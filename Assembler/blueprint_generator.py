@@ -4,10 +4,18 @@
 # see https://wiki.factorio.com/Blueprint_string_format for JSON structure
 
 import json
+import os
+import threading
 import constants
+import instrumentation
 
 map_version = 64427130880  # copied from random blueprint, probably insignificant
 
+ROM_ROW_ENTITY_NAMES = ("arithmetic-combinator", "small-lamp", "constant-combinator", "decider-combinator")
+
+_rom_row_templates = dict()  # absolute template path => RomRowTemplate
+_rom_row_templates_lock = threading.Lock()
+
 
 class Blueprint:
     """Contains the json dict, and a list of constant combinator entities which can have values"""
@@ -26,9 +34,9 @@ class Blueprint:
 
         # constant combinators, will later be populated with signals
         self.constant_combinators = list()
+        self.rom_lines = 0
 
         # setup metadata
-        global map_version
         self.bp_dict["label"] = "Program - PROM"
         self.bp_dict["item"] = "blueprint"
         self.bp_dict["version"] = map_version
@@ -56,22 +64,22 @@ class Blueprint:
         self.entities.append(self.prev_PC_entity)
         self.entities.append(self.prev_OUT_entity)
 
+    @instrumentation.phase_function("generate_rom_entities")
     def generate_rom_entities(self, number_of_lines):
         if number_of_lines < 0:
             raise ValueError("Number of lines must be non-negative, was {}".format(number_of_lines))
         if number_of_lines == 0:
             return
-        with open(constants.PROM_SINGLE_LINE_TEMPLATE) as f:
-            single_line_json = f.read()
+        template = get_rom_row_template(constants.PROM_SINGLE_LINE_TEMPLATE)
 
         i = 0
         while i < number_of_lines:
-            # code here
-            std_entities = json.loads(single_line_json)["entities"]
+            std_entities = template.new_row()
             arith, lamp, const_comb, decider = std_entities
+            row = self.rom_lines
             for e in std_entities:
                 e["entity_number"] = next(self.e_num)
-                e["position"]["y"] = i
+                e["position"]["y"] = row
             self.constant_combinators.append(const_comb)
 
             # manage connections
@@ -90,30 +98,105 @@ class Blueprint:
             entities_connect(lamp, decider, "green", "1", "1")
 
             # ROM out circuit
-            prev_side = "1" if i == 0 else "2"
+            prev_side = "1" if row == 0 else "2"
             entities_connect(decider, self.prev_OUT_entity, "green", "2", prev_side)
             self.prev_OUT_entity = decider
 
             self.entities += std_entities
+            self.rom_lines += 1
             i += 1
 
+    def continue_rom(self, rom_lines, last_row, next_entity_number):
+        """
+        Makes generate_rom_entities append rows to an existing ROM of rom_lines rows, instead of starting a new one.
+        last_row is the arithmetic combinator, lamp and decider combinator of its last row,
+        these are wired to the first new row. Only the new entities end up in this blueprint.
+        """
+        self.entities.clear()
+        self.e_num = counter(next_entity_number)
+        self.rom_lines = rom_lines
+        self.prev_index_entity, self.prev_PC_entity, self.prev_OUT_entity = last_row
+
+    @instrumentation.phase_function("insert_signals")
     def insert_signals(self, signals):
-        item_signals = ["copper-ore", "copper-plate", "iron-ore", "iron-plate"]
         for i, combinator in enumerate(self.constant_combinators):
-            if "control_behavior" not in combinator:
-                combinator["control_behavior"] = dict()
-            # clear any previous signal(s)
-            combinator["control_behavior"]["filters"] = list()
-            c_signals = combinator["control_behavior"]["filters"]
-            sig_count = counter(1)
-            for signal in signals[i]:
-                sig_type = {
-                                "type": "item" if signal in item_signals else "virtual",
-                                "name": signal
-                            }
-                new_signal = {"signal": sig_type, "count": signals[i][signal], "index": next(sig_count)}
-                c_signals.append(new_signal)
-            # print(json.dumps(combinator))
+            set_combinator_signals(combinator, signals[i])
+
+
+class RomRowTemplate:
+    """A single PROM row, read and validated once. Rows are stamped out by new_row, a copier made by json_copier."""
+
+    def __init__(self, filename):
+        with open(filename) as f:
+            template = json.load(f)
+        if not isinstance(template, dict) or not isinstance(template.get("entities"), list):
+            raise ValueError("PROM template {} must contain a list of entities".format(filename))
+        entities = template["entities"]
+        names = tuple(e.get("name") if isinstance(e, dict) else None for e in entities)
+        if names != ROM_ROW_ENTITY_NAMES:
+            raise ValueError("PROM template {} must contain the entities {}, was {}"
+                             .format(filename, ", ".join(ROM_ROW_ENTITY_NAMES), ", ".join(map(str, names))))
+        for e in entities:
+            if not isinstance(e.get("position"), dict):
+                raise ValueError("PROM template entity {} has no position".format(e["name"]))
+        self.filename = filename
+        self.entities = entities
+        self.new_row = json_copier(entities)
+
+
+def get_rom_row_template(filename):
+    """Returns the row template for the given file, the file is only parsed on the first call"""
+    path = os.path.abspath(filename)
+    template = _rom_row_templates.get(path)
+    if template is None:
+        with _rom_row_templates_lock:
+            # another thread may have parsed it while this one waited
+            template = _rom_row_templates.get(path)
+            if template is None:
+                template = _rom_row_templates[path] = RomRowTemplate(path)
+    return template
+
+
+def json_copier(obj):
+    """
+    A function returning a fresh copy of a JSON dict or list, without parsing or walking it again:
+    each dict is copied shallowly, in the same key order, then its nested values are replaced by their own copies
+    """
+    if isinstance(obj, dict):
+        nested = [(k, json_copier(v)) for k, v in obj.items() if isinstance(v, (dict, list))]
+        if len(nested) == 0:
+            return obj.copy
+
+        def copy_dict():
+            result = obj.copy()
+            for k, copy in nested:
+                result[k] = copy()
+            return result
+        return copy_dict
+    if isinstance(obj, list):
+        if not any(isinstance(v, (dict, list)) for v in obj):
+            return obj.copy
+        copiers = [json_copier(v) for v in obj]
+        return lambda: [copy() for copy in copiers]
+    raise TypeError("Not a JSON dict or list: {!r}".format(obj))
+
+
+def set_combinator_signals(combinator, signals):
+    """Replaces the signals of a constant combinator entity"""
+    item_signals = ["copper-ore", "copper-plate", "iron-ore", "iron-plate"]
+    if "control_behavior" not in combinator:
+        combinator["control_behavior"] = dict()
+    # clear any previous signal(s)
+    combinator["control_behavior"]["filters"] = list()
+    c_signals = combinator["control_behavior"]["filters"]
+    sig_count = counter(1)
+    for signal in signals:
+        sig_type = {
+                        "type": "item" if signal in item_signals else "virtual",
+                        "name": signal
+                    }
+        new_signal = {"signal": sig_type, "count": signals[signal], "index": next(sig_count)}
+        c_signals.append(new_signal)
 
 
 def counter(start_index):
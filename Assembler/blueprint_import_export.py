@@ -3,13 +3,27 @@
 
 import sys
 import base64
+import json
 import zlib
 
+import instrumentation
+
 SUPP_BP_VERSION = "0"
+STREAM_CHUNK_SIZE = 1 << 16  # bytes of JSON to gather before feeding the compressor
+
+# fields Factorio fills in with these values when they are missing, CompactExport leaves them out
+DEFAULT_FIELDS = {"circuit_id": 1, "direction": 0, "copy_count_from_input": True}
+# fields CompactExport leaves out once they are empty
+OMITTED_WHEN_EMPTY = ("filters", "control_behavior")
+# zlib settings tried by CompactExport, (level, strategy)
+COMPRESSION_SETTINGS = ([(level, zlib.Z_DEFAULT_STRATEGY) for level in range(1, 10)] +
+                        [(level, zlib.Z_FILTERED) for level in range(4, 10)] +
+                        [(9, zlib.Z_RLE), (9, zlib.Z_FIXED), (9, zlib.Z_HUFFMAN_ONLY)])
+SEARCH_SAMPLE_SIZE = 1 << 18  # bytes of larger JSON the settings are first ranked on
+SEARCH_FINALISTS = 3  # settings of the best ranked the whole JSON is then compressed with
 
 
 def bp_decode_base64(blueprint: str) -> bytes:
-    global SUPP_BP_VERSION
     blueprint_version = blueprint[0]
     if blueprint_version is not SUPP_BP_VERSION:
         warning_msg = "Warning: Expected Factorio blueprint version {}, was version {}\n"
@@ -20,7 +34,6 @@ def bp_decode_base64(blueprint: str) -> bytes:
 
 
 def bp_encode_base64(bp_compressed: bytes) -> str:
-    global SUPP_BP_VERSION
     return SUPP_BP_VERSION + base64.b64encode(bp_compressed).decode("utf-8")
 
 
@@ -30,3 +43,201 @@ def bp_decompress(bp_compressed: bytes) -> str:
 
 def bp_compress(bp_json: str) -> bytes:
     return zlib.compress(bp_json.encode("utf-8"))
+
+
+def bp_write_stream(bp_json_dict: dict, out, encode=json.dumps) -> None:
+    """
+    Writes the blueprint string of the JSON dict to the text stream out (a file, sys.stdout etc).
+    Same result as bp_encode_base64(bp_compress(json.dumps(bp_json_dict))), but the JSON is
+    compressed and base64 encoded chunk by chunk, so the full string is never held in memory.
+    encode is used for the values below the streamed depth, see bp_json_chunks.
+    """
+    compressor = zlib.compressobj()
+    compress = instrumentation.timed_function("compress", compressor.compress)
+    b64encode = instrumentation.timed_function("base64", base64.b64encode)
+    encode = instrumentation.timed_function("json_dumps", encode)
+    pending = b""  # compressed bytes not yet base64 encoded, base64 works on groups of 3 bytes
+    out.write(SUPP_BP_VERSION)
+
+    def write_compressed(data):
+        nonlocal pending
+        pending += data
+        cut = len(pending) - len(pending) % 3
+        if cut > 0:
+            out.write(b64encode(pending[:cut]).decode("utf-8"))
+            pending = pending[cut:]
+
+    batch = list()
+    batch_size = 0
+    for chunk in bp_json_chunks(bp_json_dict, encode=encode):
+        batch.append(chunk)
+        batch_size += len(chunk)
+        if batch_size >= STREAM_CHUNK_SIZE:
+            write_compressed(compress("".join(batch).encode("utf-8")))
+            batch = list()
+            batch_size = 0
+    write_compressed(compress("".join(batch).encode("utf-8")))
+    write_compressed(compressor.flush())
+    out.write(b64encode(pending).decode("utf-8"))
+
+
+class SegmentedExport:
+    """
+    Writes blueprint strings like bp_write_stream, for the same blueprint over and over (see watch.py).
+    The JSON is compressed in segments of SEGMENT_ENTITIES entities, each by a new compressor ending in a sync flush,
+    so the compressed segments can be joined into one zlib stream. The segments are kept, and writing the
+    blueprint again only compresses the segments whose JSON changed.
+    """
+
+    SEGMENT_ENTITIES = 1024  # 256 PROM rows
+
+    def __init__(self):
+        self.segments = list()  # (JSON bytes, segment for bp_join_segments) of each segment
+
+    def write(self, bp_json_dict, out, encode=json.dumps) -> None:
+        entities = bp_json_dict["blueprint"]["entities"]
+        # the JSON around the entities, split where the entities go
+        outer = dict(bp_json_dict)
+        outer["blueprint"] = dict(outer["blueprint"], entities=[])
+        head, tail = json.dumps(outer).split('"entities": []')
+        texts = [head + '"entities": [']
+        for start in range(0, len(entities), self.SEGMENT_ENTITIES):
+            texts.append((", " if start > 0 else "") +
+                         ", ".join(encode(e) for e in entities[start:start + self.SEGMENT_ENTITIES]))
+        texts.append("]" + tail)
+
+        segments = list()
+        for n, text in enumerate(texts):
+            data = text.encode("utf-8")
+            if n < len(self.segments) and self.segments[n][0] == data:
+                segment = self.segments[n]
+            else:
+                with instrumentation.phase("compress"):
+                    segment = (data, (deflate_segment(data), zlib.adler32(data), len(data)))
+            segments.append(segment)
+        self.segments = segments
+        out.write(SUPP_BP_VERSION)
+        out.write(base64.b64encode(bp_join_segments(segment[1] for segment in segments)).decode("utf-8"))
+
+
+def deflate_segment(data: bytes) -> bytes:
+    """Raw deflate of data ending in a sync flush, so segments compressed apart can be joined, see bp_join_segments"""
+    compressor = zlib.compressobj(wbits=-15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    """The adler32 of two pieces of data joined, from the adler32 of each and the length of the second"""
+    base = 65521
+    sum1 = adler1 & 0xffff
+    sum2 = (length2 % base) * sum1 + (adler1 >> 16) + (adler2 >> 16) - length2
+    sum1 += (adler2 & 0xffff) - 1
+    return (sum1 % base) | ((sum2 % base) << 16)
+
+
+def bp_join_segments(segments) -> bytes:
+    """
+    The zlib stream of the joined data of (deflate_segment(data), zlib.adler32(data), len(data)) segments,
+    which may have been compressed in other processes
+    """
+    compressed = [b"\x78\x9c"]  # zlib header, deflate with the default window
+    checksum = zlib.adler32(b"")
+    for deflated, adler, length in segments:
+        compressed.append(deflated)
+        checksum = adler32_combine(checksum, adler, length)
+    compressed.append(zlib.compressobj(wbits=-15).flush())  # the final, empty block
+    compressed.append(checksum.to_bytes(4, "big"))
+    return b"".join(compressed)
+
+
+class CompactExport:
+    """
+    Writes the smallest blueprint strings it can, for sharing, at the cost of a slower export.
+    The JSON leaves out what makes no difference in game (see bp_compact), has no spaces,
+    and is compressed with each of COMPRESSION_SETTINGS, keeping the smallest result.
+    Used in place of a SegmentedExport, see AssemblyCache.write_blueprint.
+    """
+
+    def __init__(self, settings=COMPRESSION_SETTINGS):
+        self.settings = settings
+        self.chosen_setting = None  # (level, strategy) of the last blueprint written
+
+    def write(self, bp_json_dict, out, encode=json.dumps) -> None:
+        with instrumentation.phase("json_dumps"):
+            # the entities may come already encoded (see AssemblyCache), bp_compact works on the decoded JSON
+            compact = bp_compact_json("".join(bp_json_chunks(bp_json_dict, encode=encode)))
+            data = json.dumps(compact, separators=(",", ":")).encode("utf-8")
+        with instrumentation.phase("compress"):
+            compressed, self.chosen_setting = bp_compress_smallest(data, self.settings)
+        out.write(bp_encode_base64(compressed))
+
+
+def bp_compact(bp_json_dict):
+    """
+    A copy of the blueprint JSON without constant combinator filters of count 0, fields with the value
+    Factorio gives them when missing (DEFAULT_FIELDS), and the fields of OMITTED_WHEN_EMPTY left empty by that.
+    """
+    return bp_compact_json(json.dumps(bp_json_dict))
+
+
+def bp_compact_json(bp_json: str):
+    """bp_compact of the decoded JSON string, each dict is compacted as the decoder makes it, inner dicts first"""
+    return json.loads(bp_json, object_hook=_compact_dict)
+
+
+def _compact_dict(obj):
+    result = dict()
+    for key, value in obj.items():
+        if key in DEFAULT_FIELDS:
+            default = DEFAULT_FIELDS[key]
+            # type() as well, True == 1 in Python
+            if type(value) is type(default) and value == default:
+                continue
+        elif key == "filters" and isinstance(value, list):
+            value = [f for f in value if not (isinstance(f, dict) and f.get("count") == 0)]
+        if key in OMITTED_WHEN_EMPTY and len(value) == 0:
+            continue
+        result[key] = value
+    return result
+
+
+def bp_compress_smallest(data: bytes, settings=COMPRESSION_SETTINGS):
+    """
+    Compresses data with each (level, strategy), returns the smallest result and its setting.
+    Data larger than SEARCH_SAMPLE_SIZE is only compressed whole with the SEARCH_FINALISTS settings
+    doing best on its first SEARCH_SAMPLE_SIZE bytes.
+    """
+    def compress(chunk, setting):
+        level, strategy = setting
+        compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 9, strategy)
+        return compressor.compress(chunk) + compressor.flush()
+
+    if len(data) > SEARCH_SAMPLE_SIZE:
+        sample = data[:SEARCH_SAMPLE_SIZE]
+        settings = sorted(settings, key=lambda setting: len(compress(sample, setting)))[:SEARCH_FINALISTS]
+    return min(((compress(data, setting), setting) for setting in settings), key=lambda result: len(result[0]))
+
+
+def bp_json_chunks(obj, stream_depth=3, encode=json.dumps):
+    """
+    Yields the JSON encoding of obj in chunks, which joined are equal to json.dumps(obj).
+    Dicts and lists are split into their items down to stream_depth, deeper values are encoded whole
+    by encode (at the default depth, each entity of a blueprint).
+    """
+    if stream_depth <= 0:
+        yield encode(obj)
+    elif isinstance(obj, dict) and all(isinstance(key, str) for key in obj):
+        yield "{"
+        for i, key in enumerate(obj):
+            yield (", " if i > 0 else "") + json.dumps(key) + ": "
+            yield from bp_json_chunks(obj[key], stream_depth - 1, encode)
+        yield "}"
+    elif isinstance(obj, list):
+        yield "["
+        for i, value in enumerate(obj):
+            if i > 0:
+                yield ", "
+            yield from bp_json_chunks(value, stream_depth - 1, encode)
+        yield "]"
+    else:
+        yield json.dumps(obj)
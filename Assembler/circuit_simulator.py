@@ -0,0 +1,455 @@
+# Simulates the circuit networks of a blueprint tick by tick, without Factorio
+# usage: python circuit_simulator.py [blueprint file] [--ticks TICKS]
+# The red and green networks are built from the wires in the "connections" of the entities (see entities_connect).
+# Like in Factorio, a combinator reads the networks on its input side and its result is on the networks of its
+# output side one tick later. Only the combinators whose input networks changed are evaluated again.
+
+import argparse
+import sys
+import time
+
+import constants
+from disassembler import combinator_signals, load_blueprint
+from emulator import _div, _mod, _pow, to_int32
+from exceptions import SimulatorError
+
+COLORS = ("red", "green")
+INPUT = 1  # circuit id of the input side of a combinator, and the only side of other entities
+OUTPUT = 2
+CONSTANT_ENTITIES = ("constant-combinator", "pushbutton")
+FULL_COMPUTER_START = 1496  # constant combinator of Blueprints/full_computer.txt starting the computer once on
+
+ARITHMETIC_OPERATIONS = {
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": _div,
+    "%": _mod,
+    "^": _pow,
+    "<<": lambda a, b: a << (b & 31),
+    ">>": lambda a, b: a >> (b & 31),
+    "AND": lambda a, b: a & b,
+    "OR": lambda a, b: a | b,
+    "XOR": lambda a, b: a ^ b,
+}
+
+COMPARATORS = {
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "=": lambda a, b: a == b,
+    "≥": lambda a, b: a >= b,
+    ">=": lambda a, b: a >= b,
+    "≤": lambda a, b: a <= b,
+    "<=": lambda a, b: a <= b,
+    "≠": lambda a, b: a != b,
+    "!=": lambda a, b: a != b,
+}
+
+EACH = "signal-each"
+EVERYTHING = "signal-everything"
+ANYTHING = "signal-anything"
+
+
+class Network:
+    """The signals on a wire network, summed over everything outputting to it, and the combinators reading it"""
+    __slots__ = ("signals", "readers")
+
+    def __init__(self):
+        self.signals = dict()  # name => sum, wrapped to 32 bit
+        self.readers = list()
+
+    def add(self, old, new):
+        """Replaces the output old of an entity on this network with new"""
+        signals = self.signals
+        for name, value in old.items():
+            total = to_int32(signals.get(name, 0) - value)
+            if total == 0:
+                del signals[name]
+            else:
+                signals[name] = total
+        for name, value in new.items():
+            total = to_int32(signals.get(name, 0) + value)
+            if total == 0:
+                del signals[name]
+            else:
+                signals[name] = total
+
+
+class Combinator:
+    """An entity with outputs, a combinator, or a constant combinator whose output is only changed from outside"""
+    __slots__ = ("entity", "inputs", "input_key", "outputs", "output", "evaluate")
+
+    def __init__(self, entity, inputs, outputs, evaluate):
+        self.entity = entity
+        self.inputs = inputs  # networks read, red and green
+        self.input_key = tuple(map(id, inputs))
+        self.outputs = outputs  # networks written
+        self.output = dict()
+        self.evaluate = evaluate  # input signals => output signals, None for constant combinators
+
+
+def read_networks(networks):
+    """The signals of the red and the green network added together, as a combinator sees them"""
+    red, green = networks[0].signals, networks[1].signals
+    if len(green) == 0:
+        return red
+    if len(red) == 0:
+        return green
+    total = dict(red)
+    for name, value in green.items():
+        value = to_int32(total.get(name, 0) + value)
+        if value == 0:
+            del total[name]
+        else:
+            total[name] = value
+    return total
+
+
+def second_value(conditions):
+    """A function of the input signals giving the second operand, of the second signal or the constant"""
+    if "second_signal" in conditions:
+        name = conditions["second_signal"]["name"]
+        return lambda signals: signals.get(name, 0)
+    constant = conditions.get("constant", 0)
+    return lambda signals: constant
+
+
+def signal_name(conditions, key):
+    signal = conditions.get(key)
+    return None if signal is None else signal["name"]
+
+
+def arithmetic(conditions):
+    """The function of an arithmetic combinator, from its arithmetic_conditions"""
+    first = signal_name(conditions, "first_signal")
+    output = signal_name(conditions, "output_signal")
+    operation = ARITHMETIC_OPERATIONS.get(conditions.get("operation", "*"))
+    if operation is None:
+        raise SimulatorError("Unknown arithmetic operation {}".format(conditions["operation"]))
+    second = second_value(conditions)
+
+    def evaluate(signals):
+        if first is None or output is None:
+            return dict()
+        b = second(signals)
+        if first == EACH:
+            results = {name: to_int32(operation(a, b)) for name, a in signals.items()}
+            if output == EACH:
+                return {name: value for name, value in results.items() if value != 0}
+            total = to_int32(sum(results.values()))
+            return {output: total} if total != 0 else dict()
+        result = to_int32(operation(signals.get(first, 0), b))
+        return {output: result} if result != 0 else dict()
+    return evaluate
+
+
+def condition(conditions):
+    """
+    A function of the input signals, whether the condition (of a decider or lamp) holds for them,
+    with the virtual signals of Factorio
+    """
+    first = signal_name(conditions, "first_signal")
+    compare = COMPARATORS.get(conditions.get("comparator", "<"))
+    if compare is None:
+        raise SimulatorError("Unknown comparator {}".format(conditions["comparator"]))
+    second = second_value(conditions)
+    if first is None:
+        return lambda signals: False
+    if first == EVERYTHING:
+        return lambda signals: all(compare(a, second(signals)) for a in signals.values())
+    if first == ANYTHING:
+        return lambda signals: any(compare(a, second(signals)) for a in signals.values())
+    return lambda signals: compare(signals.get(first, 0), second(signals))
+
+
+def decider(conditions):
+    """The function of a decider combinator, from its decider_conditions"""
+    first = signal_name(conditions, "first_signal")
+    output = signal_name(conditions, "output_signal")
+    copy_count = conditions.get("copy_count_from_input", True)
+    compare = COMPARATORS.get(conditions.get("comparator", "<"))
+    holds = condition(conditions)
+    second = second_value(conditions)
+
+    def evaluate(signals):
+        if output is None:
+            return dict()
+        if first == EACH:
+            b = second(signals)
+            passing = {name: a for name, a in signals.items() if compare(a, b)}
+            if output == EACH:
+                return passing if copy_count else {name: 1 for name in passing}
+            if len(passing) == 0:
+                return dict()
+            total = to_int32(sum(passing.values())) if copy_count else len(passing)
+            return {output: total} if total != 0 else dict()
+        if not holds(signals):
+            return dict()
+        if output in (EVERYTHING, ANYTHING):
+            if output == ANYTHING:
+                signals = dict(list(signals.items())[:1])
+            return dict(signals) if copy_count else {name: 1 for name in signals}
+        value = signals.get(output, 0) if copy_count else 1
+        return {output: value} if value != 0 else dict()
+    return evaluate
+
+
+class CircuitSimulator:
+    """
+    The circuit networks of a blueprint and its combinators. Each tick() evaluates the combinators whose inputs
+    changed in the tick before, run() and run_until_stable() do many ticks. The signals of constant combinators
+    can be changed, and signals from outside put on any network, between ticks.
+    """
+
+    def __init__(self, json_dict):
+        if "blueprint" not in json_dict:
+            raise SimulatorError("Not a blueprint, found {}".format(", ".join(json_dict)))
+        self.entities = {e["entity_number"]: e for e in json_dict["blueprint"].get("entities", list())}
+        self.networks = dict()  # (entity number, circuit id, color) => Network
+        self.build_networks()
+        self.combinators = dict()  # entity number => Combinator
+        self.pending = set()  # combinators to evaluate in the next tick
+        self.external = dict()  # (entity number, circuit id, color) => signals put on the network from outside
+        self.tick_count = 0
+
+        for n, e in self.entities.items():
+            behavior = e.get("control_behavior", dict())
+            if e["name"] in ("arithmetic-combinator", "decider-combinator"):
+                evaluate = arithmetic(behavior.get("arithmetic_conditions", dict())) \
+                    if e["name"] == "arithmetic-combinator" else decider(behavior.get("decider_conditions", dict()))
+                combinator = Combinator(e, self.side_networks(n, INPUT), self.side_networks(n, OUTPUT), evaluate)
+                for network in combinator.inputs:
+                    network.readers.append(combinator)
+                self.pending.add(combinator)
+            elif e["name"] in CONSTANT_ENTITIES:
+                combinator = Combinator(e, [], self.side_networks(n, INPUT), None)
+                if behavior.get("is_on", True):
+                    self.set_output(combinator, {name: v for name, v in combinator_signals(e).items() if v != 0})
+            else:
+                continue
+            self.combinators[n] = combinator
+
+    @classmethod
+    def from_string(cls, blueprint_string):
+        return cls(load_blueprint(blueprint_string))
+
+    def build_networks(self):
+        """Joins the connection points of the entities wired together into networks"""
+        parent = dict()
+
+        def find(node):
+            root = node
+            while parent.setdefault(root, root) != root:
+                root = parent[root]
+            while node != root:
+                parent[node], node = root, parent[node]
+            return root
+
+        for n, e in self.entities.items():
+            for side, colors in e.get("connections", dict()).items():
+                if not side.isdecimal():
+                    continue  # copper wires of power switches
+                for color in COLORS:
+                    for wire in colors.get(color, list()):
+                        a = find((n, int(side), color))
+                        b = find((wire["entity_id"], wire.get("circuit_id", 1), color))
+                        parent[a] = b
+        by_root = dict()
+        for node in parent:
+            self.networks[node] = by_root.setdefault(find(node), Network())
+
+    def network(self, entity_number, color, circuit_id=INPUT):
+        """The network of a wire color on one side of an entity, a network of its own if nothing is wired to it"""
+        key = (entity_number, circuit_id, color)
+        if key not in self.networks:
+            self.networks[key] = Network()
+        return self.networks[key]
+
+    def side_networks(self, entity_number, circuit_id):
+        return [self.network(entity_number, color, circuit_id) for color in COLORS]
+
+    def signals(self, entity_number, circuit_id=INPUT, color=None):
+        """The signals on a side of an entity, both colors added together like a combinator reads them"""
+        if color is not None:
+            return dict(self.network(entity_number, color, circuit_id).signals)
+        return dict(read_networks(self.side_networks(entity_number, circuit_id)))
+
+    def lamp_on(self, entity_number):
+        """Whether a lamp is lit, by its circuit condition"""
+        e = self.entities[entity_number]
+        conditions = e.get("control_behavior", dict()).get("circuit_condition")
+        if conditions is None:
+            return True
+        return condition(conditions)(self.signals(entity_number))
+
+    def set_output(self, combinator, output):
+        """Changes what a combinator outputs, the combinators reading it are evaluated in the next tick"""
+        for network in combinator.outputs:
+            network.add(combinator.output, output)
+            self.pending.update(network.readers)
+        combinator.output = output
+
+    def set_signals(self, entity_number, signals):
+        """Changes the signals of a constant combinator"""
+        combinator = self.combinators.get(entity_number)
+        if combinator is None or combinator.evaluate is not None:
+            raise SimulatorError("Entity {} is not a constant combinator".format(entity_number))
+        self.set_output(combinator, {name: value for name, value in signals.items() if value != 0})
+
+    def set_enabled(self, entity_number, on):
+        """Turns a constant combinator (or pushbutton) on or off, like the switch in its window"""
+        combinator = self.combinators.get(entity_number)
+        if combinator is None or combinator.evaluate is not None:
+            raise SimulatorError("Entity {} is not a constant combinator".format(entity_number))
+        signals = combinator_signals(combinator.entity) if on else dict()
+        self.set_output(combinator, {name: value for name, value in signals.items() if value != 0})
+
+    def put_signals(self, entity_number, signals, color, circuit_id=INPUT):
+        """Puts signals on the network of a wire color on a side of an entity, in place of the ones put there before"""
+        key = (entity_number, circuit_id, color)
+        network = self.network(entity_number, color, circuit_id)
+        signals = {name: value for name, value in signals.items() if value != 0}
+        network.add(self.external.get(key, dict()), signals)
+        self.external[key] = signals
+        self.pending.update(network.readers)
+
+    def tick(self):
+        """Evaluates the combinators whose inputs changed, their new outputs are on the networks after the tick"""
+        pending, self.pending = self.pending, set()
+        changes = list()
+        inputs = dict()  # (red, green) network ids => signals, combinators often share their inputs
+        for combinator in pending:
+            key = combinator.input_key
+            signals = inputs.get(key)
+            if signals is None:
+                signals = inputs[key] = read_networks(combinator.inputs)
+            output = combinator.evaluate(signals)
+            if output != combinator.output:
+                changes.append((combinator, output))
+        for combinator, output in changes:
+            self.set_output(combinator, output)
+        self.tick_count += 1
+        return len(changes)
+
+    def run(self, ticks):
+        for _ in range(ticks):
+            self.tick()
+
+    def run_until_stable(self, max_ticks=100_000):
+        """Ticks until no output changes, returns the number of ticks"""
+        for ticks in range(max_ticks):
+            if len(self.pending) == 0:
+                return ticks
+            self.tick()
+        raise SimulatorError("Not stable after {} ticks".format(max_ticks))
+
+    @property
+    def stable(self):
+        return len(self.pending) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates the circuit networks of a blueprint")
+    parser.add_argument("file_in", nargs="?", default=constants.DEFAULT_OUTPUT_FILE)
+    parser.add_argument("--ticks", type=int, default=1000, help="number of ticks to run at most, default 1000")
+    parser.add_argument("--on", type=int, action="append", default=[], metavar="ENTITY",
+                        help="turn on a constant combinator once the blueprint is stable, like START of the computer")
+    parser.add_argument("--show", type=int, action="append", default=[], metavar="ENTITY",
+                        help="print the signals read by an entity at the end")
+    args = parser.parse_args()
+
+    with open(args.file_in) as f:
+        simulator = CircuitSimulator.from_string(f.read())
+    print("{} entities, {} combinators, {} networks".format(
+        len(simulator.entities), len(simulator.combinators), len(set(map(id, simulator.networks.values())))))
+    evaluations = 0
+    start = time.perf_counter()
+    for tick in range(args.ticks):
+        if simulator.stable:
+            if len(args.on) == 0:
+                break
+            print("Stable after {} ticks, turning on {}".format(simulator.tick_count, ", ".join(map(str, args.on))))
+            for entity_number in args.on:
+                simulator.set_enabled(entity_number, True)
+            args.on = []
+        evaluations += len(simulator.pending)
+        simulator.tick()
+    elapsed = time.perf_counter() - start
+    print("{} ticks in {:.2f} s, {} combinator evaluations, {}".format(
+        simulator.tick_count, elapsed, evaluations, "stable" if simulator.stable else "still changing"))
+    for entity_number in args.show:
+        print("{}: {}".format(entity_number, simulator.signals(entity_number)))
+
+
+def _test():
+    import contextlib
+    import io
+    from blueprint_generator import Blueprint
+    from blueprint_import_export import bp_write_stream
+    from emulator import load_program
+
+    print("Running test on circuit simulator...")
+    test_error_count = 0
+
+    def check(what, result, expected):
+        nonlocal test_error_count
+        if result != expected:
+            print("{}: {}, expected {}".format(what, result, expected), file=sys.stderr)
+            test_error_count += 1
+
+    def signal(name):
+        return {"type": "virtual", "name": name}
+
+    # combinators on their own
+    check("each * 2", arithmetic({"first_signal": signal(EACH), "constant": 2, "operation": "*",
+                                  "output_signal": signal(EACH)})({"A": 3, "B": -4}), {"A": 6, "B": -8})
+    check("each + 1 to A", arithmetic({"first_signal": signal(EACH), "constant": 1, "operation": "+",
+                                       "output_signal": signal("A")})({"A": 3, "B": 5}), {"A": 10})
+    check("overflow", arithmetic({"first_signal": signal("A"), "constant": 2, "operation": "*",
+                                  "output_signal": signal("A")})({"A": 2**31 - 1}), {"A": -2})
+    check("division by zero", arithmetic({"first_signal": signal("A"), "second_signal": signal("B"),
+                                          "operation": "/", "output_signal": signal("A")})({"A": 5}), {})
+    check("everything = 1", decider({"first_signal": signal(EVERYTHING), "constant": 1, "comparator": "=",
+                                     "output_signal": signal("C"), "copy_count_from_input": False})({}), {"C": 1})
+    check("anything > 1", decider({"first_signal": signal(ANYTHING), "constant": 1, "comparator": ">",
+                                   "output_signal": signal(EVERYTHING)})({"A": 1, "B": 2}), {"A": 1, "B": 2})
+    check("each ≠ 0", decider({"first_signal": signal(EACH), "constant": 3, "comparator": "≠",
+                               "output_signal": signal(EACH), "copy_count_from_input": False})({"A": 3, "B": 2}),
+          {"B": 1})
+
+    # a PROM, its row index counts up one row per tick, then each PC reads its row one tick later
+    with contextlib.redirect_stderr(io.StringIO()):
+        rom_signals = load_program("examples/demo_quicksort.fal")
+    bp = Blueprint()
+    bp.generate_rom_entities(len(rom_signals))
+    bp.insert_signals(rom_signals)
+    pc_lamp, output_lamp = [e["entity_number"] for e in bp.entities if e["name"] == "small-lamp"][:2]
+    out = io.StringIO()
+    bp_write_stream(bp.json_dict, out)
+    simulator = CircuitSimulator.from_string(out.getvalue())
+    check("ticks for the row index", simulator.run_until_stable(), len(rom_signals))
+    for pc, signals in enumerate(rom_signals):
+        simulator.put_signals(pc_lamp, {"iron-plate": pc}, "green")
+        simulator.tick()
+        expected = {name: value for name, value in signals.items() if value != 0}
+        # the decider of the row passes its index and the PC as well
+        expected.update({"iron-ore": pc, "iron-plate": pc} if pc > 0 else {})
+        check("row {}".format(pc), simulator.signals(output_lamp, color="green"), expected)
+        check("stable after row {}".format(pc), simulator.stable, True)
+
+    # the whole computer, started
+    with open("../Blueprints/full_computer.txt") as f:
+        simulator = CircuitSimulator.from_string(f.read())
+    simulator.run_until_stable()
+    simulator.set_enabled(FULL_COMPUTER_START, True)
+    simulator.run(200)
+    check("full computer running", simulator.stable, False)
+
+    if test_error_count == 0:
+        print("All tests succeeded")
+    else:
+        print("{} test{} failed".format(test_error_count, "" if test_error_count == 1 else "s"))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,5 +4,8 @@ DEFAULT_INPUT_FILE = "input.fal"
 DEFAULT_PREPROCESSED_FILE = "input_preprocessed.fal"
 DEFAULT_OUTPUT_FILE = "output.txt"
 PROM_SINGLE_LINE_TEMPLATE = "PROM_template_single_line.json"
+DEFAULT_CACHE_FILE = "assembler_cache.pickle"
+DEFAULT_INCLUDE_CACHE_DIR = "include_cache"  # parsed #include files, see include_cache
 APPEND_EXITCODE_SUCCESS = True  # Append HLTG to end of instruction stream?
 MAX_MACRO_DEPTH = 1_000_000
+TOKENIZER_BACKEND = "regex"  # "regex" or "chars", see tokenizer.TOKENIZER_BACKENDS
@@ -0,0 +1,348 @@
+# Static estimate of the cycles a program spends in each basic block and loop
+# usage: python cost_analyzer.py [file] [--json FILE] [--top N] [--blocks] [--budget CYCLES] [-O]
+# The control-flow graph is built from the branch targets resolved by token_parser, and each instruction costs
+# the cycles of its opcode in opcode_costs. A branch to a register (a return) has no known successors, the
+# addresses taken from labels (return addresses etc) are entries of the graph like the first instruction.
+
+import argparse
+import json
+import sys
+
+import constants
+from emulator import KIND_BRANCH, KIND_HALT_EXIT, KIND_HLT
+from exceptions import AssemblyError
+from opcode_costs import cycle_costs
+from opcode_map import opcodes
+from peephole import immediate, opcode, operands, optimize
+from token_parser import token_parser
+from tokenizer import tokenize_file
+
+ASSUMED_ITERATIONS = 10  # runs of a loop each time it is entered, to weigh nested loops by
+DEFAULT_TOP_LOOPS = 5
+
+
+def _kind(op):
+    return opcodes[op]()[0].get("copper-plate", KIND_HLT)
+
+
+_branches = {op for op in opcodes if _kind(op) == KIND_BRANCH}
+_halts = {op for op in opcodes if _kind(op) in (KIND_HLT, KIND_HALT_EXIT)}
+
+
+class BasicBlock:
+    """Instructions start to end (exclusive), run one after the other, with the blocks run after them"""
+
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.successors = list()  # block indexes
+        self.predecessors = list()
+        self.indirect = False  # ends with a branch to a register
+        self.cycles = 0
+        self.lines = (None, None)  # lowest and highest source line, macro bodies are lines of their own
+
+    def to_dict(self):
+        return {"start": self.start, "end": self.end, "lines": list(self.lines), "cycles": self.cycles,
+                "successors": self.successors, "indirect": self.indirect}
+
+
+class Loop:
+    """A natural loop, the blocks of the header and of the paths from the back edges to it"""
+
+    def __init__(self, header, blocks):
+        self.header = header  # block index
+        self.blocks = blocks  # set of block indexes
+        self.depth = 1  # 1 + the number of loops it is nested in
+        self.cycles = 0  # per iteration, each block of the loop run once
+        self.lines = (None, None)  # lowest and highest source line of the loop
+
+    @property
+    def weight(self):
+        """Cycles of an iteration, times ASSUMED_ITERATIONS for each loop it is nested in and itself"""
+        return self.cycles * ASSUMED_ITERATIONS ** self.depth
+
+    def to_dict(self, blocks):
+        return {"header": blocks[self.header].start, "lines": list(self.lines), "depth": self.depth,
+                "blocks": sorted(blocks[b].start for b in self.blocks), "cycles": self.cycles, "weight": self.weight}
+
+
+def line_number(inst):
+    return inst.opcode.file_line_num
+
+
+def branch_target(inst):
+    """The address of a branch to an immediate or label, None for a branch to a register"""
+    branch_operands = operands(inst)
+    if len(branch_operands) != 1:
+        return None
+    return immediate(branch_operands[0])
+
+
+def build_cfg(instructions, costs=None):
+    """The basic blocks of the program, in the order of their addresses, and the indexes of the entry blocks"""
+    if costs is None:
+        costs = cycle_costs
+    n = len(instructions)
+    leaders = {0} if n > 0 else set()
+    taken = set()  # addresses taken from labels, by other instructions than branches
+    for address, inst in enumerate(instructions):
+        op = opcode(inst)
+        if op in _branches:
+            target = branch_target(inst)
+            if target is not None:
+                leaders.add(target)
+            leaders.add(address + 1)
+        elif op in _halts:
+            leaders.add(address + 1)
+        else:
+            for k in inst.label_operands:
+                taken.add(immediate(inst.operands[k]))
+    leaders = sorted(a for a in leaders | taken if 0 <= a < n)
+    block_of = dict()  # first address => block index
+    blocks = list()
+    for k, start in enumerate(leaders):
+        end = leaders[k + 1] if k + 1 < len(leaders) else n
+        block_of[start] = k
+        blocks.append(BasicBlock(k, start, end))
+
+    for block in blocks:
+        last = instructions[block.end - 1]
+        op = opcode(last)
+        successors = list()
+        if op in _branches:
+            target = branch_target(last)
+            if target is None:
+                block.indirect = True
+            elif target in block_of:
+                successors.append(block_of[target])
+            if op != "B" and block.end < n:
+                successors.append(block_of[block.end])
+        elif op not in _halts and block.end < n:
+            successors.append(block_of[block.end])
+        block.successors = list(dict.fromkeys(successors))
+        for s in block.successors:
+            blocks[s].predecessors.append(block.index)
+        block.cycles = sum(costs.get(opcode(inst), 1) for inst in instructions[block.start:block.end])
+        lines = [line_number(inst) for inst in instructions[block.start:block.end]]
+        block.lines = (min(lines), max(lines))
+    entries = sorted({0} | {block_of[a] for a in taken if a in block_of}) if len(blocks) > 0 else []
+    return blocks, entries
+
+
+def immediate_dominators(blocks, entries):
+    """
+    Immediate dominator of each block reachable from the entries, None for the others and for the entries.
+    The iterative algorithm of Cooper, Harvey and Kennedy, over a root before all entries.
+    """
+    root = len(blocks)
+    successors = [b.successors for b in blocks] + [entries]
+    # postorder from the root
+    order = list()
+    visited = {root}
+    stack = [(root, iter(successors[root]))]
+    while len(stack) > 0:
+        node, children = stack[-1]
+        for child in children:
+            if child not in visited:
+                visited.add(child)
+                stack.append((child, iter(successors[child])))
+                break
+        else:
+            stack.pop()
+            order.append(node)
+    position = {node: k for k, node in enumerate(order)}
+    predecessors = [[p for p in b.predecessors if p in position] for b in blocks]
+    for entry in entries:
+        predecessors[entry].append(root)
+
+    idom = {root: root}
+
+    def intersect(a, b):
+        while a != b:
+            while position[a] < position[b]:
+                a = idom[a]
+            while position[b] < position[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for node in reversed(order[:-1]):
+            new_idom = None
+            for p in predecessors[node]:
+                if p in idom:
+                    new_idom = p if new_idom is None else intersect(p, new_idom)
+            if idom.get(node) != new_idom:
+                idom[node] = new_idom
+                changed = True
+    return [None if idom.get(b) in (None, root) else idom[b] for b in range(len(blocks))], set(position)
+
+
+def find_loops(blocks, entries):
+    """The natural loops, one per header, with their nesting depth"""
+    idom, reachable = immediate_dominators(blocks, entries)
+
+    def dominates(a, b):
+        while b is not None:
+            if a == b:
+                return True
+            b = idom[b]
+        return False
+
+    bodies = dict()  # header => set of blocks
+    for block in blocks:
+        if block.index not in reachable:
+            continue
+        for header in block.successors:
+            if dominates(header, block.index):
+                body = bodies.setdefault(header, {header})
+                stack = [block.index]
+                while len(stack) > 0:
+                    b = stack.pop()
+                    if b not in body:
+                        body.add(b)
+                        stack += [p for p in blocks[b].predecessors if p in reachable]
+    loops = [Loop(header, body) for header, body in sorted(bodies.items())]
+    for loop in loops:
+        # a loop with its header in another loop is nested in it
+        loop.depth = 1 + sum(1 for other in loops if other is not loop and loop.header in other.blocks)
+        loop.cycles = sum(blocks[b].cycles for b in loop.blocks)
+        lines = [n for b in loop.blocks for n in blocks[b].lines]
+        loop.lines = (min(lines), max(lines))
+    return loops
+
+
+class CostReport:
+    """Cycle estimates of the basic blocks and loops of a program"""
+
+    def __init__(self, instructions, costs=None):
+        self.instruction_count = len(instructions)
+        self.blocks, self.entries = build_cfg(instructions, costs)
+        self.loops = find_loops(self.blocks, self.entries)
+        self.cycles = sum(b.cycles for b in self.blocks)  # each instruction once
+
+    def most_expensive_loops(self, top=DEFAULT_TOP_LOOPS):
+        return sorted(self.loops, key=lambda loop: (-loop.weight, loop.header))[:top]
+
+    def to_dict(self):
+        return {
+            "instructions": self.instruction_count,
+            "cycles": self.cycles,
+            "assumed_iterations": ASSUMED_ITERATIONS,
+            "blocks": [b.to_dict() for b in self.blocks],
+            "entries": [self.blocks[b].start for b in self.entries],
+            "loops": [loop.to_dict(self.blocks) for loop in self.most_expensive_loops(len(self.loops))],
+        }
+
+    def text(self, top=DEFAULT_TOP_LOOPS, list_blocks=False):
+        lines = ["{} instructions, {} basic blocks, {} loops, {} cycles to run each instruction once".format(
+            self.instruction_count, len(self.blocks), len(self.loops), self.cycles)]
+        if len(self.loops) > 0:
+            lines.append("Most expensive loops (weight: cycles per iteration, times {} for each loop level):"
+                         .format(ASSUMED_ITERATIONS))
+            for loop in self.most_expensive_loops(top):
+                lines.append("  lines {}-{}: header at {} (line {}), depth {}, {} blocks, {} cycles per iteration, "
+                             "weight {}".format(loop.lines[0], loop.lines[1], self.blocks[loop.header].start,
+                                                self.blocks[loop.header].lines[0], loop.depth, len(loop.blocks),
+                                                loop.cycles, loop.weight))
+        if list_blocks:
+            lines.append("Basic blocks:")
+            for b in self.blocks:
+                successors = ", ".join(str(self.blocks[s].start) for s in b.successors)
+                if b.indirect:
+                    successors += (", " if successors else "") + "register"
+                lines.append("  {}-{} (lines {}-{}): {} cycles -> {}".format(
+                    b.start, b.end - 1, b.lines[0], b.lines[1], b.cycles, successors or "halt"))
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.text()
+
+
+def analyze(instructions, costs=None):
+    return CostReport(instructions, costs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimates the cycles spent in each basic block and loop")
+    parser.add_argument("file_in", nargs="?", default=constants.DEFAULT_INPUT_FILE)
+    parser.add_argument("--json", metavar="FILE", help="write the whole report as JSON to FILE")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP_LOOPS, help="number of loops to list")
+    parser.add_argument("--blocks", action="store_true", help="list every basic block")
+    parser.add_argument("--costs", metavar="FILE", help="JSON of opcode => cycles, replacing those of opcode_costs")
+    parser.add_argument("--budget", type=int, metavar="CYCLES",
+                        help="exit with status 1 if an iteration of a loop takes more cycles")
+    parser.add_argument("-O", "--optimize", action="store_true", help="analyze the peephole optimized program")
+    args = parser.parse_args()
+
+    costs = dict(cycle_costs)
+    if args.costs is not None:
+        with open(args.costs) as f:
+            costs.update({op.upper(): cycles for op, cycles in json.load(f).items()})
+    try:
+        instructions = token_parser(tokenize_file(args.file_in), args.file_in)
+    except AssemblyError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if args.optimize:
+        instructions = optimize(instructions)[0]
+    report = analyze(instructions, costs)
+    print(report.text(args.top, args.blocks))
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report.to_dict(), f, indent=2)
+        print("Report saved as " + args.json)
+    if args.budget is not None:
+        over = [loop for loop in report.loops if loop.cycles > args.budget]
+        for loop in over:
+            print("OVER BUDGET lines {}-{}: {} cycles per iteration, budget {}".format(
+                loop.lines[0], loop.lines[1], loop.cycles, args.budget), file=sys.stderr)
+        if len(over) > 0:
+            sys.exit(1)
+
+
+def _test():
+    import os
+    from peephole import _parse
+
+    print("Running test on cost analyzer...")
+    # program, and the start address, depth and cycles per iteration of each loop
+    cases = [
+        ("MOV R1, 3\nloop: DEC R1\nBZ end\nB loop\nend: HLT", [(1, 1, 5)]),
+        ("MOV R1, 3\nouter: MOV R2, 3\ninner: DEC R2\nBN inner\nDEC R1\nBN outer",
+         [(1, 1, 7), (2, 2, 3)]),
+        # the return address is an entry, the return has no known successor
+        ("PUSH 1f\nB f\n1: HLT\nf: POP R0\nB R0", []),
+        ("loop: LOAD R1, [R2]\nSTORE R1, [R3]\nB loop", [(0, 1, 6)]),
+    ]
+    test_error_count = 0
+    filename = "abcdefgh_cost_test.fal"
+    try:
+        for source, expected in cases:
+            with open(filename, "w") as f:
+                f.write(source + "\n")
+            report = analyze(_parse(filename))
+            result = sorted((report.blocks[loop.header].start, loop.depth, loop.cycles) for loop in report.loops)
+            if result != expected:
+                print("{!r}: loops {}, expected {}".format(source, result, expected), file=sys.stderr)
+                test_error_count += 1
+    finally:
+        os.remove(filename)
+
+    report = analyze(_parse("examples/demo_quicksort.fal"))
+    if [(loop.lines, loop.depth) for loop in report.most_expensive_loops()] != [((80, 84), 2), ((71, 99), 1)]:
+        print("demo_quicksort.fal: loops {}".format(report.to_dict()["loops"]), file=sys.stderr)
+        test_error_count += 1
+    if sum(b.end - b.start for b in report.blocks) != report.instruction_count:
+        print("demo_quicksort.fal: blocks do not cover the program", file=sys.stderr)
+        test_error_count += 1
+    if test_error_count == 0:
+        print("All tests succeeded")
+    else:
+        print("{} test{} failed".format(test_error_count, "" if test_error_count == 1 else "s"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# Turns a blueprint string with a PROM back into a program file
+# usage: python disassembler.py [blueprint file] [output file]
+# The rows of the PROM are found by following the wiring made by Blueprint.generate_rom_entities,
+# and each row is decoded through a reverse index of the opcode layouts in opcode_tables.
+
+import json
+import sys
+
+import registers
+from blueprint_import_export import bp_decode_base64, bp_decompress
+from opcode_tables import BOTH, IMM, OPCODE_ENCODINGS
+from operand_type import OperandType
+
+DEFAULT_DISASSEMBLY_FILE = "disassembled.fal"
+
+_register_names = {index: name for name, index in registers.register_dict.items()}
+_branch_opcodes = {"B", "BZ", "BN"}
+
+
+def build_reverse_index():
+    """Set of signal names of a ROM row => (opcode, operand types, layout) making exactly those signals"""
+    index = dict()
+    for opcode, opcode_encoding in OPCODE_ENCODINGS.items():
+        for layout in opcode_encoding.layouts.values():
+            index.setdefault(frozenset(layout.names), list()).append((opcode, opcode_encoding.operand_types, layout))
+    return index
+
+
+REVERSE_INDEX = build_reverse_index()
+_partial_candidates = dict()  # set of signal names => layouts making at least those signals, see decode_row
+
+
+def decode_operands(signals, operand_types, layout):
+    """Returns the operand texts, or None if the signals were not made by this layout"""
+    for name, value in zip(layout.names, layout.values):
+        if value is not None and signals[name] != value:
+            return None
+    values = dict()
+    for name, slot in layout.slots:
+        # a register operand may set its index in more than one signal
+        if values.setdefault(slot, signals[name]) != signals[name]:
+            return None
+    operands = list()
+    slot = 0
+    for operand_type, form in zip(operand_types, layout.forms):
+        if form == IMM:
+            text = str(values[slot])
+        else:
+            if values[slot] not in _register_names:
+                return None
+            text = _register_names[values[slot]]
+            if form == BOTH:
+                slot += 1
+                text += ", " + str(values[slot])
+        slot += 1
+        operands.append("[" + text + "]" if operand_type == OperandType.REG_OR_IMM_OR_BOTH else text)
+    return operands
+
+
+def partial_candidates(names):
+    """The layouts making the signals names and more, for rows without their signals of count 0 (see CompactExport)"""
+    if names not in _partial_candidates:
+        _partial_candidates[names] = [c for key, candidates in REVERSE_INDEX.items() if names < key
+                                      for c in candidates]
+    return _partial_candidates[names]
+
+
+def decode_row(signals):
+    """Returns (opcode, operand texts) for the signals of a ROM row, or None if no opcode makes these signals"""
+    names = frozenset(signals)
+    # like ADD R1, R1, 1 and INC R1, some encodings give the same signals, only in another order,
+    # and without the signals of count 0, the layout missing the fewest signals is the likeliest
+    order = tuple(signals)
+    for opcode, operand_types, layout in sorted(REVERSE_INDEX.get(names, ()), key=lambda c: c[2].names != order):
+        operands = decode_operands(signals, operand_types, layout)
+        if operands is not None:
+            return opcode, operands
+    for opcode, operand_types, layout in sorted(partial_candidates(names), key=lambda c: (
+            len(c[2].names), tuple(name for name in c[2].names if name in names) != order)):
+        operands = decode_operands({name: signals.get(name, 0) for name in layout.names}, operand_types, layout)
+        if operands is not None:
+            return opcode, operands
+    return None
+
+
+def load_blueprint(blueprint_string):
+    """The JSON dict of a blueprint string"""
+    return json.loads(bp_decompress(bp_decode_base64(blueprint_string.strip())))
+
+
+def _wires(entity, side, color):
+    """(entity number, circuit id) of each wire of a color on one side of an entity"""
+    wires = entity.get("connections", dict()).get(side, dict()).get(color, list())
+    return [(w["entity_id"], w.get("circuit_id", 1)) for w in wires]
+
+
+def find_roms(entities):
+    """
+    Finds the PROMs among the blueprint entities, returns a list of ROMs, largest first,
+    each a list of the constant combinators of its rows in ROM order.
+    Each row has a constant combinator wired (red) to the input of a decider combinator, and the outputs of
+    the deciders are chained (green) from row to row. The first row is wired to the output lamp.
+    """
+    by_number = {e["entity_number"]: e for e in entities}
+    row_combinator = dict()  # decider => constant combinator of the same row
+    for e in entities:
+        if e["name"] == "constant-combinator":
+            for n, circuit in _wires(e, "1", "red"):
+                if circuit == 1 and by_number.get(n, dict()).get("name") == "decider-combinator":
+                    row_combinator[n] = e
+    chained = {d: [n for n, circuit in _wires(by_number[d], "2", "green") if circuit == 2 and n in row_combinator]
+               for d in row_combinator}
+
+    roms = list()
+    seen = set()
+    for d in row_combinator:
+        if d in seen or len(chained[d]) > 1:
+            continue
+        # an end of a chain, walk it
+        chain = [d]
+        seen.add(d)
+        while True:
+            following = [n for n in chained[chain[-1]] if n not in seen]
+            if len(following) != 1:
+                break
+            chain.append(following[0])
+            seen.add(following[0])
+        if chain_start(chain[-1], by_number, row_combinator) > chain_start(chain[0], by_number, row_combinator):
+            chain.reverse()
+        roms.append([row_combinator[d] for d in chain])
+    roms.sort(key=len, reverse=True)
+    return roms
+
+
+def chain_start(decider, by_number, row_combinator):
+    """How likely the end of a chain of deciders is the first ROM row, wired to the output lamp, and above the rest"""
+    others = [by_number[n]["name"] for n, circuit in _wires(by_number[decider], "2", "green")
+              if n not in row_combinator]
+    return ("small-lamp" in others, len(others) > 0, -by_number[decider]["position"]["y"])
+
+
+def combinator_signals(combinator):
+    """The signals of a constant combinator, in filter order"""
+    filters = combinator.get("control_behavior", dict()).get("filters", list())
+    return {f["signal"]["name"]: f["count"] for f in sorted(filters, key=lambda f: f["index"])}
+
+
+def disassemble_rows(rom_signals):
+    """Returns the program lines for the signals of each ROM row, with labels for static branch targets"""
+    decoded = [decode_row(signals) for signals in rom_signals]
+    labels = set()
+    for row in decoded:
+        if row is not None and row[0] in _branch_opcodes:
+            address = int_or_none(row[1][0])
+            if address is not None and 0 <= address < len(decoded):
+                labels.add(address)
+
+    lines = list()
+    for address, row in enumerate(decoded):
+        if address in labels:
+            lines.append("L{}:".format(address))
+        if row is None:
+            # keep the addresses of the rows after it
+            lines.append("NOP ; row {}: unknown signals {}".format(address, rom_signals[address]))
+            continue
+        opcode, operands = row
+        if opcode in _branch_opcodes and int_or_none(operands[0]) in labels:
+            operands = ["L" + operands[0]]
+        lines.append((opcode + " " + ", ".join(operands)).rstrip())
+    return lines
+
+
+def int_or_none(text):
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
+def disassemble(blueprint_string):
+    """
+    Returns the program lines of the largest PROM in a blueprint string.
+    In a blueprint book, like the PROM banks of rom_banks.py, the largest PROM of each blueprint in order.
+    """
+    json_dict = load_blueprint(blueprint_string)
+    if "blueprint_book" in json_dict:
+        blueprints = sorted(json_dict["blueprint_book"].get("blueprints", list()), key=lambda b: b.get("index", 0))
+        blueprints = [b["blueprint"] for b in blueprints if "blueprint" in b]
+    elif "blueprint" in json_dict:
+        blueprints = [json_dict["blueprint"]]
+    else:
+        raise ValueError("Not a blueprint or blueprint book, found {}".format(", ".join(json_dict)))
+    rows = list()
+    for blueprint in blueprints:
+        roms = find_roms(blueprint.get("entities", list()))
+        if len(roms) > 0:
+            rows += roms[0]
+    if len(rows) == 0:
+        raise ValueError("No PROM found in the blueprint")
+    return disassemble_rows([combinator_signals(c) for c in rows])
+
+
+def main():
+    file_in = sys.argv[1] if len(sys.argv) > 1 else "output.txt"
+    file_out = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_DISASSEMBLY_FILE
+    with open(file_in) as f:
+        lines = disassemble(f.read())
+    with open(file_out, "w") as f:
+        f.write("; disassembled from {}\n".format(file_in))
+        for line in lines:
+            f.write(line + "\n")
+    print("Done. {} instructions saved as {}".format(sum(1 for line in lines if not line.endswith(":")), file_out))
+
+
+def _test():
+    print("Running test on disassembler...")
+    import glob
+    import io
+    import os
+    from blueprint_generator import Blueprint
+    from blueprint_import_export import CompactExport, bp_compress, bp_encode_base64
+    from emulator import load_program
+    from rom_banks import RomBanks
+    test_error_count = 0
+    for filename in sorted(glob.glob("examples/demo_*.fal")):
+        if "fail" in filename:
+            continue
+        rom_signals = load_program(filename)
+        bp = Blueprint()
+        bp.generate_rom_entities(len(rom_signals))
+        bp.insert_signals(rom_signals)
+        exports = {"default": bp_encode_base64(bp_compress(json.dumps(bp.json_dict)))}
+        for mode, export in [("compact", CompactExport().write),
+                             ("banked", lambda _, out: RomBanks(7, workers=1).write(rom_signals, out)),
+                             ("book", lambda _, out: RomBanks(7, book=True, workers=1).write(rom_signals, out))]:
+            stream = io.StringIO()
+            export(bp.json_dict, stream)
+            exports[mode] = stream.getvalue()
+        for mode, blueprint_string in exports.items():
+            lines = disassemble(blueprint_string)
+            # assembling the disassembly gives the same ROM, plus the HLTG appended by the assembler
+            tmp_filename = "abcdefgh_disassembled.fal"
+            with open(tmp_filename, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            try:
+                reassembled = load_program(tmp_filename)
+            finally:
+                os.remove(tmp_filename)
+            if [list(s.items()) for s in reassembled[:len(rom_signals)]] != [list(s.items()) for s in rom_signals]:
+                print("{} ({} export): reassembled ROM differs".format(filename, mode), file=sys.stderr)
+                test_error_count += 1
+    if test_error_count == 0:
+        print("All tests succeeded")
+    else:
+        print("{} test{} failed".format(test_error_count, "" if test_error_count == 1 else "s"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+# Executes an assembled program, without Factorio
+# The program is run from the constant combinator signals of each ROM row (the output of inst_to_signals),
+# so the emulator runs exactly what ends up in the blueprint.
+
+import sys
+from enum import Enum, auto
+
+import registers
+from exceptions import EmulatorError
+
+MEMORY_SIZE = 256
+REGISTER_COUNT = 32
+ZERO_REGISTER = REGISTER_COUNT  # always 0, stands in for a missing register operand
+INT32_MIN = -2**31
+
+
+class HaltReason(Enum):
+    HALT = auto()  # HLT
+    SUCCESS = auto()  # HLTG
+    FAILURE = auto()  # HLTB
+
+
+# Control signal (copper-plate) of each kind of instruction, see opcode_map
+KIND_HLT = 0
+KIND_NOP = 1
+KIND_STORE = 2
+KIND_LOAD = 4
+KIND_HALT_EXIT = 6
+KIND_BRANCH = 7
+KIND_ALU = 9
+KIND_CLEAR = 12
+KIND_PUSH = 13
+KIND_POP = 16
+
+
+def to_int32(n):
+    """Wraps an integer to signed 32 bit, like a Factorio signal"""
+    return ((n - INT32_MIN) & 0xffffffff) + INT32_MIN
+
+
+def _div(a, b):
+    # Factorio rounds towards zero, and dividing by zero gives zero
+    if b == 0:
+        return 0
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+def _mod(a, b):
+    if b == 0:
+        return 0
+    return a - b * _div(a, b)
+
+
+def _pow(a, b):
+    if b < 0:
+        return 0
+    return pow(a, b, 2**32)
+
+
+def _rol(a, b):
+    a &= 0xffffffff
+    return (a << 1) | (a >> 31)
+
+
+def _ror(a, b):
+    a &= 0xffffffff
+    return (a >> 1) | ((a & 1) << 31)
+
+
+# ALU functions by the value of signal-F, results are wrapped to 32 bit afterwards
+ALU_FUNCTIONS = {
+    0: lambda a, b: a + b,
+    1: lambda a, b: a * b,
+    2: _div,
+    3: _pow,
+    4: _mod,
+    5: lambda a, b: a >> (b & 31),
+    6: lambda a, b: a << (b & 31),
+    7: lambda a, b: (a & 0xffffffff) >> 1,
+    8: _rol,
+    9: _ror,
+    10: lambda a, b: ~a,
+    11: lambda a, b: a & b,
+    12: lambda a, b: a | b,
+    13: lambda a, b: a ^ b,
+}
+
+
+def decode_row(signals):
+    """Decodes the signals of one ROM row into (kind, operands)"""
+    def register(present, signal):
+        return signals.get(signal, 0) if signals.get(present, 0) else ZERO_REGISTER
+
+    kind = signals.get("copper-plate", KIND_HLT)
+    a = (register("signal-K", "signal-0"), signals.get("signal-A", 0))
+    b = (register("signal-L", "signal-1"), signals.get("signal-B", 0))
+    alu = (signals.get("signal-2", 0), signals.get("signal-3", 0), signals.get("signal-O", 0),
+           ALU_FUNCTIONS.get(signals.get("signal-F", 0)))
+    if kind in (KIND_HLT, KIND_NOP):
+        return kind, ()
+    elif kind == KIND_STORE:
+        return kind, a + b
+    elif kind == KIND_LOAD:
+        return kind, (signals.get("signal-U", 0),) + a
+    elif kind == KIND_HALT_EXIT:
+        reason = {1: HaltReason.SUCCESS, 2: HaltReason.FAILURE}.get(signals.get("signal-A", 0))
+        if reason is None:
+            raise EmulatorError("Unknown exit code in {}".format(signals))
+        return kind, (reason,)
+    elif kind == KIND_BRANCH:
+        return kind, (signals.get("signal-C", 0),) + a
+    elif kind in (KIND_ALU, KIND_PUSH, KIND_POP):
+        if alu[3] is None:
+            raise EmulatorError("Unknown ALU function in {}".format(signals))
+        target = "signal-V" if kind == KIND_POP else "signal-U"
+        write = signals.get("signal-red", 0) != 0
+        return kind, (signals.get(target, 0) if write else None,) + a + b + alu + (signals.get("signal-U", 0),)
+    elif kind == KIND_CLEAR:
+        return kind, (signals.get("signal-grey", 0) != 0, signals.get("signal-black", 0) != 0)
+    raise EmulatorError("Unknown instruction signals {}".format(signals))
+
+
+class Emulator:
+    """
+    Runs the ROM signals of a program, see inst_to_signals.
+    State: 32 registers, SP, PC, the Z and N flags of the ALU and 256 words of RAM.
+    Reading PC gives the address of the instruction being executed.
+    """
+
+    def __init__(self, rom_signals, memory_size=MEMORY_SIZE):
+        self.decoded = [decode_row(signals) for signals in rom_signals]
+        self.program = [(_DISPATCH[kind], operands) for kind, operands in self.decoded]
+        self.memory_size = memory_size
+        self.reset()
+
+    def reset(self):
+        # R0..R31, the zero register, then SP and PC, so register_dict indexes (SP -2, PC -1) work as they are
+        self.registers = [0] * (REGISTER_COUNT + 3)
+        self.memory = [0] * self.memory_size
+        self.zero = False
+        self.negative = False
+        self.pc = 0
+        self.steps = 0
+        self.halt_reason = None
+
+    @property
+    def sp(self):
+        return self.registers[registers.register_dict["SP"]]
+
+    def register(self, name):
+        return self.registers[registers.register_dict[name.upper()]]
+
+    def run(self, max_steps=100_000_000):
+        """Runs until the program halts, returns the HaltReason"""
+        program = self.program
+        regs = self.registers
+        program_length = len(program)
+        pc = self.pc
+        steps = self.steps
+        step_limit = steps + max_steps
+        try:
+            while self.halt_reason is None:
+                if steps >= step_limit:
+                    raise EmulatorError("No halt after {} steps, at PC {}".format(max_steps, pc))
+                if not 0 <= pc < program_length:
+                    raise EmulatorError("PC {} outside program of {} instructions".format(pc, program_length))
+                handler, operands = program[pc]
+                regs[-1] = pc
+                pc = handler(self, operands, pc)
+                steps += 1
+        finally:
+            self.pc = pc
+            self.steps = steps
+        return self.halt_reason
+
+    def check_address(self, address, pc):
+        if not 0 <= address < self.memory_size:
+            raise EmulatorError("Memory address {} out of range, at PC {}".format(address, pc))
+        return address
+
+
+def _hlt(emu, operands, pc):
+    emu.halt_reason = HaltReason.HALT
+    return pc
+
+
+def _nop(emu, operands, pc):
+    return pc + 1
+
+
+def _store(emu, operands, pc):
+    a_reg, a_imm, b_reg, b_imm = operands
+    regs = emu.registers
+    address = to_int32(regs[a_reg] + a_imm)
+    emu.memory[emu.check_address(address, pc)] = to_int32(regs[b_reg] + b_imm)
+    return pc + 1
+
+
+def _load(emu, operands, pc):
+    u, a_reg, a_imm = operands
+    regs = emu.registers
+    address = to_int32(regs[a_reg] + a_imm)
+    regs[u] = emu.memory[emu.check_address(address, pc)]
+    return pc + 1
+
+
+def _halt_exit(emu, operands, pc):
+    emu.halt_reason = operands[0]
+    return pc
+
+
+def _branch(emu, operands, pc):
+    condition, a_reg, a_imm = operands
+    if condition == 0 or (condition == 1 and emu.zero) or (condition == 2 and emu.negative):
+        return to_int32(emu.registers[a_reg] + a_imm)
+    return pc + 1
+
+
+def _alu(emu, operands, pc):
+    target, a_reg, a_imm, b_reg, b_imm, coef_a, coef_b, offset, function, u = operands
+    regs = emu.registers
+    a = coef_a * to_int32(regs[a_reg] + a_imm)
+    b = coef_b * to_int32(regs[b_reg] + b_imm)
+    result = to_int32(function(a, b) + offset)
+    emu.zero = result == 0
+    emu.negative = result < 0
+    if target is not None:
+        regs[target] = result
+    return pc + 1
+
+
+def _clear(emu, operands, pc):
+    clear_registers, clear_memory = operands
+    if clear_registers:
+        regs = emu.registers
+        for i in range(REGISTER_COUNT):
+            regs[i] = 0
+        regs[registers.register_dict["SP"]] = 0
+    if clear_memory:
+        emu.memory = [0] * emu.memory_size
+    return pc + 1
+
+
+def _push(emu, operands, pc):
+    # M[SP] := o1, then SP := SP - 1 through the ALU
+    target, a_reg, a_imm, b_reg, b_imm, coef_a, coef_b, offset, function, u = operands
+    regs = emu.registers
+    address = to_int32(regs[a_reg] + a_imm)
+    emu.memory[emu.check_address(address, pc)] = to_int32(regs[b_reg] + b_imm)
+    regs[target] = to_int32(function(coef_a * address, 0) + offset)
+    return pc + 1
+
+
+def _pop(emu, operands, pc):
+    # SP := SP + 1 through the ALU, then o1 := M[SP]
+    target, a_reg, a_imm, b_reg, b_imm, coef_a, coef_b, offset, function, u = operands
+    regs = emu.registers
+    address = to_int32(function(coef_a * to_int32(regs[a_reg] + a_imm), 0) + offset)
+    regs[target] = address
+    regs[u] = emu.memory[emu.check_address(address, pc)]
+    return pc + 1
+
+
+# Handler of each kind of instruction, handlers return the address of the next instruction
+_DISPATCH = {
+    KIND_HLT: _hlt,
+    KIND_NOP: _nop,
+    KIND_STORE: _store,
+    KIND_LOAD: _load,
+    KIND_HALT_EXIT: _halt_exit,
+    KIND_BRANCH: _branch,
+    KIND_ALU: _alu,
+    KIND_CLEAR: _clear,
+    KIND_PUSH: _push,
+    KIND_POP: _pop,
+}
+
+
+def load_program(filename):
+    """Assembles a program file, returns the ROM signals"""
+    from insr_to_signals import inst_to_signals
+    from token_parser import token_parser
+    from tokenizer import tokenize_file
+    return inst_to_signals(token_parser(tokenize_file(filename), filename))
+
+
+def _test():
+    print("Running test on emulator...")
+    # program, expected registers and expected memory (address: value) after the run
+    cases = [
+        ("examples/demo_fibonacci_iterative.fal", {"R3": 64}, {0: 0, 1: 1, 2: 1, 3: 2, 4: 3, 10: 55, 46: 1836311903}),
+        ("examples/demo_fibonacci_recursive.fal",
+         {"R2": 5, "R3": 8, "R4": 13, "R5": 21, "R6": 34, "R7": 55, "SP": 0xff}, {}),
+        ("examples/demo_fibonacci_recursive_memoization.fal", {"R3": 12, "R4": 144, "SP": 0xff}, {12: 144}),
+        ("examples/demo_procedure.fal", {"R0": 8, "SP": 0xff},
+         dict(enumerate([30, 62, 96, 132, 170, 210, 252, 296]))),
+        ("examples/demo_quicksort.fal", {"SP": 0xff},
+         dict(enumerate(sorted([6, -922868, -7514, -68800, -3, 62, 192677, 193, 73500220, -76, 4359, -8376837,
+                                2921565, -17324976, 97484, -255])))),
+        ("examples/demo_stack.fal", {"R1": 5, "R2": 10, "SP": 0xff}, {}),
+        ("examples/demo_mem_test.fal", {"R4": 10, "R5": 20, "R6": 30}, {2: 10, 4: 20, 6: 30}),
+        ("examples/demo_labels.fal", {"R0": 5, "R1": 4, "R2": 42, "R3": 12345}, {}),
+        ("examples/demo_macros.fal", {"R0": 0, "R1": 5, "R2": 10 >> 20, "R5": 100}, {}),
+    ]
+    test_error_count = 0
+    for filename, expected_registers, expected_memory in cases:
+        emu = Emulator(load_program(filename))
+        reason = emu.run()
+        failures = list()
+        if reason != HaltReason.SUCCESS:
+            failures.append("halted with {}".format(reason))
+        for name, value in expected_registers.items():
+            if emu.register(name) != value:
+                failures.append("{} was {}, expected {}".format(name, emu.register(name), value))
+        for address, value in expected_memory.items():
+            if emu.memory[address] != value:
+                failures.append("M[{}] was {}, expected {}".format(address, emu.memory[address], value))
+        for failure in failures:
+            print("{}: {}".format(filename, failure), file=sys.stderr)
+        test_error_count += len(failures)
+    if test_error_count == 0:
+        print("All tests succeeded")
+    else:
+        print("{} test{} failed".format(test_error_count, "" if test_error_count == 1 else "s"))
+
+
+if __name__ == "__main__":
+    _test()
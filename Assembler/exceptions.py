@@ -1,7 +1,12 @@
-# custom exceptions
-
+# custom exceptions, and the errors and warnings of the assembler
+# An error raises AssemblyError, carrying a Diagnostic with the position of the token it was found at.
+# The passes catch the errors of each line or instruction and go on, so one run reports all of them.
+# Warnings go to the Diagnostics being collected for the run, see collecting(), else they are printed.
+
+import contextlib
+import contextvars
+import os
 import sys
-import time
 
 
 class AsmSyntaxError(Exception):
@@ -16,6 +21,89 @@ class ParseFileError(Exception):
     pass
 
 
+class EmulatorError(Exception):
+    pass
+
+
+class SimulatorError(Exception):
+    pass
+
+
+class Diagnostic:
+    """An error or warning, at the line and column of a token if it has one"""
+
+    def __init__(self, kind, msg, token=None, one_line=False):
+        self.kind = kind  # "SyntaxError", "ParsingError" or "Warning"
+        self.msg = msg
+        self.one_line = one_line  # printed as a single line, without the source line
+        self.line = None
+        self.column = None
+        self.source_line = None
+        self.file = None  # path of the included file the token is in, None in the program itself
+        if token is not None:
+            self.line = token.file_line_num
+            self.column = token.str_col
+            self.source_line = token.file_raw_text
+            self.file = token.file_name
+
+    @property
+    def is_error(self):
+        return self.kind != "Warning"
+
+    def to_dict(self):
+        return {"kind": self.kind, "message": self.msg, "file": self.file, "line": self.line, "column": self.column}
+
+    def __str__(self):
+        if self.line is None:
+            return self.kind + ": " + self.msg
+        if self.one_line:
+            return "[{}, line {}{}] {}".format(self.kind, self.line, in_file(self.file), self.msg)
+        msg = self.msg
+        if "\n" in msg:
+            splat = msg.split("\n")
+            msg = splat[0] + "".join(["\n" + " " * (len(self.kind) + 2) + _ for _ in splat[1:]])
+        return format_line(self.line, self.source_line, self.column, self.file) + self.kind + ": " + msg
+
+    def __repr__(self):
+        return "Diagnostic({!r}, {!r}, line={}, column={})".format(self.kind, self.msg, self.line, self.column)
+
+
+class AssemblyError(Exception):
+    """The errors found in a program, as a list of Diagnostic"""
+
+    def __init__(self, diagnostics):
+        super().__init__("\n".join(map(str, diagnostics)))
+        self.diagnostics = list(diagnostics)
+        self.included = list()  # absolute paths of the files the program included, set by assembler_api.assemble
+
+
+class Diagnostics:
+    """The warnings of an assembler run"""
+
+    def __init__(self):
+        self.warnings = list()
+
+
+_diagnostics = contextvars.ContextVar("diagnostics", default=None)  # Diagnostics of the run in this context
+
+
+@contextlib.contextmanager
+def collecting():
+    """Collects the warnings of the block instead of printing them, each thread or task collects its own"""
+    diagnostics = Diagnostics()
+    reset_token = _diagnostics.set(diagnostics)
+    try:
+        yield diagnostics
+    finally:
+        _diagnostics.reset(reset_token)
+
+
+def raise_errors(errors):
+    """Raises the Diagnostic errors collected by a pass, if there are any"""
+    if len(errors) > 0:
+        raise AssemblyError(errors)
+
+
 def show_parsing_error(msg, token):
     output_error("ParsingError", msg, token)
 
@@ -25,37 +113,37 @@ def show_syntax_error(msg, token):
 
 
 def output_error(error_type, msg, token):
-    """Show a message to stderr, then exit"""
-    if "\n" in msg:
-        splat = msg.split("\n")
-        indented = splat[1:]
-        msg = splat[0] + "".join(["\n" + " " * (len(error_type) + 2) + _ for _ in indented])
-    error_msg = get_line_from_token(token)
-    error_msg += error_type + ": " + msg
-    time.sleep(0.005)
-    print(error_msg, file=sys.stderr)
-    exit(0)
+    """Raises the error at the token"""
+    raise AssemblyError([Diagnostic(error_type, msg, token)])
 
 
-def show_warning(msg, token):
-    warning = get_line_from_token(token)
-    warning += "Warning: " + msg
-    time.sleep(0.005)
-    print(warning, file=sys.stderr)
+def add_warning(warning):
+    diagnostics = _diagnostics.get()
+    if diagnostics is not None:
+        diagnostics.warnings.append(warning)
+    else:
+        print(warning, file=sys.stderr)
+
+
+def show_warning(msg, token=None):
+    add_warning(Diagnostic("Warning", msg, token))
 
 
 def show_warning_one_line(msg, token):
-    warning = "[Warning, line {}] ".format(str(token.file_line_num)) + msg
-    time.sleep(0.005)
-    print(warning, file=sys.stderr)
+    add_warning(Diagnostic("Warning", msg, token, one_line=True))
 
 
-def get_line_from_token(token):
-    line_number = token.file_line_num
-    raw_line = token.file_raw_text
-    index = token.str_col
+def in_file(file):
+    return "" if file is None else " of " + os.path.basename(file)
+
+
+def format_line(line_number, raw_line, index, file=None):
     indent_len = 4
-    error_msg = "  Line {}\n".format(line_number)
+    error_msg = "  Line {}{}\n".format(line_number, in_file(file))
     error_msg += " " * indent_len + raw_line + "\n"
     error_msg += " " * (indent_len + index) + "^\n"
     return error_msg
+
+
+def get_line_from_token(token):
+    return format_line(token.file_line_num, token.file_raw_text, token.str_col, token.file_name)
@@ -0,0 +1,294 @@
+# Cache of the files included with #include, each parsed once into a Module
+# Modules are kept for the whole process. The command line tools also write them to a directory (use_directory),
+# so other processes and later runs find them, the library keeps them in memory only.
+# A module is used again while its file has the same modification time and size, or else the same content hash.
+
+import functools
+import hashlib
+import os
+import pickle
+import sys
+import threading
+
+import constants
+from macro import Macro
+from tokenizer import SourceLine, Token, TokenType
+
+CACHE_VERSION = 1
+
+# the parsed modules are only valid for the same tokenizer and parser
+_FINGERPRINT_FILES = ["tokenizer.py", "token_parser.py", "macro.py", "label.py", "include_cache.py"]
+
+
+class FileStamp:
+    """Modification time, size and content hash of a file"""
+
+    def __init__(self, mtime_ns, size, content_hash):
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.content_hash = content_hash
+
+    @staticmethod
+    def of(path, content=None):
+        stat = os.stat(path)
+        if content is None:
+            with open(path, "rb") as f:
+                content = f.read()
+        return FileStamp(stat.st_mtime_ns, stat.st_size, hashlib.sha256(content).hexdigest())
+
+    def matches(self, path):
+        """True if the file is unchanged, the content is only hashed again when the time or size differ"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if (stat.st_mtime_ns, stat.st_size) == (self.mtime_ns, self.size):
+            return True
+        stamp = FileStamp.of(path)
+        if stamp.content_hash != self.content_hash:
+            return False
+        # touched but the same, no need to hash it next time
+        self.mtime_ns, self.size = stamp.mtime_ns, stamp.size
+        return True
+
+
+class IncludeDirective:
+    """An #include line of a module, resolved each time the module is used, so each file is included once"""
+
+    def __init__(self, path, token):
+        self.path = path  # absolute
+        self.token = token
+
+
+class Module:
+    """
+    A parsed file: the macros it defines, and its lines outside macro definitions,
+    as lists of token lines and IncludeDirectives in the order of the file.
+    The tokens are shared by every program including the module, they are copied before being changed.
+    """
+
+    def __init__(self, path, stamp, macros, parts):
+        self.path = path
+        self.stamp = stamp
+        self.macros = macros  # name => Macro
+        self.parts = parts
+
+    def __getstate__(self):
+        """The lines as token records, pickled many times faster than the tokens"""
+        line_indexes = dict()  # id of SourceLine => index in records
+        records = list()  # number, text, file and token records (text, type, column) of each line
+
+        def line_index(line):
+            source = line[0].line
+            i = line_indexes.get(id(source))
+            if i is None:
+                i = line_indexes[id(source)] = len(records)
+                records.append((source.number, source.text, source.file,
+                                tuple((t.text, t.t_type.value, t.str_col) for t in source.tokens)))
+            return i
+
+        def token_position(token):
+            return line_index(token.tokens), token.tokens.index(token)
+
+        macros = [(m.name, m.param_count, m.token_line_begin, m.token_line_end, token_position(m.begin_token),
+                   [line_index(line) for line in m.lines_of_inst]) for m in self.macros.values()]
+        parts = [(part.path, token_position(part.token)) if isinstance(part, IncludeDirective) else line_index(part)
+                 for part in self.parts]
+        return self.path, self.stamp, records, macros, parts
+
+    def __setstate__(self, state):
+        self.path, self.stamp, records, macros, parts = state
+        token_types = {t.value: t for t in TokenType}
+        lines = list()
+        for number, text, file, token_records in records:
+            source = SourceLine(number, text, file)
+            source.tokens = [Token(text, token_types[t_type], source, column)
+                             for text, t_type, column in token_records]
+            lines.append(source.tokens)
+        self.macros = dict()
+        for name, param_count, line_begin, line_end, (i, k), macro_lines in macros:
+            macro = Macro(name, param_count, line_begin, lines[i][k])
+            macro.token_line_end = line_end
+            macro.lines_of_inst = [lines[i] for i in macro_lines]
+            self.macros[name] = macro
+        self.parts = [IncludeDirective(part[0], lines[part[1][0]][part[1][1]]) if isinstance(part, tuple)
+                      else lines[part] for part in parts]
+
+
+class ModuleCache:
+    """
+    The modules of the process by path, and the on-disk copies in directory, one file per module.
+    directory None keeps the modules in memory only. Safe to use from many threads.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.modules = dict()  # absolute path => Module
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.parsed = 0
+
+    def get(self, path, parse):
+        """The module of the file at the absolute path, parse(path, content) is called to make a new one"""
+        with self.lock:
+            module = self.modules.get(path)
+        if module is not None and module.stamp.matches(path):
+            self.hits += 1
+            return module
+        module = self.load(path)
+        if module is not None and module.stamp.matches(path):
+            self.disk_hits += 1
+        else:
+            with open(path, "rb") as f:
+                content = f.read()
+            module = parse(path, content)
+            module.stamp = FileStamp.of(path, content)
+            self.parsed += 1
+            self.save(module)
+        with self.lock:
+            self.modules[path] = module
+        return module
+
+    def cache_filename(self, path):
+        return os.path.join(self.directory, hashlib.sha1(path.encode("utf-8")).hexdigest() + ".pickle")
+
+    def load(self, path):
+        """The module of the path written by this or another process, None if missing or outdated"""
+        if self.directory is None:
+            return None
+        try:
+            with open(self.cache_filename(path), "rb") as f:
+                fingerprint, module = pickle.load(f)
+            if fingerprint == cache_fingerprint() and isinstance(module, Module) and module.path == path:
+                return module
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("Warning: Could not read include cache of {} ({})".format(path, e), file=sys.stderr)
+        return None
+
+    def save(self, module):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.cache_filename(module.path)
+        # each process and thread writes its own file, the last one replaces the others
+        tmp_filename = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+        with open(tmp_filename, "wb") as f:
+            pickle.dump((cache_fingerprint(), module), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+
+
+@functools.lru_cache(maxsize=None)
+def cache_fingerprint():
+    """Hash of the cache version and the modules the parsed modules depend on, computed once"""
+    h = hashlib.sha1(str(CACHE_VERSION).encode("utf-8"))
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    for filename in _FINGERPRINT_FILES:
+        with open(os.path.join(module_dir, filename), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+module_cache = ModuleCache()  # the modules of this process, used by token_parser, in memory unless use_directory
+
+
+def use_directory(directory=constants.DEFAULT_INCLUDE_CACHE_DIR):
+    """Makes the modules of this process also be written to and read from directory, None for memory only"""
+    module_cache.directory = directory
+
+
+def _test():
+    import tempfile
+    from exceptions import AssemblyError
+    from include_cache import ModuleCache  # the class token_parser makes modules of, also when run as a script
+    from token_parser import token_parser
+    from tokenizer import tokenize_file
+
+    print("Running test on include cache...")
+    test_error_count = 0
+
+    def check(what, result, expected):
+        nonlocal test_error_count
+        if result != expected:
+            print("{}: {!r}, expected {!r}".format(what, result, expected), file=sys.stderr)
+            test_error_count += 1
+
+    with tempfile.TemporaryDirectory() as directory:
+        def write(name, text):
+            with open(os.path.join(directory, name), "w") as f:
+                f.write(text)
+            return os.path.join(directory, name)
+
+        def parse(name, modules):
+            filename = os.path.join(directory, name)
+            included = set()
+            instructions = token_parser(tokenize_file(filename), filename, included, modules)
+            return [" ".join([inst.opcode.text] + [str(t.text) for t in inst.operands]) for inst in instructions], \
+                sorted(os.path.basename(f) for f in included)
+
+        def errors(name, modules):
+            try:
+                parse(name, modules)
+            except AssemblyError as e:
+                return [(os.path.basename(d.file or name), d.line, d.msg.split("\n")[-1]) for d in e.diagnostics]
+            return None
+
+        # lib.fal and main.fal both include macros.fal, it is only included once
+        write("macros.fal", "#macro inc 1\nADD $0, $0, 1\n#endm\n")
+        write("lib.fal", '#include "macros.fal"\n#def ANSWER 42\nB 1f\nfunc:\ninc R1\n1:\n')
+        main = write("main.fal", '#include "lib.fal"\n#include "macros.fal"\nMOV R1, ANSWER\ninc R1\nB func\n')
+        cache_directory = os.path.join(directory, "cache")
+        modules = ModuleCache(cache_directory)
+        expected = (["B 2", "ADD R1 , R1 , 1", "MOV R1 , 42", "ADD R1 , R1 , 1", "B 1", "HLTG"],
+                    ["lib.fal", "macros.fal"])
+        check("included", parse("main.fal", modules), expected)
+        check("parsed", (modules.parsed, modules.hits, modules.disk_hits), (2, 0, 0))
+        check("again", parse("main.fal", modules), expected)
+        check("from memory", (modules.parsed, modules.hits, modules.disk_hits), (2, 2, 0))
+
+        # another process finds them on disk
+        other = ModuleCache(cache_directory)
+        check("other process", parse("main.fal", other), expected)
+        check("from disk", (other.parsed, other.hits, other.disk_hits), (0, 0, 2))
+
+        # saved again with the same content, then changed
+        stat = os.stat(main)
+        os.utime(os.path.join(directory, "macros.fal"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        check("touched", parse("main.fal", modules)[0], expected[0])
+        check("touched parsed", modules.parsed, 2)
+        write("macros.fal", "#macro inc 1\nADD $0, $0, 2\n#endm\n")
+        os.utime(os.path.join(directory, "macros.fal"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+        check("changed", parse("main.fal", modules)[0][1], "ADD R1 , R1 , 2")
+        check("changed parsed", modules.parsed, 3)
+
+        # errors
+        write("a.fal", '#include "b.fal"\n')
+        write("b.fal", 'NOP\n#include "a.fal"\n')
+        check("cycle", errors("a.fal", modules), [("b.fal", 2, "Cycle: a.fal => b.fal => a.fal")])
+        write("missing.fal", 'NOP\n#include "nothing.fal"\n')
+        check("missing", errors("missing.fal", modules),
+              [("missing.fal", 2, "Can't read included file: No such file or directory")])
+        write("unclosed.fal", "#macro m 0\n")
+        write("bad.fal", '#include "unclosed.fal"\n')
+        check("in included file", errors("bad.fal", modules),
+              [("unclosed.fal", 1, "Missing `#endm` declaration for declared macro")])
+        write("typo.fal", "NOP\nNOP\n: NOP\n")
+        write("short.fal", '#include "typo.fal"\nNOP\n')
+        check("tokenizer error in included file", errors("short.fal", modules),
+              [("typo.fal", 3, "Missing label")])
+        write("twice.fal", '#include "macros.fal"\n#macro inc 1\n#endm\n')
+        check("macro twice", errors("twice.fal", modules),
+              [("macros.fal", 1, "Macro name must be unique, `inc` was already defined")])
+        write("in_macro.fal", '#macro m 0\n#include "macros.fal"\n#endm\n')
+        check("in macro", errors("in_macro.fal", modules), [("in_macro.fal", 2, "Can't include a file within a macro")])
+
+    if test_error_count == 0:
+        print("All tests succeeded")
+    else:
+        print("{} test{} failed".format(test_error_count, "" if test_error_count == 1 else "s"))
+
+
+if __name__ == "__main__":
+    _test()
@@ -1,107 +1,146 @@
 # takes a list of instructions and generates list of signals for the constant combinators PROM
 
 
+import instrumentation
 import integer_literal as int_l
 import registers
-from exceptions import show_syntax_error, show_warning_one_line
+from exceptions import AssemblyError, Diagnostic, raise_errors, show_syntax_error, show_warning_one_line
 from instruction import Instruction
 from opcode_map import opcodes
+from opcode_tables import BOTH, IMM, OPCODE_ENCODINGS, REG, encode
 from operand_type import OperandType
 
 
-def inst_to_signals(instructions):
+@instrumentation.phase_function("inst_to_signals")
+def inst_to_signals(instructions, signal_cache=None):
+    """
+    signal_cache is an optional dict of (opcode, operand texts) => signals of a resolved instruction,
+    instructions found in it are not encoded again, new instructions are added to it.
+    Every instruction is checked, the errors of all of them are raised together.
+    """
     const_comb_signals = list()
+    errors = list()
 
     # Warning checks, check if SP is written to / initialized before using push or pop
     sp_written = False
     opcodes_ordered = list(opcodes)  # opcodes is ordered dict
-    alu_opcodes = opcodes_ordered[opcodes_ordered.index("ALU"):opcodes_ordered.index("XOR")]
+    alu_opcodes = set(opcodes_ordered[opcodes_ordered.index("ALU"):opcodes_ordered.index("XOR")])
 
     for inst in instructions:
         assert isinstance(inst, Instruction)
-        opcode = inst.opcode.text
-        if opcode.upper() not in opcodes:
-            show_syntax_error("Unknown opcode {}".format(opcode), inst.opcode)
+        opcode = inst.opcode.text.upper()
+        opcode_encoding = OPCODE_ENCODINGS.get(opcode)
+        if opcode_encoding is None:
+            errors.append(Diagnostic("SyntaxError", "Unknown opcode {}".format(inst.opcode.text), inst.opcode))
+            continue
 
-        if opcode.upper() == "LOAD" or opcode.upper() in alu_opcodes:
+        if opcode == "LOAD" or opcode in alu_opcodes:
             if inst.operands[0].text == "SP":
                 sp_written = True
-        elif opcode.upper() in ["PUSH", "POP"] and not sp_written:
-            show_warning_one_line(opcode.upper() + " used before stack pointer initialized. Undefined behavior.", inst.opcode)
+        elif opcode in ["PUSH", "POP"] and not sp_written:
+            show_warning_one_line(opcode + " used before stack pointer initialized. Undefined behavior.", inst.opcode)
             sp_written = True  # Only show one warning
 
-        control_signals, encoding = opcodes[opcode.upper()]()
-        instruction_signals = iterate_operands(inst, control_signals, encoding)
+        if signal_cache is not None:
+            key = (opcode,) + tuple(t.text for t in inst.operands)
+            if key in signal_cache:
+                const_comb_signals.append(signal_cache[key])
+                continue
+
+        try:
+            instruction_signals = encode_operands(inst, opcode_encoding)
+        except AssemblyError as e:
+            errors.extend(e.diagnostics)
+            continue
+        if signal_cache is not None:
+            signal_cache[key] = instruction_signals
 
         const_comb_signals.append(instruction_signals)
 
+    raise_errors(errors)
     return const_comb_signals
 
 
-def iterate_operands(inst: Instruction, sig_dict, encoding):
-    result_signals = dict()
-    result_signals.update(sig_dict)
+def encode_operands(inst: Instruction, opcode_encoding):
+    """The signals of an instruction, from the layout of its operand forms, see opcode_tables"""
     operands = extract_operands(inst.operands)
-    if len(operands) != len(encoding):
+    operand_types = opcode_encoding.operand_types
+    if len(operands) != len(operand_types):
         t = inst.opcode
-        show_syntax_error("Incorrect number of operands, was {} but expected {}".format(len(operands), len(encoding)),
-                          t)
-    for i, e in enumerate(operands):
-        operand_signals = get_signals_by_operand(e, encoding[i])
-        result_signals.update(operand_signals)
-    return result_signals
-
-
-def get_signals_by_operand(operand, operand_type_w_signals):
-    operand_dict = dict()
-    operand_type = operand_type_w_signals[0]
-    signal_dict = operand_type_w_signals[1]
-    if operand_type == OperandType.IMMEDIATE:
-        val = immediate_from_operand(operand)
-        operand_dict.update(replace_val_in_dict(signal_dict, val))
-    elif operand_type == OperandType.REGISTER:
-        val = register_from_operand(operand)
-        operand_dict.update(replace_val_in_dict(signal_dict, val))
-    elif operand_type in [OperandType.REG_OR_IMM, OperandType.REG_OR_LABEL]:
-        # label is now a value, so same logic as register / imm
-        # Must see if operand has register or value
-        last_signal_dict = operand_type_w_signals[2]
-        if int_l.is_number_or_literal(operand.text):
-            val = immediate_from_operand(operand)
-            operand_dict.update(replace_val_in_dict(last_signal_dict, val))
-        else:
-            val = register_from_operand(operand)
-            operand_dict.update(replace_val_in_dict(signal_dict, val))
-    elif operand_type == OperandType.REG_OR_IMM_OR_BOTH:
-        # operand is a list, check length
-        last_signal_dict = operand_type_w_signals[2]
-        if len(operand) == 2:
-            # both reg and imm
-            reg = register_from_operand(operand[0])
-            imm = immediate_from_operand(operand[1])
-            operand_dict.update(replace_val_in_dict(signal_dict, reg))
-            operand_dict.update(replace_val_in_dict(last_signal_dict, imm))
-        elif len(operand) == 1:
-            # must check if operand is register or immediate value
-            if int_l.is_number_or_literal(operand[0].text):
-                val = immediate_from_operand(operand[0])
-                operand_dict.update(replace_val_in_dict(last_signal_dict, val))
-            else:
-                val = register_from_operand(operand[0])
-                operand_dict.update(replace_val_in_dict(signal_dict, val))
-        else:
-            raise Exception("Unknown error: Extracted bracket operand has no length")
-    return operand_dict
+        show_syntax_error("Incorrect number of operands, was {} but expected {}"
+                          .format(len(operands), len(operand_types)), t)
+    values = list()
+    forms = tuple([parse(operand, values)
+                   for operand, parse in zip(operands, _opcode_parsers[opcode_encoding.opcode])])
+    return encode(opcode_encoding.layouts[forms], values)
+
+
+# Each operand parser appends the values of an operand to values, and returns the form of the operand
+
+def immediate_operand(operand, values):
+    values.append(immediate_from_operand(operand))
+    return IMM
+
+
+def register_operand(operand, values):
+    values.append(register_from_operand(operand))
+    return REG
+
+
+def register_or_immediate(operand, values):
+    # label is now a value, so same logic as register / imm
+    # a register name is never a number, so numbers are only parsed once
+    # (resolved labels can be ints)
+    if isinstance(operand.text, str):
+        val = operand.text.upper()
+        if val in registers.register_dict:
+            values.append(registers.register_dict[val])
+            return REG
+    num = int_l.parse_number_or_literal(operand.text)
+    if num is None:
+        show_syntax_error("Unknown register " + str(operand.text), operand)
+    values.append(checked_range(num, operand))
+    return IMM
+
+
+def bracket_operand(operand, values):
+    # operand is a list, check length
+    if len(operand) == 2:
+        # both reg and imm
+        values.append(register_from_operand(operand[0]))
+        values.append(immediate_from_operand(operand[1]))
+        return BOTH
+    elif len(operand) == 1:
+        return register_or_immediate(operand[0], values)
+    else:
+        raise Exception("Unknown error: Extracted bracket operand has no length")
+
+
+_operand_parsers = {
+    OperandType.IMMEDIATE: immediate_operand,
+    OperandType.REGISTER: register_operand,
+    OperandType.REG_OR_IMM: register_or_immediate,
+    OperandType.REG_OR_LABEL: register_or_immediate,
+    OperandType.REG_OR_IMM_OR_BOTH: bracket_operand,
+}
+
+# operand parsers of each opcode
+_opcode_parsers = {opcode: tuple(_operand_parsers[t] for t in opcode_encoding.operand_types)
+                   for opcode, opcode_encoding in OPCODE_ENCODINGS.items()}
 
 
 def immediate_from_operand(operand):
     val = operand.text
-    if not int_l.is_number_or_literal(val):
+    num = int_l.parse_number_or_literal(val)
+    if num is None:
         show_syntax_error("invalid number {}, must be on format [-][0x|0b]nnnn".format(val), operand)
-    num = int_l.to_number_or_literal(val)
+    return checked_range(num, operand)
+
+
+def checked_range(num, operand):
     if not int_l.verify_number_range(num):
-        show_syntax_error("Immediate number outside signed 32-bit range. Must be within -2^31..2^31 -1. Was: " + num,
-                          operand)
+        show_syntax_error("Immediate number outside signed 32-bit range. Must be within -2^31..2^31 -1. Was: " +
+                          str(num), operand)
     return num
 
 
@@ -112,13 +151,6 @@ def register_from_operand(operand):
     return registers.register_dict[val.upper()]
 
 
-def replace_val_in_dict(sym_d, val):
-    for key in sym_d:
-        if sym_d[key] == "var":
-            sym_d[key] = val
-    return sym_d
-
-
 def extract_operands(operand_tokens):
     """
     Takes in a list of tokens, and extracts the operands
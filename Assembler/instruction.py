@@ -2,6 +2,8 @@
 
 
 class Instruction:
-    def __init__(self, opcode, operands):
+    def __init__(self, opcode, operands, label_operands=()):
         self.opcode = opcode
         self.operands = operands
+        # indexes of the operands which were labels, now program addresses, see peephole.optimize
+        self.label_operands = set(label_operands)
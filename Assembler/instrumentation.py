@@ -0,0 +1,174 @@
+# Instrumentation of the phases of the assembler
+# The pipeline marks its phases with phase(), and counts what it processed with count().
+# Nothing is measured until a hook is added, like a Profiler, so the marks cost next to nothing otherwise.
+# Hooks and phases belong to the context they were added in, like a thread, so each thread is measured on its own.
+
+import contextlib
+import contextvars
+import functools
+import time
+import tracemalloc
+
+_hooks = contextvars.ContextVar("instrumentation_hooks", default=())
+_phases = contextvars.ContextVar("instrumentation_phases", default=())  # names of the active phases, innermost last
+
+
+class PhaseHook:
+    """Base class of the hooks, called for each phase being entered and left, and each count"""
+
+    def phase_start(self, name):
+        pass
+
+    def phase_end(self, name, seconds):
+        pass
+
+    def count(self, phase, key, n):
+        pass
+
+
+def add_hook(hook):
+    """Adds the hook to the current context, it is called for the phases of this thread only"""
+    _hooks.set(_hooks.get() + (hook,))
+
+
+def remove_hook(hook):
+    hooks = list(_hooks.get())
+    hooks.remove(hook)
+    _hooks.set(tuple(hooks))
+
+
+@contextlib.contextmanager
+def hooked(hook):
+    """Adds the hook for the duration of the block"""
+    token = _hooks.set(_hooks.get() + (hook,))
+    try:
+        yield hook
+    finally:
+        _hooks.reset(token)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Marks the block as a phase, phases can be nested and entered many times"""
+    hooks = _hooks.get()
+    if len(hooks) == 0:
+        yield
+        return
+    for hook in hooks:
+        hook.phase_start(name)
+    token = _phases.set(_phases.get() + (name,))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _phases.reset(token)
+        for hook in reversed(hooks):
+            hook.phase_end(name, seconds)
+
+
+def phase_function(name):
+    """Decorator, each call of the function is a phase"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if len(_hooks.get()) == 0:
+                return func(*args, **kwargs)
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_function(name, func):
+    """func, or if there are hooks, a wrapper making each call a phase. For functions called in a loop."""
+    if len(_hooks.get()) == 0:
+        return func
+    return phase_function(name)(func)
+
+
+def count(key, n):
+    """Adds n to a count (tokens, instructions etc) of the innermost phase"""
+    hooks = _hooks.get()
+    if len(hooks) == 0:
+        return
+    active_phases = _phases.get()
+    if len(active_phases) == 0:
+        return
+    for hook in hooks:
+        hook.count(active_phases[-1], key, n)
+
+
+class PhaseStats:
+    def __init__(self, parent):
+        self.parent = parent  # name of the phase this one ran within, the first time
+        self.seconds = 0.0
+        self.calls = 0
+        self.counts = dict()
+        self.peak_memory = 0  # bytes allocated above the memory in use when the phase started, at most
+
+    def to_dict(self):
+        result = {"parent": self.parent, "seconds": self.seconds, "calls": self.calls, "counts": self.counts}
+        if self.peak_memory is not None:
+            result["peak_memory"] = self.peak_memory
+        return result
+
+
+class Profiler(PhaseHook):
+    """
+    Collects the wall time, number of calls, counts and (with trace_memory) tracemalloc peak of each phase.
+    Tracing memory makes everything slower, the times are best taken without it.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = dict()  # name => PhaseStats, in order of the first call
+        self.stack = list()  # [name, memory at the start, peak so far] of the active phases
+        self.started_tracing = False
+        self.start = time.perf_counter()
+
+    def phase_start(self, name):
+        if name not in self.phases:
+            self.phases[name] = PhaseStats(self.stack[-1][0] if len(self.stack) > 0 else None)
+        memory = 0
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            memory, peak = tracemalloc.get_traced_memory()
+            if len(self.stack) > 0:
+                # the peak is reset for this phase, keep the one of the phase it runs within
+                self.stack[-1][2] = max(self.stack[-1][2], peak)
+            tracemalloc.reset_peak()
+        self.stack.append([name, memory, memory])
+
+    def phase_end(self, name, seconds):
+        name, start_memory, peak = self.stack.pop()
+        stats = self.phases[name]
+        stats.seconds += seconds
+        stats.calls += 1
+        if self.trace_memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            stats.peak_memory = max(stats.peak_memory, peak - start_memory)
+            if len(self.stack) > 0:
+                self.stack[-1][2] = max(self.stack[-1][2], peak)
+            tracemalloc.reset_peak()
+        else:
+            stats.peak_memory = None
+
+    def count(self, phase, key, n):
+        counts = self.phases[phase].counts
+        counts[key] = counts.get(key, 0) + n
+
+    def close(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def report(self):
+        """The statistics of each phase as a dict, ready for json.dump"""
+        return {
+            "total_seconds": time.perf_counter() - self.start,
+            "trace_memory": self.trace_memory,
+            "phases": {name: stats.to_dict() for name, stats in self.phases.items()},
+        }
@@ -2,32 +2,22 @@
 
 
 def is_number_or_literal(n):
-    prefix = str(n).lower()
-    if prefix.startswith("0x") or prefix.startswith("-0x"):
-        try:
-            int(n, base=16)
-            return True
-        except ValueError:
-            return False
-    elif prefix.startswith("0b") or prefix.startswith("-0b"):
-        try:
-            int(n, base=2)
-            return True
-        except ValueError:
-            return False
-    else:
-        try:
-            int(n)
-            return True
-        except ValueError:
-            return False
+    return parse_number_or_literal(n) is not None
+
+
+def parse_number_or_literal(n):
+    """The value of a number or literal, None if n is neither"""
+    try:
+        return to_number_or_literal(n)
+    except ValueError:
+        return None
 
 
 def to_number_or_literal(n):
-    prefix = str(n).lower()
-    if prefix.startswith("0x") or prefix.startswith("-0x"):
+    prefix = str(n)[:3].lower()
+    if prefix.startswith(("0x", "-0x")):
         return int(n, base=16)
-    elif prefix.startswith("0b") or prefix.startswith("-0b"):
+    elif prefix.startswith(("0b", "-0b")):
         return int(n, base=2)
     else:
         return int(n)
@@ -1,5 +1,6 @@
 # label class and label related functions
 
+from bisect import bisect_right
 from exceptions import ParseFileError, AsmSyntaxError
 
 
@@ -17,7 +18,7 @@ def find_numeric_labels(labels, digit, pc_adr):
     Linear search through list of numeric labels.
     List is assumed to be sorted by PC address.
     """
-    # Note to self: Might implement binary search if better performance is required
+    # For many lookups, build a NumericLabelIndex once instead
     result = dict()
     back = None
     forward = None
@@ -42,6 +43,44 @@ def find_numeric_labels(labels, digit, pc_adr):
     return result
 
 
+class NumericLabelIndex:
+    """
+    The numeric labels grouped by digit, each group sorted by PC address.
+    Built once, then labels are found by binary search.
+    """
+    def __init__(self, labels):
+        self.labels = dict()  # digit => list of labels
+        self.addresses = dict()  # digit => list of PC addresses, same order as labels
+        for label in labels:
+            assert isinstance(label, NumericLabel)
+            digit_labels = self.labels.setdefault(label.digit, list())
+            digit_addresses = self.addresses.setdefault(label.digit, list())
+            if len(digit_labels) > 0 and digit_labels[-1].pc_adr > label.pc_adr:
+                prev_label = digit_labels[-1]
+                error_txt = "List of numeric labels not in order (by address). " \
+                            "Previous: [{}: {}], current: [{}: {}]" \
+                            .format(prev_label.digit, prev_label.pc_adr, label.digit, label.pc_adr)
+                raise ParseFileError(error_txt)
+            digit_labels.append(label)
+            digit_addresses.append(label.pc_adr)
+
+    def find_forward_label(self, digit, pc_adr):
+        """The first label with the digit after pc_adr"""
+        addresses = self.addresses.get(digit, [])
+        i = bisect_right(addresses, pc_adr)
+        if i == len(addresses):
+            raise AsmSyntaxError("No forward label found.")
+        return self.labels[digit][i]
+
+    def find_back_label(self, digit, pc_adr):
+        """The last label with the digit at or before pc_adr"""
+        addresses = self.addresses.get(digit, [])
+        i = bisect_right(addresses, pc_adr)
+        if i == 0:
+            raise AsmSyntaxError("No back label found.")
+        return self.labels[digit][i - 1]
+
+
 def find_forward_label(labels, digit, pc_adr):
     forward = find_numeric_labels(labels, digit, pc_adr)["forward"]
     if forward is None:
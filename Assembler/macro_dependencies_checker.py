@@ -1,6 +1,5 @@
 # Takes in a dictionary of macroes, checks if they have cyclic dependencies
 
-import time
 
 from exceptions import show_parsing_error
 
@@ -54,7 +53,6 @@ def check_dependencies(macros, verbose=False):
         for name in deps:
             print(name + ": " + (" ".join(deps[name]) if len(deps[name]) > 1 else "None") + ", ", end="")
         print()
-        time.sleep(0.005)
 
     # Use DFS on all nodes to detect cyclic dependencies
     for m_key in wrapped_macros:
@@ -0,0 +1,50 @@
+# Takes in lines of tokens and a table of macros, streams out the lines with every macro call expanded
+
+import constants
+from macro import Macro
+from exceptions import show_syntax_error
+
+
+def expand_macros(lines, macros):
+    """
+    Generator, yields the lines of tokens with all macro calls replaced by the macro contents.
+    Works on a stack of line iterators, so each call site is expanded exactly once,
+    and expanded lines are never rescanned.
+    """
+    stack = [iter(lines)]
+    while len(stack) > 0:
+        line = next(stack[-1], None)
+        if line is None:
+            # exhausted the source or a macro body
+            stack.pop()
+            continue
+        m = macros.get(line[0].text)
+        if m is None:
+            yield line
+            continue
+        assert isinstance(m, Macro)
+        if len(stack) > constants.MAX_MACRO_DEPTH:
+            raise Exception("At depth {}, reached max macro depth. Misusing macros are we?".format(len(stack)))
+        if len(line) != 1 + m.param_count:
+            show_syntax_error("Invalid number of macro parameters. Macro expects {}, got {}"
+                              .format(m.param_count, len(line) - 1), line[0])
+        # body lines are expanded lazily, any macro call within is pushed on top of the stack
+        stack.append(macro_body(m, line[1:]))
+
+
+def macro_body(m, params):
+    """Generator, yields a copy of each line in the macro body with parameters replaced"""
+    for lines in m.lines_of_inst:
+        line = list()
+        for token in lines:
+            new_token = token.copy()
+            line.append(new_token)
+            if new_token.text.startswith("$"):
+                try:
+                    num = int(new_token.text[1:])
+                    if num > len(params) - 1 or num < 0:
+                        raise ValueError
+                    new_token.text = params[num].text
+                except ValueError:
+                    show_syntax_error("Parameter must have valid argument index", token)
+        yield line
@@ -0,0 +1,29 @@
+# Estimated cost of each opcode in CPU cycles, for cost_analyzer
+# By the kind of instruction (its copper-plate signal, see opcode_map), the table can be changed per opcode.
+# These are estimates to rank code by, a taken branch costs the same as one not taken.
+
+from collections import OrderedDict
+
+from emulator import KIND_ALU, KIND_BRANCH, KIND_CLEAR, KIND_HALT_EXIT, KIND_HLT, KIND_LOAD, KIND_NOP, KIND_POP, \
+    KIND_PUSH, KIND_STORE
+from opcode_map import opcodes
+
+KIND_CYCLES = {
+    KIND_HLT: 1,
+    KIND_NOP: 1,
+    KIND_STORE: 2,  # the address, then the write to RAM
+    KIND_LOAD: 2,  # the address, then the read from RAM
+    KIND_HALT_EXIT: 1,
+    KIND_BRANCH: 2,  # the next address is known one cycle later
+    KIND_ALU: 1,
+    KIND_CLEAR: 1,
+    KIND_PUSH: 2,  # a STORE and the decrement of SP
+    KIND_POP: 2,  # a LOAD and the increment of SP
+}
+
+
+def _cycles(opcode):
+    return KIND_CYCLES[opcodes[opcode]()[0].get("copper-plate", KIND_HLT)]
+
+
+cycle_costs = OrderedDict((opcode, _cycles(opcode)) for opcode in opcodes)  # opcode => cycles
@@ -0,0 +1,87 @@
+# The encodings of opcode_map, compiled once into immutable tables
+# For each opcode and each choice of operand forms (register, immediate or both), the layout gives the
+# signal names in the order inst_to_signals sets them, the fixed values and which signals take operand values.
+
+import itertools
+from types import MappingProxyType
+from typing import NamedTuple
+
+from opcode_map import opcodes
+from operand_type import OperandType
+
+# forms of an operand
+REG = "reg"
+IMM = "imm"
+BOTH = "both"  # [register, immediate]
+
+# forms each operand type can take, with the signal dicts of opcode_map each form uses
+_OPERAND_FORMS = {
+    OperandType.REGISTER: ((REG, (0,)),),
+    OperandType.IMMEDIATE: ((IMM, (0,)),),
+    OperandType.REG_OR_IMM: ((REG, (0,)), (IMM, (1,))),
+    OperandType.REG_OR_LABEL: ((REG, (0,)), (IMM, (1,))),
+    OperandType.REG_OR_IMM_OR_BOTH: ((REG, (0,)), (IMM, (1,)), (BOTH, (0, 1))),
+}
+
+
+class SignalLayout(NamedTuple):
+    forms: tuple  # form of each operand
+    names: tuple  # signal names, in order
+    values: tuple  # value of each signal, None for those set from an operand
+    slots: tuple  # (signal name, index into the operand values) of the signals set from an operand
+
+
+class OpcodeEncoding(NamedTuple):
+    opcode: str
+    operand_types: tuple
+    layouts: MappingProxyType  # tuple of operand forms => SignalLayout
+
+
+def compile_layout(control_signals, operand_dicts, forms):
+    """
+    The layout of one choice of forms. operand_dicts has the signal dicts of each operand used by its form.
+    Operand values are numbered in operand order, a BOTH operand has two values, register then immediate.
+    Later signals replace the value, but keep the place, of earlier ones, like dict.update in iterate_operands.
+    """
+    signals = dict(control_signals)
+    slot = 0
+    for signal_dicts in operand_dicts:
+        for signal_dict in signal_dicts:
+            for name, value in signal_dict.items():
+                signals[name] = ("var", slot) if value == "var" else value
+            slot += 1
+    names = tuple(signals)
+    values = tuple(None if isinstance(v, tuple) else v for v in signals.values())
+    slots = tuple((name, v[1]) for name, v in signals.items() if isinstance(v, tuple))
+    return SignalLayout(tuple(forms), names, values, slots)
+
+
+def compile_opcode(opcode, factory):
+    control_signals, encoding = factory()
+    operand_types = tuple(operand[0] for operand in encoding)
+    choices = list()
+    for operand in encoding:
+        if operand[0] not in _OPERAND_FORMS:
+            raise ValueError("Unknown operand type {} of {}".format(operand[0], opcode))
+        choices.append([(form, [operand[1 + i] for i in dict_indexes])
+                        for form, dict_indexes in _OPERAND_FORMS[operand[0]]])
+    layouts = dict()
+    for choice in itertools.product(*choices):
+        forms = tuple(form for form, signal_dicts in choice)
+        layouts[forms] = compile_layout(control_signals, [signal_dicts for form, signal_dicts in choice], forms)
+    return OpcodeEncoding(opcode, operand_types, MappingProxyType(layouts))
+
+
+def compile_opcodes():
+    return MappingProxyType({opcode: compile_opcode(opcode, factory) for opcode, factory in opcodes.items()})
+
+
+OPCODE_ENCODINGS = compile_opcodes()
+
+
+def encode(layout, operand_values):
+    """The signals of an instruction with the given layout and operand values"""
+    signals = dict(zip(layout.names, layout.values))
+    for name, slot in layout.slots:
+        signals[name] = operand_values[slot]
+    return signals
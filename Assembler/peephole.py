@@ -0,0 +1,344 @@
+# Optional peephole optimizer, run between token_parser and inst_to_signals
+# Short sequences of instructions are rewritten by the rules of a table, until no rule applies,
+# and the label addresses are remapped after each round of removals.
+# Code addresses are assumed to come from labels and branch immediates (like PUSH 1f, B 5),
+# a register branch to an address built from plain numbers may go astray.
+# Memory at and below the stack pointer is assumed unused after a POP, see push_pop.
+
+from collections import OrderedDict
+
+import registers as reg
+from blueprint_generator import ROM_ROW_ENTITY_NAMES
+from emulator import KIND_ALU, KIND_BRANCH, KIND_HALT_EXIT, KIND_HLT
+from insr_to_signals import extract_operands
+from instruction import Instruction
+from integer_literal import parse_number_or_literal
+from opcode_map import opcodes
+from tokenizer import Token, TokenType
+
+rules = OrderedDict()  # name => (number of instructions, rule function)
+
+
+def rule(name, length):
+    """Add function to the rule table, it is called with `length` instructions, see optimize"""
+    return lambda func: rules.setdefault(name, (length, func))
+
+
+def _kind(opcode):
+    return opcodes[opcode]()[0].get("copper-plate", KIND_HLT)
+
+
+_flag_writers = {op for op in opcodes if _kind(op) == KIND_ALU}  # set the Z and N flags read by BZ and BN
+_branches = {op for op in opcodes if _kind(op) == KIND_BRANCH}
+_halts = {op for op in opcodes if _kind(op) in (KIND_HLT, KIND_HALT_EXIT)}
+
+# ALU opcodes with an operand value leaving the other operand as it is
+_identities = {"ADD": 0, "SUB": 0, "OR": 0, "XOR": 0, "ASR": 0, "LSL": 0, "MUL": 1, "DIV": 1, "AND": -1}
+_commutative = {"ADD", "OR", "XOR", "MUL", "AND"}
+_fixed_registers = {"SP", "PC"}  # changed by other instructions, or by reading them, left alone
+
+
+class RuleContext:
+    """What a rule may ask about the program around the instructions it is given"""
+
+    def __init__(self, instructions, address, length):
+        self.instructions = instructions
+        self.address = address  # of the first instruction given to the rule
+        self.length = length
+
+    def flags_unused(self):
+        """
+        Whether the Z and N flags after the instructions are set again before any branch reads them.
+        Only the instructions up to the next branch are looked at.
+        """
+        for inst in self.instructions[self.address + self.length:]:
+            op = opcode(inst)
+            if op in _flag_writers or op in _halts:
+                return True
+            if op in _branches:
+                return False
+        return True
+
+
+class OptimizerReport:
+    """Counts of the rules applied, and the size of the program before and after"""
+
+    def __init__(self, instructions_before):
+        self.instructions_before = instructions_before
+        self.instructions_after = instructions_before
+        self.applied = OrderedDict()  # rule name => times applied
+        self.rounds = 0
+
+    def __str__(self):
+        saved = self.instructions_before - self.instructions_after
+        text = "Optimizer: {} -> {} instructions, saved {} ROM rows ({} combinators) and {} cycles per pass".format(
+            self.instructions_before, self.instructions_after, saved, saved * len(ROM_ROW_ENTITY_NAMES), saved)
+        if len(self.applied) > 0:
+            text += " (" + ", ".join("{} {}x".format(name, n) for name, n in self.applied.items()) + ")"
+        return text
+
+
+def opcode(inst):
+    return inst.opcode.text.upper()
+
+
+def operands(inst):
+    """The operands of an instruction, without the commas, a bracket group as a list of its operands"""
+    return extract_operands(inst.operands)
+
+
+def register(operand):
+    """The register name of an operand, None if it is not a register"""
+    if isinstance(operand, list) or not isinstance(operand.text, str):
+        return None
+    text = operand.text.upper()
+    return text if text in reg.register_dict else None
+
+
+def immediate(operand):
+    """The value of an immediate operand, None if it is not a number"""
+    if isinstance(operand, list):
+        return None
+    return parse_number_or_literal(operand.text)
+
+
+def branch_targets(instructions):
+    """Addresses branched to, or taken from labels (return addresses etc)"""
+    targets = set()
+    for inst in instructions:
+        for k in address_operands(inst):
+            targets.add(immediate(inst.operands[k]))
+    return targets
+
+
+def address_operands(inst):
+    """Indexes into inst.operands of the tokens holding program addresses, labels and branch immediates"""
+    indexes = set(inst.label_operands)
+    if opcode(inst) in _branches:
+        branch_operands = operands(inst)
+        if len(branch_operands) == 1 and immediate(branch_operands[0]) is not None:
+            indexes.add(next(k for k, t in enumerate(inst.operands) if t is branch_operands[0]))
+    return indexes
+
+
+def optimize(instructions, rule_table=None):
+    """
+    Applies the rules until none applies, returns the new list of instructions and an OptimizerReport.
+    A rule gets the instructions at some address and a RuleContext, and returns their replacement, or None.
+    Instructions branched to can only be the first of the instructions given to a rule.
+    """
+    if rule_table is None:
+        rule_table = rules
+    report = OptimizerReport(len(instructions))
+    changed = True
+    while changed:
+        changed = False
+        targets = branch_targets(instructions)
+        new_instructions = list()
+        new_address = dict()  # old address => new address
+        i = 0
+        while i < len(instructions):
+            new_address[i] = len(new_instructions)
+            for name, (length, func) in rule_table.items():
+                window = instructions[i:i + length]
+                if len(window) < length or any(i + k in targets for k in range(1, length)):
+                    continue
+                replacement = func(window, RuleContext(instructions, i, length))
+                if replacement is not None:
+                    report.applied[name] = report.applied.get(name, 0) + 1
+                    new_instructions += replacement
+                    i += length
+                    changed = True
+                    break
+            else:
+                new_instructions.append(instructions[i])
+                i += 1
+        new_address[len(instructions)] = len(new_instructions)
+        if changed:
+            instructions = [remap_addresses(inst, new_address) for inst in new_instructions]
+            report.rounds += 1
+    report.instructions_after = len(instructions)
+    return instructions, report
+
+
+def remap_addresses(inst, new_address):
+    """The instruction with its address operands changed to the new addresses, copied if any changed"""
+    operands = list(inst.operands)
+    changed = False
+    for k in address_operands(inst):
+        address = immediate(operands[k])
+        if address in new_address and new_address[address] != address:
+            operands[k] = operands[k].copy()
+            operands[k].text = str(new_address[address])
+            changed = True
+    if not changed:
+        return inst
+    return Instruction(inst.opcode, operands, inst.label_operands)
+
+
+def replaced(inst, new_opcode, new_operands, label_operands=()):
+    """
+    A new instruction in place of inst, with the opcode token of inst and the operand tokens, separated by commas.
+    label_operands are the indexes of the operands which were labels, in new_operands.
+    """
+    opcode_token = inst.opcode.copy()
+    opcode_token.text = new_opcode
+    tokens = list()
+    for operand in new_operands:
+        if len(tokens) > 0:
+            tokens.append(Token(",", TokenType.DELIMITER, operand.line, operand.str_col))
+        tokens.append(operand)
+    return Instruction(opcode_token, tokens, [2 * k for k in label_operands])
+
+
+@rule("identity operation", 1)
+def identity_operation(window, context):
+    """ADD R, R, 0, MUL R, R, 1 etc are left out, if the flags they set are not used"""
+    inst, = window
+    op = opcode(inst)
+    if op not in _identities or len(operands(inst)) != 3:
+        return None
+    target, a, b = operands(inst)
+    if register(target) is None or register(target) in _fixed_registers:
+        return None
+    identity = _identities[op]
+    if not ((register(a) == register(target) and immediate(b) == identity) or
+            (op in _commutative and immediate(a) == identity and register(b) == register(target))):
+        return None
+    return [] if context.flags_unused() else None
+
+
+@rule("branch to next", 1)
+def branch_to_next(window, context):
+    """B, BZ or BN to the next address is left out"""
+    inst, = window
+    if opcode(inst) not in _branches or len(operands(inst)) != 1:
+        return None
+    target, = operands(inst)
+    return [] if register(target) is None and immediate(target) == context.address + 1 else None
+
+
+@rule("move to itself", 1)
+def move_to_itself(window, context):
+    """MOV R, R is left out, if the flags it sets are not used"""
+    inst, = window
+    if opcode(inst) != "MOV" or len(operands(inst)) != 2:
+        return None
+    target, source = operands(inst)
+    if register(target) is None or register(target) != register(source) or register(target) in _fixed_registers:
+        return None
+    return [] if context.flags_unused() else None
+
+
+@rule("push pop", 2)
+def push_pop(window, context):
+    """PUSH x followed by POP y is MOV y, x, or nothing if x is y"""
+    push, pop = window
+    if opcode(push) != "PUSH" or opcode(pop) != "POP" or len(operands(push)) != 1 or len(operands(pop)) != 1:
+        return None
+    source, = operands(push)
+    target, = operands(pop)
+    if register(target) is None or register(target) in _fixed_registers or register(source) in _fixed_registers:
+        return None
+    if register(source) == register(target):
+        # PUSH and POP leave the flags as they are
+        return []
+    if not context.flags_unused():
+        return None
+    label_operands = [1] if len(push.label_operands) > 0 else []
+    return [replaced(pop, "MOV", [target, source], label_operands)]
+
+
+@rule("overwritten move", 2)
+def overwritten_move(window, context):
+    """MOV a, x followed by MOV a, y, the first is left out. Its flags are set again by the second."""
+    first, second = window
+    if opcode(first) != "MOV" or opcode(second) != "MOV" or len(operands(first)) != 2 or len(operands(second)) != 2:
+        return None
+    target = register(operands(first)[0])
+    if target is None or target in _fixed_registers or register(operands(second)[0]) != target or \
+            register(operands(second)[1]) == target:
+        return None
+    return [second]
+
+
+@rule("move back", 2)
+def move_back(window, context):
+    """MOV a, b followed by MOV b, a, the second is left out. Both set the flags from the same value."""
+    first, second = window
+    if opcode(first) != "MOV" or opcode(second) != "MOV" or len(operands(first)) != 2 or len(operands(second)) != 2:
+        return None
+    a, b = map(register, operands(first))
+    if a is None or b is None or a in _fixed_registers or b in _fixed_registers:
+        return None
+    second_target, second_source = map(register, operands(second))
+    return [first] if second_target == b and second_source == a else None
+
+
+def _parse(filename):
+    import contextlib
+    import io
+    from token_parser import token_parser
+    from tokenizer import tokenize_file
+    with contextlib.redirect_stderr(io.StringIO()):
+        return token_parser(tokenize_file(filename), filename)
+
+
+def _test():
+    import glob
+    import os
+    import sys
+    from emulator import Emulator
+    from insr_to_signals import inst_to_signals
+
+    print("Running test on peephole optimizer...")
+    # program, and the optimized program, without the HLTG at the end
+    cases = [
+        ("ADD R1, R1, 0\nMUL R2, 1, R2\nAND R3, R3, -1\nMOV R4, 1", ["MOV R4 , 1"]),
+        # BZ reads the flags of the ADD
+        ("ADD R1, R1, 0\nBZ 1f\nNOP\n1: NOP", ["ADD R1 , R1 , 0", "BZ 3", "NOP", "NOP"]),
+        ("ADD R1, R2, 0\nADD SP, SP, 0\nSUB R1, 0, R1", ["ADD R1 , R2 , 0", "ADD SP , SP , 0", "SUB R1 , 0 , R1"]),
+        ("B 1f\n1: MOV R1, R1\nMOV R2, 3", ["MOV R2 , 3"]),
+        ("PUSH R1\nPOP R2\nHLT", ["MOV R2 , R1", "HLT"]),
+        ("PUSH R1\nPOP R1\nCMP R1, 0\nBZ 1f\n1: NOP", ["CMP R1 , 0", "NOP"]),
+        ("PUSH 1f\nPOP R3\nMOV R1, 0\nB R3\nNOP\n1: NOP", ["MOV R3 , 4", "MOV R1 , 0", "B R3", "NOP", "NOP"]),
+        ("MOV R1, R2\nMOV R1, 5\nMOV R3, R4\nMOV R4, R3", ["MOV R1 , 5", "MOV R3 , R4"]),
+        # the label of the second instruction keeps it from being merged with the first
+        ("MOV R1, R2\n1: MOV R1, 5\nBN 1b", ["MOV R1 , R2", "MOV R1 , 5", "BN 1"]),
+        ("loop: ADD R1, R1, 0\nNOP\nDEC R2\nBZ loop", ["NOP", "DEC R2", "BZ 0"]),
+    ]
+    test_error_count = 0
+    filename = "abcdefgh_peephole_test.fal"
+    try:
+        for source, expected in cases:
+            with open(filename, "w") as f:
+                f.write(source + "\n")
+            instructions, report = optimize(_parse(filename))
+            result = [" ".join([inst.opcode.text.upper()] + [str(t.text) for t in inst.operands])
+                      for inst in instructions[:-1]]
+            if result != expected:
+                print("{!r}: optimized to {}, expected {}".format(source, result, expected), file=sys.stderr)
+                test_error_count += 1
+    finally:
+        os.remove(filename)
+
+    # the examples give the same registers and memory after a run, optimized or not
+    for filename in sorted(glob.glob("examples/demo_*.fal")):
+        if filename.endswith("_fail.fal"):
+            continue
+        instructions = _parse(filename)
+        emulators = [Emulator(inst_to_signals(instructions)), Emulator(inst_to_signals(optimize(instructions)[0]))]
+        for emu in emulators:
+            emu.run()
+        a, b = emulators
+        if (a.halt_reason, a.registers[:-1], a.memory) != (b.halt_reason, b.registers[:-1], b.memory):
+            print("{}: optimized program ran differently".format(filename), file=sys.stderr)
+            test_error_count += 1
+    if test_error_count == 0:
+        print("All tests succeeded")
+    else:
+        print("{} test{} failed".format(test_error_count, "" if test_error_count == 1 else "s"))
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,146 @@
+# Generates synthetic programs for benchmarks and tests
+# usage: python program_generator.py [-n INSTRUCTIONS] [--seed SEED] ... output file
+# The programs assemble without errors, they are not meant to be run.
+
+import argparse
+import random
+
+# kinds of statements, and how often each is picked by default
+DEFAULT_MIX = {
+    "alu": 5,  # three register operands
+    "alu_immediate": 3,  # register and immediate (or definition) operands
+    "memory": 2,  # STORE and LOAD with bracket operands
+    "branch": 1,  # to symbolic and numeric labels
+    "stack": 1,  # PUSH and POP
+    "macro": 1,  # call of one of the nested macros
+}
+
+_alu_opcodes = ["ADD", "SUB", "MUL", "AND", "OR", "XOR"]
+_branch_opcodes = ["B", "BZ", "BN"]
+
+
+def generate_program(instruction_count=1000, macro_depth=3, definition_count=10, symbolic_label_density=0.02,
+                     numeric_label_density=0.02, mix=None, seed=0):
+    """
+    Returns the source of a program with instruction_count instructions after macro expansion,
+    not counting the HLTG appended by the assembler.
+    macro_depth is the number of macros, each calling the one before it.
+    The label densities are the chance of a label before each instruction.
+    mix has a weight for each kind of statement, see DEFAULT_MIX.
+    """
+    rng = random.Random(seed)
+    mix = dict(DEFAULT_MIX if mix is None else mix)
+    if macro_depth == 0:
+        mix.pop("macro", None)
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    definitions = ["c{}".format(i) for i in range(definition_count)]
+
+    def register():
+        return "R{}".format(rng.randrange(16))
+
+    def immediate():
+        if len(definitions) > 0 and rng.random() < 0.5:
+            return rng.choice(definitions)
+        return str(rng.randrange(-1000, 1000))
+
+    lines = ["; generated by program_generator.py, seed {}".format(seed)]
+    lines += ["#def {} {}".format(name, rng.randrange(256)) for name in definitions]
+
+    # macro k calls macro k - 1, so a call of macro k expands to k + 2 instructions
+    for k in range(macro_depth):
+        lines.append("#macro m{} 1".format(k))
+        if k == 0:
+            lines.append("ADD $0, $0, 1")
+            lines.append("1: XOR $0, $0, 3")
+        else:
+            lines.append("MUL $0, $0, 3")
+            lines.append("m{} $0".format(k - 1))
+        lines.append("#endm")
+
+    symbolic_labels = ["s{}".format(i) for i in range(max(1, int(instruction_count * symbolic_label_density)))]
+    unplaced_labels = list(symbolic_labels)
+    rng.shuffle(unplaced_labels)
+    numeric_defined = set()
+    numeric_pending = set()  # digits referenced forward, but not yet defined
+
+    lines.append("MOV SP, 255")
+    emitted = 1
+    while emitted < instruction_count:
+        # labels go on a line of their own, a line can only have one label and a macro call none
+        if len(unplaced_labels) > 0 and rng.random() < symbolic_label_density:
+            lines.append(unplaced_labels.pop() + ":")
+        if rng.random() < numeric_label_density or (len(numeric_pending) > 0 and rng.random() < 0.1):
+            digit = numeric_pending.pop() if len(numeric_pending) > 0 else rng.randrange(10)
+            numeric_defined.add(digit)
+            lines.append("{}:".format(digit))
+
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "macro":
+            k = rng.randrange(macro_depth)
+            if emitted + k + 2 > instruction_count:
+                kind = "alu"
+            else:
+                lines.append("m{} {}".format(k, register()))
+                emitted += k + 2
+                continue
+        if kind == "alu":
+            statement = "{} {}, {}, {}".format(rng.choice(_alu_opcodes), register(), register(), register())
+        elif kind == "alu_immediate":
+            statement = "{} {}, {}, {}".format(rng.choice(_alu_opcodes), register(), register(), immediate())
+        elif kind == "memory":
+            if rng.random() < 0.5:
+                statement = "STORE {}, [{}, {}]".format(register(), register(), immediate())
+            else:
+                statement = "LOAD {}, [{}]".format(register(), register())
+        elif kind == "branch":
+            r = rng.random()
+            if r < 0.5:
+                target = rng.choice(symbolic_labels)
+            elif r < 0.75 and len(numeric_defined) > 0:
+                target = "{}b".format(rng.choice(sorted(numeric_defined)))
+            else:
+                digit = rng.randrange(10)
+                numeric_pending.add(digit)
+                target = "{}f".format(digit)
+            statement = "{} {}".format(rng.choice(_branch_opcodes), target)
+        else:
+            statement = "{} {}".format(rng.choice(["PUSH", "POP"]), register())
+        lines.append(statement)
+        emitted += 1
+
+    # the labels still to be defined go before the last instruction
+    lines += ["{}:".format(label) for label in unplaced_labels + sorted(numeric_pending)]
+    lines.append("NOP")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a synthetic program")
+    parser.add_argument("file_out")
+    parser.add_argument("-n", "--instructions", type=int, default=1000)
+    parser.add_argument("--macro-depth", type=int, default=3)
+    parser.add_argument("--definitions", type=int, default=10)
+    parser.add_argument("--symbolic-labels", type=float, default=0.02, help="chance of a label per instruction")
+    parser.add_argument("--numeric-labels", type=float, default=0.02, help="chance of a label per instruction")
+    parser.add_argument("--mix", default=None,
+                        help="weight of each kind of statement, like alu=5,memory=2, kinds: " + ", ".join(DEFAULT_MIX))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mix = None
+    if args.mix is not None:
+        mix = {kind: 0 for kind in DEFAULT_MIX}
+        for item in args.mix.split(","):
+            kind, weight = item.split("=")
+            if kind not in DEFAULT_MIX:
+                parser.error("unknown kind {}, choose from: {}".format(kind, ", ".join(DEFAULT_MIX)))
+            mix[kind] = float(weight)
+    with open(args.file_out, "w") as f:
+        f.write(generate_program(args.instructions, args.macro_depth, args.definitions, args.symbolic_labels,
+                                 args.numeric_labels, mix, args.seed))
+    print("Done. Program saved as " + args.file_out)
+
+
+if __name__ == "__main__":
+    main()
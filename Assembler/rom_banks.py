@@ -0,0 +1,280 @@
+# Splits the PROM of a long program into banks of a fixed number of rows, generated in parallel
+# The banks are placed side by side, every other one running upwards, so the wires from the last row of a bank
+# to the first row of the next one stay short. Or each bank becomes a blueprint of a blueprint book, without the wires
+# between banks: until the last row of each bank is wired to the first row of the next one by hand, the rows of each
+# page answer to the addresses 0 to bank_size - 1.
+# Each worker generates, encodes and compresses its bank, the compressed banks are joined into one zlib stream.
+
+import base64
+import json
+import os
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import constants
+from blueprint_generator import Blueprint, ROM_ROW_ENTITY_NAMES, get_rom_row_template, map_version, \
+    set_combinator_signals
+from blueprint_import_export import SUPP_BP_VERSION, bp_join_segments, deflate_segment
+
+DEFAULT_BANK_SIZE = 4096  # rows
+BANK_SPACING = 7  # tiles between the columns of two banks, within the reach of a circuit wire
+ROW_ENTITIES = len(ROM_ROW_ENTITY_NAMES)
+
+# positions of the entities wired to the next row, within a ROM row (arithmetic combinator, lamp, decider)
+ROM_ROW_WIRED_ENTITIES = (0, 1, 3)
+
+
+class RomBanks:
+    """
+    Settings of a banked PROM: rows per bank, a blueprint book instead of a single blueprint
+    (its pages are to be wired to each other when placed, see the module comment),
+    and the number of processes generating the banks (default all cores, 1 generates them in this process)
+    """
+
+    def __init__(self, bank_size=DEFAULT_BANK_SIZE, book=False, workers=None):
+        if bank_size < 1:
+            raise ValueError("Bank size must be positive, was {}".format(bank_size))
+        self.bank_size = bank_size
+        self.book = book
+        self.workers = workers
+
+    def bank_ranges(self, row_count):
+        """(first row, end row) of each bank"""
+        return [(start, min(start + self.bank_size, row_count)) for start in range(0, row_count, self.bank_size)]
+
+    def write(self, rom_signals, out):
+        """Writes the blueprint (or blueprint book) string of the banked PROM with the signals of each row to out"""
+        # each job gets the signals of its bank, and of the row after it
+        jobs = [(rom_signals[start:end + 1], start, end, len(rom_signals), self.bank_size, self.book)
+                for start, end in self.bank_ranges(len(rom_signals))]
+        workers = self.workers or os.cpu_count() or 1
+        if workers == 1 or len(jobs) <= 1:
+            banks = [_bank_job(job) for job in jobs]
+        else:
+            get_rom_row_template(constants.PROM_SINGLE_LINE_TEMPLATE)
+            with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=warm_up) as executor:
+                banks = list(executor.map(_bank_job, jobs))
+
+        # the JSON around the banks, split where the banks go
+        if self.book:
+            key, outer = '"blueprints": ', book_json_dict([])
+        else:
+            key, outer = '"entities": ', Blueprint().json_dict
+            outer["blueprint"]["entities"] = []
+        head, tail = json.dumps(outer).split(key + "[]")
+        segments = [compress_segment(head + key + "[")] + banks + [compress_segment("]" + tail)]
+        out.write(SUPP_BP_VERSION)
+        out.write(base64.b64encode(bp_join_segments(segments)).decode("utf-8"))
+
+
+def warm_up():
+    """Loads the PROM template, once per worker process"""
+    get_rom_row_template(constants.PROM_SINGLE_LINE_TEMPLATE)
+
+
+def compress_segment(text):
+    data = text.encode("utf-8")
+    return deflate_segment(data), zlib.adler32(data), len(data)
+
+
+def _bank_job(job):
+    return compress_segment(bank_json(*job))
+
+
+class RowTextTemplate:
+    """
+    The JSON text of a PROM row between two other rows, as literal parts and holes for what changes from row
+    to row: the entity numbers, the position and the signals of the constant combinator. Made once from rows
+    generated by Blueprint.generate_rom_entities, so it follows the PROM template, and a row filled in from
+    row_format gives the same text as json.dumps of the generated row.
+    """
+
+    HOLE = "@@hole{}@@"
+
+    def __init__(self):
+        bp = Blueprint()
+        header_entities = len(bp.entities)
+        bp.generate_rom_entities(3)
+        row = bp.entities[header_entities + ROW_ENTITIES:header_entities + 2 * ROW_ENTITIES]
+        self.base_number = row[0]["entity_number"]
+        self.holes = list()  # ("number", offset to the first entity of the row), ("x", x), ("y",) or ("filters",)
+        marked = [self.mark(e) for e in row]
+        self.parts = list()  # literal text before each hole, and after the last one
+        text = json.dumps(marked)[1:-1]
+        for n in range(len(self.holes)):
+            literal, text = text.split('"' + self.HOLE.format(n) + '"')
+            self.parts.append(literal)
+        self.parts.append(text)
+
+    def hole(self, spec):
+        self.holes.append(spec)
+        return self.HOLE.format(len(self.holes) - 1)
+
+    def mark(self, obj, key=None):
+        """A copy of the JSON with holes in place of the values changing from row to row"""
+        if isinstance(obj, dict):
+            result = dict()
+            for k, v in obj.items():
+                if k in ("entity_number", "entity_id"):
+                    result[k] = self.hole(("number", v - self.base_number))
+                elif key == "position" and k in ("x", "y"):
+                    result[k] = self.hole((k, v))
+                elif k == "filters":
+                    result[k] = self.hole(("filters",))
+                else:
+                    result[k] = self.mark(v, k)
+            return result
+        if isinstance(obj, list):
+            return [self.mark(v) for v in obj]
+        return obj
+
+    def row_format(self, x_offset):
+        """
+        The row as a format string for str.format, with the x positions moved by x_offset filled in.
+        Its fields are the entity numbers, in the order of number_offsets(), y and filters.
+        """
+        offsets = self.number_offsets()
+        text = [self.parts[0].replace("{", "{{").replace("}", "}}")]
+        for n, spec in enumerate(self.holes):
+            kind = spec[0]
+            if kind == "number":
+                text.append("{" + str(offsets.index(spec[1])) + "}")
+            elif kind == "x":
+                text.append(json.dumps(spec[1] + x_offset))
+            else:
+                text.append("{" + kind + "}")
+            text.append(self.parts[n + 1].replace("{", "{{").replace("}", "}}"))
+        return "".join(text)
+
+    def number_offsets(self):
+        """Each offset of an entity number to the first entity of the row, once"""
+        return sorted(set(spec[1] for spec in self.holes if spec[0] == "number"))
+
+
+def filters_text(signals):
+    """JSON text of the filters of a constant combinator with the signals"""
+    combinator = dict()
+    set_combinator_signals(combinator, signals)
+    return json.dumps(combinator["control_behavior"]["filters"])
+
+
+def get_row_text_template():
+    """The row text template, made on the first call"""
+    template = _row_text_templates.get(constants.PROM_SINGLE_LINE_TEMPLATE)
+    if template is None:
+        with _row_text_templates_lock:
+            template = _row_text_templates.get(constants.PROM_SINGLE_LINE_TEMPLATE)
+            if template is None:
+                template = _row_text_templates[constants.PROM_SINGLE_LINE_TEMPLATE] = RowTextTemplate()
+    return template
+
+
+_row_text_templates = dict()  # template file => RowTextTemplate
+_row_text_templates_lock = threading.Lock()
+
+
+def generated_rows(start, row_signals, next_signals=None):
+    """
+    The entities of the rows from start with the given signals, generated by Blueprint.generate_rom_entities
+    and numbered as part of the whole ROM, with the wires to the row before, and to the row after if there are
+    next_signals. From row 0, with the entities before the ROM.
+    """
+    header_entities = len(Blueprint().entities)
+    bp = Blueprint()
+    if start > 0:
+        # the first row is wired to the row before, by entity number
+        last_row = [{"entity_number": header_entities + ROW_ENTITIES * (start - 1) + k + 1}
+                    for k in ROM_ROW_WIRED_ENTITIES]
+        bp.continue_rom(start, last_row, header_entities + ROW_ENTITIES * start + 1)
+    # and the last row to the row after, generated here as well and left out
+    next_rows = 0 if next_signals is None else 1
+    bp.generate_rom_entities(len(row_signals) + next_rows)
+    bp.insert_signals(list(row_signals) + [next_signals] * next_rows)
+    return bp.entities[:len(bp.entities) - ROW_ENTITIES * next_rows]
+
+
+def bank_json(bank_signals, start, end, row_count, bank_size, book):
+    """
+    The JSON text of the bank of rows start to end of a ROM of row_count rows, within the list of entities
+    of the blueprint, or of the blueprints of the book. The first bank has the entities the ROM is wired to.
+    bank_signals has the signals of the rows of the bank, and of the row after it, if any.
+    The first and last row of the bank are generated, the rows between rendered from a RowTextTemplate.
+    """
+    header_entities = len(Blueprint().entities)
+    bank = start // bank_size
+    first_number = 1 if start == 0 else header_entities + ROW_ENTITIES * start + 1
+    last_number = header_entities + ROW_ENTITIES * end
+    # in a book, each bank is numbered from 1
+    shift = 1 - first_number if book else 0
+
+    def y(row):
+        if book:
+            return row - start
+        # odd banks run upwards, starting next to the last row of the bank before
+        return row - start if bank % 2 == 0 else bank_size - 1 - (row - start)
+
+    x_offset = 0 if book else bank * BANK_SPACING
+
+    def edge_row_text(row):
+        next_signals = bank_signals[row + 1 - start] if row + 1 < row_count else None
+        entities = generated_rows(row, [bank_signals[row - start]], next_signals)
+        for e in entities[len(entities) - ROW_ENTITIES:]:
+            e["position"]["y"] = y(row)
+            e["position"]["x"] += x_offset
+        if book:
+            # without the wires to the other banks
+            shift_entities(entities, first_number, last_number)
+        return json.dumps(entities)[1:-1]
+
+    rows = [edge_row_text(start)]
+    template = get_row_text_template()
+    row_format = template.row_format(x_offset).format
+    offsets = template.number_offsets()
+    filters = dict()  # signals => filters text, programs repeat instructions
+    for row in range(start + 1, end - 1):
+        signals = bank_signals[row - start]
+        key = tuple(signals.items())
+        if key not in filters:
+            filters[key] = filters_text(signals)
+        base_number = header_entities + ROW_ENTITIES * row + 1 + shift
+        rows.append(row_format(*[base_number + offset for offset in offsets], y=y(row), filters=filters[key]))
+    if end - 1 > start:
+        rows.append(edge_row_text(end - 1))
+    text = ", ".join(rows)
+    if not book:
+        return (", " if start > 0 else "") + text
+
+    bp = Blueprint()
+    bp.bp_dict["label"] = "Program - PROM bank {}, rows {}-{}".format(bank, start, end - 1)
+    bp.bp_dict["entities"] = []
+    head, tail = json.dumps({"index": bank, "blueprint": bp.bp_dict}).split('"entities": []')
+    return (", " if start > 0 else "") + head + '"entities": [' + text + "]" + tail
+
+
+def shift_entities(entities, first_number, last_number):
+    """
+    Numbers the entities numbered first_number to last_number from 1, and removes their wires to
+    entities outside of those numbers
+    """
+    for e in entities:
+        e["entity_number"] -= first_number - 1
+        connections = e.get("connections", dict())
+        for side in list(connections):
+            for color in list(connections[side]):
+                wires = [dict(w, entity_id=w["entity_id"] - first_number + 1) for w in connections[side][color]
+                         if first_number <= w["entity_id"] <= last_number]
+                if len(wires) > 0:
+                    connections[side][color] = wires
+                else:
+                    del connections[side][color]
+            if len(connections[side]) == 0:
+                del connections[side]
+        if "connections" in e and len(connections) == 0:
+            del e["connections"]
+
+
+def book_json_dict(blueprints):
+    """A blueprint book of the given list of {"index": i, "blueprint": blueprint}"""
+    return {"blueprint_book": {"item": "blueprint-book", "label": "Program - PROM banks", "blueprints": blueprints,
+                               "active_index": 0, "version": map_version}}
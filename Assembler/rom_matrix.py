@@ -0,0 +1,186 @@
+# The ROM as an int32 matrix, one row per instruction and one column per signal, instead of a list of signal dicts
+# Needs NumPy, which is optional for the rest of the assembler
+
+import sys
+from itertools import chain, repeat
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from opcode_map import opcodes
+
+
+def signal_registry():
+    """Every signal any opcode can set, in order of first use in opcode_map"""
+    names = dict()
+    for factory in opcodes.values():
+        control_signals, encoding = factory()
+        names.update(dict.fromkeys(control_signals))
+        for operand in encoding:
+            for signal_dict in operand[1:]:
+                names.update(dict.fromkeys(signal_dict))
+    return tuple(names)
+
+
+SIGNALS = signal_registry()
+SIGNAL_COLUMNS = {name: i for i, name in enumerate(SIGNALS)}
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("rom_matrix needs NumPy, install it with: pip install numpy")
+
+
+class RomMatrix:
+    """
+    values: int32 matrix of instructions x SIGNALS, absent signals are 0
+    layouts: int32 array, the layout of each row, an index into layout_table
+    layout_table: list of tuples of columns, the signals set in a row, in the order of the signal dict
+    The layouts keep signals set to 0 apart from absent ones, and the order of the signals,
+    so converting back gives the same signal dicts, and the same blueprint.
+    """
+
+    def __init__(self, values, layouts, layout_table):
+        require_numpy()
+        self.values = values
+        self.layouts = layouts
+        self.layout_table = layout_table
+        # mask of the columns set by each layout
+        self.layout_masks = np.zeros((max(len(layout_table), 1), len(SIGNALS)), dtype=bool)
+        for i, columns in enumerate(layout_table):
+            self.layout_masks[i, list(columns)] = True
+
+    @staticmethod
+    def from_signals(rom_signals):
+        """
+        Builds the matrix from the signal dicts of inst_to_signals. Python only looks at the distinct layouts,
+        the values of all rows are read by one np.fromiter and scattered into the matrix at once.
+        """
+        require_numpy()
+        # the signal names of each row, and an id for each distinct tuple of names
+        names_of_rows = list(map(tuple, rom_signals))
+        layout_ids = dict.fromkeys(names_of_rows)
+        for i, names in enumerate(layout_ids):
+            layout_ids[names] = i
+        try:
+            layout_table = [tuple(SIGNAL_COLUMNS[name] for name in names) for names in layout_ids]
+        except KeyError as e:
+            raise ValueError("Signal {} is not used by any opcode".format(e)) from None
+        layouts = np.fromiter(map(layout_ids.__getitem__, names_of_rows), dtype=np.int32, count=len(rom_signals))
+        matrix = RomMatrix(np.zeros((len(rom_signals), len(SIGNALS)), dtype=np.int32), layouts, layout_table)
+        rows, columns = matrix.cells()
+        matrix.values[rows, columns] = np.fromiter(chain.from_iterable(map(dict.values, rom_signals)),
+                                                   dtype=np.int32, count=len(rows))
+        return matrix
+
+    def to_signals(self):
+        """The signal dicts of each row, as inst_to_signals returns them"""
+        rows, columns = self.cells()
+        values = iter(self.values[rows, columns].tolist())
+        names = [tuple(SIGNALS[column] for column in layout) for layout in self.layout_table]
+        # each zip takes as many values as its row has names
+        return list(map(dict, map(zip, map(names.__getitem__, self.layouts.tolist()), repeat(values))))
+
+    def cells(self):
+        """Row and column of each signal set, row by row, each row in the order of its signal dict"""
+        lengths = np.array([len(layout) for layout in self.layout_table] or [0], dtype=np.int64)
+        layout_columns = np.fromiter(chain.from_iterable(self.layout_table), dtype=np.int64, count=int(lengths.sum()))
+        layout_starts = np.cumsum(lengths) - lengths
+        row_lengths = lengths[self.layouts]
+        rows = np.repeat(np.arange(len(self.layouts)), row_lengths)
+        # for each cell, the index of its column in layout_columns: the start of the row's layout, plus the position
+        # of the cell within its row
+        row_starts = np.cumsum(row_lengths) - row_lengths
+        positions = np.arange(len(rows)) + np.repeat(layout_starts[self.layouts] - row_starts, row_lengths)
+        return rows, layout_columns[positions]
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def present(self):
+        """Boolean matrix of the signals set in each row, including those set to 0"""
+        return self.layout_masks[self.layouts]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.layouts.nbytes
+
+    def column(self, name):
+        """Values of one signal in every row"""
+        return self.values[:, SIGNAL_COLUMNS[name]]
+
+    def changed_rows(self, other):
+        """Indexes of the rows that differ from the other matrix, rows past the end of either count as changed"""
+        n = min(len(self), len(other))
+        # layouts of the other matrix as indexes in this layout table, -1 if not in it
+        layout_ids = {layout: i for i, layout in enumerate(self.layout_table)}
+        translate = np.array([layout_ids.get(layout, -1) for layout in other.layout_table] + [-1], dtype=np.int32)
+        changed = np.any(self.values[:n] != other.values[:n], axis=1) | \
+            (self.layouts[:n] != translate[other.layouts[:n]])
+        return np.concatenate([np.flatnonzero(changed), np.arange(n, max(len(self), len(other)))])
+
+    def statistics(self):
+        """Number of rows, how often each signal is set, and how often each copper-plate (control) value is used"""
+        signal_use = self.present.sum(axis=0)
+        kinds, kind_counts = np.unique(self.column("copper-plate"), return_counts=True)
+        return {
+            "rows": len(self),
+            "signal_use": {name: int(n) for name, n in zip(SIGNALS, signal_use) if n > 0},
+            "control_values": {int(k): int(n) for k, n in zip(kinds, kind_counts)},
+        }
+
+    def pack(self):
+        """Sparse form (layouts, values of the set signals in row and column order), for storing big ROMs"""
+        return self.layouts.copy(), self.values[self.present]
+
+    @staticmethod
+    def unpack(layouts, packed_values, layout_table):
+        require_numpy()
+        matrix = RomMatrix(np.zeros((len(layouts), len(SIGNALS)), dtype=np.int32), layouts, layout_table)
+        matrix.values[matrix.present] = packed_values
+        return matrix
+
+
+def _test():
+    print("Running test on rom_matrix...")
+    if np is None:
+        print("NumPy not installed, skipped")
+        return
+    import glob
+    from emulator import load_program
+    test_error_count = 0
+    for filename in sorted(glob.glob("examples/demo_*.fal")):
+        if "fail" in filename:
+            continue
+        rom_signals = load_program(filename)
+        matrix = RomMatrix.from_signals(rom_signals)
+        # same signals in the same order, zero-valued signals included
+        if [list(s.items()) for s in matrix.to_signals()] != [list(s.items()) for s in rom_signals]:
+            print("{}: signals differ after the round trip".format(filename), file=sys.stderr)
+            test_error_count += 1
+        unpacked = RomMatrix.unpack(*matrix.pack(), matrix.layout_table)
+        if unpacked.to_signals() != rom_signals or len(unpacked.changed_rows(matrix)) != 0:
+            print("{}: signals differ after packing".format(filename), file=sys.stderr)
+            test_error_count += 1
+        if matrix.statistics()["rows"] != len(rom_signals):
+            print("{}: wrong row count".format(filename), file=sys.stderr)
+            test_error_count += 1
+
+    edited = [dict(s) for s in rom_signals]
+    edited[1]["signal-A"] = 7
+    edited.append({"copper-plate": 1})
+    changed = RomMatrix.from_signals(edited).changed_rows(matrix).tolist()
+    if changed != [1, len(rom_signals)]:
+        print("changed_rows gave {}".format(changed), file=sys.stderr)
+        test_error_count += 1
+    if test_error_count == 0:
+        print("All tests succeeded")
+    else:
+        print("{} test{} failed".format(test_error_count, "" if test_error_count == 1 else "s"))
+
+
+if __name__ == "__main__":
+    _test()
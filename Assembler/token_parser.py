@@ -1,19 +1,79 @@
 # Takes in a list of list of tokens, and pre-processes them into a list of instructions
 
-import sys
+import os
+
 import constants
-from tokenizer import Token, TokenType
+import instrumentation
+from include_cache import IncludeDirective, Module, module_cache
+from tokenizer import SourceLine, Token, TokenType, tokenize_lines
 from macro import Macro
 import label as lb
 from instruction import Instruction
 from macro_dependencies_checker import check_dependencies
-from exceptions import show_syntax_error, AsmSyntaxError
+from macro_expander import expand_macros
+from exceptions import show_parsing_error, show_syntax_error, show_warning, AsmSyntaxError, AssemblyError, raise_errors
+
+
+def token_parser(tokens, filename=None, included=None, modules=None):
+    """
+    filename is the file of the tokens, the files of #include are found relative to it, else to the working directory.
+    included is an optional set, the absolute paths of the included files are added to it.
+    modules is the include_cache.ModuleCache the included files are parsed into, by default the one of the process.
+    """
+    macros, program_lines = build_macro_table(tokens, filename, included, modules)
+
+    # replace all macros with the macro contents, the macro definitions themselves were left out
+    with instrumentation.phase("macro_expansion"):
+        tokens = list(expand_macros(program_lines, macros))
+        instrumentation.count("lines", len(tokens))
+
+    tokens = replace_definitions(tokens)
+    instructions = resolve_labels(tokens)
+
+    if constants.APPEND_EXITCODE_SUCCESS:
+        last_line = tokens[-1][0].file_line_num
+        fake_line = SourceLine(last_line + 1, "HLTG ; appended exit code")
+        fake_token = Token("HLTG", TokenType.OPCODE, fake_line, 0)
+        fake_line.tokens.append(fake_token)
+        halt_successfully = Instruction(fake_token, list())
+        instructions.append(halt_successfully)
+
+    return instructions
+
+
+@instrumentation.phase_function("macro_table")
+def build_macro_table(tokens, filename=None, included=None, modules=None):
+    """
+    1st pass, build a table of macros. Returns the macros, and the lines outside macro definitions,
+    with the lines of each included file in place of its #include. See token_parser for the other arguments.
+    """
+    directory = os.path.dirname(os.path.abspath(filename)) if filename is not None else os.getcwd()
+    macros, parts = scan_macros(tokens, directory)
+    program_lines = list()
+    include_stack = [os.path.abspath(filename)] if filename is not None else list()
+    seen = set()
+    try:
+        add_parts(parts, macros, program_lines, include_stack, seen, modules or module_cache, False)
+    finally:
+        # also on errors, which may come from an included file
+        if included is not None:
+            included.update(seen)
+
+    # check for macro dependencies
+    check_dependencies(macros)
+    instrumentation.count("macros", len(macros))
+    instrumentation.count("includes", len(seen))
+    return macros, program_lines
 
 
-def token_parser(tokens):
-    # 1st pass, build a table of macros
+def scan_macros(tokens, directory):
+    """
+    The macros defined in the lines of a file, and its lines outside macro definitions,
+    with an IncludeDirective for each #include, its path relative to directory
+    """
     macros = dict()
     active_macro = None
+    parts = list()
     for i, line in enumerate(tokens):
         first_token = line[0]
         assert isinstance(first_token, Token)
@@ -45,6 +105,14 @@ def token_parser(tokens):
             active_macro.token_line_end = i + 1
             macros[active_macro.name] = active_macro
             active_macro = None
+        elif first_token.text.lower() == "#include":
+            if active_macro is not None:
+                show_syntax_error("Can't include a file within a macro", first_token)
+            if len(line) != 2:
+                show_syntax_error("Include needs a declaration and a file name.\n"
+                                  "Example: `#include \"library.fal\"`", first_token)
+            path = os.path.abspath(os.path.join(directory, line[1].text.strip("\"'")))
+            parts.append(IncludeDirective(path, line[1]))
         else:
             if active_macro is not None:
                 # check for symbolic (global) labels inside the macro
@@ -54,60 +122,63 @@ def token_parser(tokens):
                                           "Use numeric (local) labels instead", token)
                 # Insert instructions as tokens into active macro
                 active_macro.lines_of_inst.append(line)
+            else:
+                parts.append(line)
     if active_macro is not None:
         show_syntax_error("Missing `#endm` declaration for declared macro", active_macro.begin_token)
+    return macros, parts
 
-    # check for macro dependencies
-    check_dependencies(macros)
 
-    # replace all macros with the macro contents
-    # remove all macro definitions from tokens
-    # traverse macros in reverse order of declaration, to preserve indexes
-    for m_key in sorted(macros, key=lambda x: macros[x].token_line_begin, reverse=True):
-        m = macros[m_key]
-        assert isinstance(m, Macro)
-        # token_line_begin and token_line_end
-        tokens = tokens[:m.token_line_begin] + tokens[m.token_line_end:]
-
-    replacement_happened = True
-    i = 0
-    while replacement_happened:
-        if i > constants.MAX_MACRO_DEPTH:
-            raise Exception("At the {}th iteration, reached max macro depth. Misusing macros are we?".format(i))
-        i += 1
-        replacement_happened = False
-        # Traverse the tokens in reverse order, while keeping own index
-        index = len(tokens) - 1
-        while index >= 0:
-            line = tokens[index]
-            if line[0].text in macros.keys():
-                m = macros[line[0].text]
-                if len(line) != 1 + m.param_count:
-                    show_syntax_error("Invalid number of macro parameters. Macro expects {}, got {}"
-                                      .format(m.param_count, len(line) - 1), line[0])
-                params = line[1:]
-                # Replace line with body of macro
-                line_replace = list()
-                for lines in m.lines_of_inst:
-                    line = list()
-                    for token in lines:
-                        new_token = token.copy()
-                        line.append(new_token)
-                        if new_token.text.startswith("$"):
-                            try:
-                                num = int(new_token.text[1:])
-                                if num > len(params) - 1 or num < 0:
-                                    raise ValueError
-                                new_token.text = params[num].text
-                            except ValueError:
-                                show_syntax_error("Parameter must have valid argument index", token)
-                    line_replace.append(line)
-                tokens = tokens[:index] + line_replace + tokens[index + 1:]
-                replacement_happened = True
-            index -= 1
-
-    # Handle definitions
+def add_parts(parts, macros, program_lines, include_stack, seen, modules, copy):
+    """
+    Adds the lines of parts to program_lines, and the lines and macros of each file included, once.
+    include_stack holds the files being included, to find cycles. The lines of modules are copied.
+    """
+    for part in parts:
+        if not isinstance(part, IncludeDirective):
+            program_lines.append([t.copy() for t in part] if copy else part)
+            continue
+        if part.path in include_stack:
+            cycle = include_stack[include_stack.index(part.path):] + [part.path]
+            show_parsing_error("Found cyclic include. Leads to infinite recursion.\n"
+                               "Cycle: " + " => ".join(map(os.path.basename, cycle)), part.token)
+        if part.path in seen:
+            # already included, by this or another file
+            continue
+        seen.add(part.path)
+        try:
+            module = modules.get(part.path, parse_module)
+        except OSError as e:
+            show_syntax_error("Can't read included file: {}".format(e.strerror), part.token)
+        for name, macro in module.macros.items():
+            if name in macros:
+                show_syntax_error("Macro name must be unique, `{}` was already defined".format(name), macro.begin_token)
+            macros[name] = macro
+        include_stack.append(part.path)
+        add_parts(module.parts, macros, program_lines, include_stack, seen, modules, True)
+        include_stack.pop()
+
+
+def parse_module(path, content):
+    """The include_cache.Module of a file included"""
+    try:
+        lines_of_tokens = tokenize_lines(content.decode("utf-8").splitlines(keepends=True))
+    except AssemblyError as e:
+        # the tokens of the lines with errors were never made, so the errors have no file yet
+        for diagnostic in e.diagnostics:
+            diagnostic.file = path
+        raise
+    for line in lines_of_tokens:
+        line[0].line.file = path
+    macros, parts = scan_macros(lines_of_tokens, os.path.dirname(path))
+    return Module(path, None, macros, parts)
+
+
+@instrumentation.phase_function("definitions")
+def replace_definitions(tokens):
+    """Handle definitions, returns the lines without the definitions"""
     definitions = dict()
+    errors = list()
     for line in tokens:
         # replace any definitions
         for t in line:
@@ -116,12 +187,17 @@ def token_parser(tokens):
 
         # add new definitions
         if line[0].text.lower() == "#def":
-            for t in line:
-                if t.t_type == TokenType.DELIMITER:
-                    show_syntax_error("Invalid symbol `{}` in definition".format(t.text), t)
-            if len(line) != 3:
-                show_syntax_error("A definition must have a declaration, a keyword, and a replacement", line[0])
+            try:
+                for t in line:
+                    if t.t_type == TokenType.DELIMITER:
+                        show_syntax_error("Invalid symbol `{}` in definition".format(t.text), t)
+                if len(line) != 3:
+                    show_syntax_error("A definition must have a declaration, a keyword, and a replacement", line[0])
+            except AssemblyError as e:
+                errors.extend(e.diagnostics)
+                continue
             definitions[line[1].text] = line[2].text
+    raise_errors(errors)
 
     # Drop any definitions
     new_tokens = list()
@@ -129,35 +205,27 @@ def token_parser(tokens):
         if line[0].text.lower() == "#def":
             continue
         new_tokens.append(line)
-    tokens = new_tokens
+    instrumentation.count("definitions", len(definitions))
+    return new_tokens
 
-    # Create instructions and handle labels
+
+@instrumentation.phase_function("labels")
+def resolve_labels(tokens):
+    """Create instructions and handle labels"""
     instructions = list()
 
     symbolic_labels = dict()
     numeric_labels = list()  # sorted by PC address
+    errors = list()
 
     for line in tokens:
         # check for labels
-        found_label = True
-        while found_label:
-            found_label = False
-            for i, t in enumerate(line):
-                if t.t_type == TokenType.LABEL_DELIMITER:
-                    if i != 1:
-                        show_syntax_error("Misplaced label colon", t)
-                    found_label = True
-                    label = line[0]
-                    label_target = len(instructions)  # Target is absolute signed PC address
-                    if lb.is_numeric_label(label.text):
-                        label_num = lb.NumericLabel(int(label.text), label_target, label.file_line_num)
-                        numeric_labels.append(label_num)
-                    else:
-                        if label.text in symbolic_labels:
-                            error_msg = "Label ´{}´ previously defined".format(label.text)
-                            show_syntax_error(error_msg, label)
-                        symbolic_labels[label.text] = label_target
-                    line = line[2:]
+        try:
+            line = take_labels(line, len(instructions), symbolic_labels, numeric_labels)
+        except AssemblyError as e:
+            # the line is left out, the following lines are still checked
+            errors.extend(e.diagnostics)
+            continue
         if len(line) == 0:
             continue
 
@@ -168,24 +236,14 @@ def token_parser(tokens):
         instructions.append(instruction)
 
     # replace each branch label with the program address
+    numeric_label_index = lb.NumericLabelIndex(numeric_labels)
     unused_labels = set(symbolic_labels.keys())
     for i, inst in enumerate(instructions):
-        for operand in inst.operands:
-            op = operand.text
-            if op in symbolic_labels:
-                unused_labels.discard(op)
-                operand.text = symbolic_labels[op]
-            elif len(op) == 2 and op[0].isdecimal() and op[1] in ["b", "f"]:
-                label_target = None
-                try:
-                    if op[1] == "b":
-                        label_target = lb.find_back_label(numeric_labels, int(op[0]), i)
-                    elif op[1] == "f":
-                        label_target = lb.find_forward_label(numeric_labels, int(op[0]), i)
-                except AsmSyntaxError as e:
-                    show_syntax_error(e.args[0], operand)
-                operand.text = str(label_target.pc_adr)
-                label_target.was_referenced = True
+        try:
+            replace_label_operands(inst, i, symbolic_labels, numeric_label_index, unused_labels)
+        except AssemblyError as e:
+            errors.extend(e.diagnostics)
+    raise_errors(errors)
 
     for numeric_label in numeric_labels:
         if not numeric_label.was_referenced:
@@ -193,18 +251,56 @@ def token_parser(tokens):
 
     if len(unused_labels) > 0:
         s = "" if len(unused_labels) == 1 else "s"
-        print("Warning: Unused label{}: {}".format(s, ", ".join(unused_labels)), file=sys.stderr)
+        show_warning("Unused label{}: {}".format(s, ", ".join(unused_labels)))
 
     # for inst in instructions:
     #     print(inst.opcode, inst.operands)
 
-    if constants.APPEND_EXITCODE_SUCCESS:
-        last_line = tokens[-1][0].file_line_num
-        fake_raw_inst = "HLTG ; appended exit code"
-        fake_token_line = list()
-        fake_token = Token("HLTG", TokenType.OPCODE, last_line + 1, fake_raw_inst, 0, fake_token_line)
-        fake_token_line.append(fake_token)
-        halt_successfully = Instruction(fake_token, list())
-        instructions.append(halt_successfully)
-
+    instrumentation.count("instructions", len(instructions))
+    instrumentation.count("labels", len(symbolic_labels) + len(numeric_labels))
     return instructions
+
+
+def take_labels(line, label_target, symbolic_labels, numeric_labels):
+    """Adds the labels at the start of the line, label_target being its PC address. Returns the rest of the line."""
+    found_label = True
+    while found_label:
+        found_label = False
+        for i, t in enumerate(line):
+            if t.t_type == TokenType.LABEL_DELIMITER:
+                if i != 1:
+                    show_syntax_error("Misplaced label colon", t)
+                found_label = True
+                label = line[0]
+                if lb.is_numeric_label(label.text):
+                    label_num = lb.NumericLabel(int(label.text), label_target, label.file_line_num)
+                    numeric_labels.append(label_num)
+                else:
+                    if label.text in symbolic_labels:
+                        error_msg = "Label ´{}´ previously defined".format(label.text)
+                        show_syntax_error(error_msg, label)
+                    symbolic_labels[label.text] = label_target
+                line = line[2:]
+    return line
+
+
+def replace_label_operands(inst, i, symbolic_labels, numeric_label_index, unused_labels):
+    """Replaces each branch label operand of the instruction at PC address i with the program address"""
+    for k, operand in enumerate(inst.operands):
+        op = operand.text
+        if op in symbolic_labels:
+            unused_labels.discard(op)
+            operand.text = symbolic_labels[op]
+            inst.label_operands.add(k)
+        elif len(op) == 2 and op[0].isdecimal() and op[1] in ["b", "f"]:
+            label_target = None
+            try:
+                if op[1] == "b":
+                    label_target = numeric_label_index.find_back_label(int(op[0]), i)
+                elif op[1] == "f":
+                    label_target = numeric_label_index.find_forward_label(int(op[0]), i)
+            except AsmSyntaxError as e:
+                show_syntax_error(e.args[0], operand)
+            operand.text = str(label_target.pc_adr)
+            label_target.was_referenced = True
+            inst.label_operands.add(k)
@@ -1,11 +1,14 @@
 # Takes in a code file, creates list of filelines where each fileline is a list of tokens
 
+import glob
 import os
+import re
 import sys
-import time
+import constants
+import instrumentation
 import label as lb
 from enum import Enum, auto
-from exceptions import show_syntax_error
+from exceptions import AssemblyError, raise_errors, show_syntax_error
 
 
 class TokenType(Enum):
@@ -18,81 +21,229 @@ class TokenType(Enum):
     OPERAND = auto()
 
 
-class Token:
-    def __init__(self, text, t_type, file_line_num, file_raw_text, file_index_start, tokens):
+class SourceLine:
+    """A line of the source file, shared by all tokens on it"""
+    __slots__ = ("number", "text", "tokens", "file")
+
+    def __init__(self, number, text, file=None):
+        self.number = number
+        self.text = text.strip("\n")
+        self.tokens = list()
+        self.file = file  # path of an included file, None in the program itself
+
+
+class BaseToken:
+    """What the tokens read from a file and the tokens copied from a macro body have in common"""
+    __slots__ = ()
+
+    @property
+    def file_line_num(self):
+        return self.line.number
+
+    @property
+    def file_raw_text(self):
+        return self.line.text
+
+    @property
+    def file_name(self):
+        return self.line.file
+
+    @property
+    def tokens(self):
+        return self.line.tokens
+
+    def copy(self):
+        return ExpandedToken(self.text, self)
+
+
+class Token(BaseToken):
+    __slots__ = ("text", "t_type", "line", "str_col")
+
+    def __init__(self, text, t_type, line, str_col):
         self.text = text
         self.t_type = t_type
-        self.file_line_num = file_line_num
-        self.file_raw_text = file_raw_text.strip("\n")
-        self.str_col = file_index_start
-        self.tokens = tokens
-        self.original_token = None  # If copied from a macro, link to original token here
+        self.line = line  # SourceLine
+        self.str_col = str_col
 
-    def copy(self):
-        new_token = Token(self.text, self.t_type, self.file_line_num, self.file_raw_text, self.str_col, self.tokens)
-        new_token.original_token = self
-        return new_token
+    original_token = None
 
 
-def tokenize_file(filename):
-    tokenized_lines = list()
+class ExpandedToken(BaseToken):
+    """
+    Copy of a token in a macro body, made for each expansion.
+    Only the text is its own, as parameters and labels are substituted, the rest is read from the original token.
+    """
+    __slots__ = ("text", "original_token")
+
+    def __init__(self, text, original_token):
+        self.text = text
+        self.original_token = original_token
+
+    @property
+    def t_type(self):
+        return self.original_token.t_type
+
+    @property
+    def line(self):
+        return self.original_token.line
+
+    @property
+    def str_col(self):
+        return self.original_token.str_col
+
+
+@instrumentation.phase_function("tokenize_file")
+def tokenize_file(filename, line_cache=None, backend=None):
+    """
+    line_cache is an optional dict of raw line => token records (text, type, column) of the line,
+    or None for empty lines. Lines found in it are not tokenized again, new lines are added to it.
+    backend is a key of TOKENIZER_BACKENDS, defaults to constants.TOKENIZER_BACKEND.
+    """
     with open(filename, "r") as f:
-        for i, line in enumerate(f):
-            line_of_tokens = list()
-            delimiters = "[],"
-
-            no_comment = line.split(";", 1)[0]
-            if len(no_comment.split()) == 0:
-                continue
-
-            found_opcode = False
-            start_token = -1  # sentinel value -1: no start token index
-            for index, c in enumerate(no_comment):
-                if c.isspace() or c in delimiters or c == ":":
-                    if start_token != -1:
-                        token_txt = no_comment[start_token:index]
-                        token_type = TokenType.OPERAND
-                        if not found_opcode:
-                            token_type = TokenType.OPCODE
-                            found_opcode = True
-                        token_i = start_token
-                        start_token = -1
-
-                        token = Token(token_txt, token_type, i + 1, line, token_i, line_of_tokens)
-                        line_of_tokens.append(token)
-                    if c in delimiters:
-                        token_txt = c
-                        token_type = TokenType.DELIMITER
-                        token = Token(token_txt, token_type, i + 1, line, index, line_of_tokens)
-                        line_of_tokens.append(token)
-                    elif c == ":":
-                        found_opcode = False
-                        if len(line_of_tokens) == 0:
-                            # Missing label error
-                            error_token = Token(":", TokenType.DELIMITER, i + 1, line, 0, line_of_tokens)
-                            show_syntax_error("Missing label", error_token)
-                        if line_of_tokens[-1].t_type not in [TokenType.OPCODE, TokenType.LABEL_SYMBOLIC,
-                                                             TokenType.LABEL_NUMERIC]:
-                            # Invalid label error
-                            prev_token = line_of_tokens[-1]
-                            show_syntax_error("Invalid label", prev_token)
-                        if lb.is_numeric_label(line_of_tokens[-1].text):
-                            line_of_tokens[-1].t_type = TokenType.LABEL_NUMERIC
-                        else:
-                            line_of_tokens[-1].t_type = TokenType.LABEL_SYMBOLIC
-                        token_type = TokenType.LABEL_DELIMITER
-
-                        token = Token(c, token_type, i + 1, line, index, line_of_tokens)
-                        line_of_tokens.append(token)
-                else:
-                    # in a token, or beginning a new token
-                    if start_token == -1:
-                        start_token = index
+        return tokenize_lines(f, line_cache, backend)
+
+
+def tokenize_lines(lines, line_cache=None, backend=None):
+    """Same as tokenize_file, for the lines of a file, with or without their newlines"""
+    tokenize_line = TOKENIZER_BACKENDS[backend or constants.TOKENIZER_BACKEND]
+    tokenized_lines = list()
+    errors = list()
+    source_texts = dict()  # lines with the same text share one string
+    for i, line in enumerate(lines):
+        if not line.endswith("\n"):
+            # a word is only a token when followed by whitespace, like the newline
+            line += "\n"
+        if line_cache is not None and line in line_cache:
+            records = line_cache[line]
+            if records is not None:
+                source = SourceLine(i + 1, line)
+                for text, t_type, index in records:
+                    source.tokens.append(Token(text, t_type, source, index))
+                source.text = source_texts.setdefault(source.text, source.text)
+                tokenized_lines.append(source.tokens)
+            continue
+
+        try:
+            line_of_tokens = tokenize_line(line, i + 1)
+        except AssemblyError as e:
+            # the rest of the lines are checked too, a line with an error is never cached
+            errors.extend(e.diagnostics)
+            continue
+        if line_cache is not None:
+            line_cache[line] = None if line_of_tokens is None else \
+                tuple((t.text, t.t_type, t.str_col) for t in line_of_tokens)
+        if line_of_tokens is not None:
+            if len(line_of_tokens) > 0:
+                source = line_of_tokens[0].line
+                source.text = source_texts.setdefault(source.text, source.text)
             tokenized_lines.append(line_of_tokens)
 
+    raise_errors(errors)
     return tokenized_lines
 
 
+def tokenize_line_chars(line, line_num):
+    """Tokenizes one line character by character. Returns None for empty or comment lines."""
+    delimiters = "[],"
+
+    no_comment = line.split(";", 1)[0]
+    if len(no_comment.split()) == 0:
+        return None
+
+    source = SourceLine(line_num, line)
+    line_of_tokens = source.tokens
+
+    found_opcode = False
+    start_token = -1  # sentinel value -1: no start token index
+    for index, c in enumerate(no_comment):
+        if c.isspace() or c in delimiters or c == ":":
+            if start_token != -1:
+                token_txt = no_comment[start_token:index]
+                token_type = TokenType.OPERAND
+                if not found_opcode:
+                    token_type = TokenType.OPCODE
+                    found_opcode = True
+                token_i = start_token
+                start_token = -1
+
+                token = Token(token_txt, token_type, source, token_i)
+                line_of_tokens.append(token)
+            if c in delimiters:
+                token_txt = c
+                token_type = TokenType.DELIMITER
+                token = Token(token_txt, token_type, source, index)
+                line_of_tokens.append(token)
+            elif c == ":":
+                found_opcode = False
+                add_label_delimiter(source, index)
+        else:
+            # in a token, or beginning a new token
+            if start_token == -1:
+                start_token = index
+    return line_of_tokens
+
+
+# each token with the whitespace before it, the column of a token is the sum of the lengths before it
+_token_pattern = re.compile(r"(\s*)([^\s\[\],:]+|[\[\],:])")
+
+
+def tokenize_line_regex(line, line_num):
+    """Tokenizes one line with a precompiled pattern. Same result as tokenize_line_chars."""
+    no_comment = line.split(";", 1)[0]
+    if len(no_comment) == 0 or no_comment.isspace():
+        return None
+
+    source = SourceLine(line_num, line)
+    line_of_tokens = source.tokens
+    append = line_of_tokens.append
+    t_type = TokenType.OPCODE  # the first word, and the first after a label
+    index = 0
+    end = len(no_comment)
+    for space, text in _token_pattern.findall(no_comment):
+        index += len(space)
+        if text in "[],":
+            append(Token(text, TokenType.DELIMITER, source, index))
+        elif text == ":":
+            t_type = TokenType.OPCODE
+            add_label_delimiter(source, index)
+        elif index + len(text) == end:
+            # like tokenize_line_chars, a word is only a token when followed by a delimiter or whitespace
+            break
+        else:
+            append(Token(text, t_type, source, index))
+            t_type = TokenType.OPERAND
+        index += len(text)
+    return line_of_tokens
+
+
+def add_label_delimiter(source, index):
+    """Turns the previous token into a label, and adds the label colon at index"""
+    line_of_tokens = source.tokens
+    if len(line_of_tokens) == 0:
+        # Missing label error
+        error_token = Token(":", TokenType.DELIMITER, source, 0)
+        show_syntax_error("Missing label", error_token)
+    if line_of_tokens[-1].t_type not in [TokenType.OPCODE, TokenType.LABEL_SYMBOLIC,
+                                         TokenType.LABEL_NUMERIC]:
+        # Invalid label error
+        prev_token = line_of_tokens[-1]
+        show_syntax_error("Invalid label", prev_token)
+    if lb.is_numeric_label(line_of_tokens[-1].text):
+        line_of_tokens[-1].t_type = TokenType.LABEL_NUMERIC
+    else:
+        line_of_tokens[-1].t_type = TokenType.LABEL_SYMBOLIC
+    token_type = TokenType.LABEL_DELIMITER
+
+    token = Token(":", token_type, source, index)
+    line_of_tokens.append(token)
+
+
+TOKENIZER_BACKENDS = {
+    "chars": tokenize_line_chars,
+    "regex": tokenize_line_regex,
+}
+
+
 def _test():
     verbose_out = False
 
@@ -126,44 +277,66 @@ def _test():
 
     print("creating testfile:", filename)
 
-    time.sleep(0.005)  # Synchronise stdout, stderr
-
     with open(filename, "w") as f:
         for line in test_lines:
             f.write(line + "\n")
 
     # now test the data
 
-    resulting_tokens = tokenize_file(filename)
-
-    # Print out result
-    if verbose_out:
-        for line in resulting_tokens:
-            print([_.file_index_start for _ in line])
-            for token in line:
-                print(token.text.ljust(10), "=>", str(token.t_type)[10:])
-            print("\n")
-
     test_error_count = 0
 
-    for i, line in enumerate(resulting_tokens):
-        for j, token in enumerate(line):
-            try:
-                assert (token.text == expected_output[i][j])
-            except AssertionError:
+    for backend in TOKENIZER_BACKENDS:
+        print("backend:", backend)
+        resulting_tokens = tokenize_file(filename, backend=backend)
+        if [t.str_col for t in resulting_tokens[1]] != [0, 2, 4, 10, 12, 14, 15, 24]:
+            test_error_count += 1
+            print("columns were", [t.str_col for t in resulting_tokens[1]], file=sys.stderr)
+
+        # Print out result
+        if verbose_out:
+            for line in resulting_tokens:
+                print([_.str_col for _ in line])
+                for token in line:
+                    print(token.text.ljust(10), "=>", str(token.t_type)[10:])
+                print("\n")
+
+        for i, line in enumerate(resulting_tokens):
+            for j, token in enumerate(line):
+                try:
+                    assert (token.text == expected_output[i][j])
+                except AssertionError:
+                    test_error_count += 1
+                    context = "Line index {}, token index {}\n".format(i, j)
+                    error_msg = "  expected `{}`, but was `{}`".format(expected_output[i][j], token.text)
+                    print(context, error_msg, sep="", file=sys.stderr)
+                try:
+                    assert (token.t_type == expected_types[i][j])
+                except AssertionError:
+                    test_error_count += 1
+                    context = "Line index {}, token index {}\n".format(i, j)
+                    error_msg = "  expected `{}`, but was `{}`".format(expected_types[i][j], token.t_type)
+                    print(context, error_msg, sep="", file=sys.stderr)
+
+    # every backend gives the same tokens as the reference, the character by character scanner
+    for example in sorted(glob.glob("examples/*.fal")):
+        results = dict()
+        for backend in TOKENIZER_BACKENDS:
+            results[backend] = [[(t.text, t.t_type, t.str_col, t.file_line_num) for t in line]
+                                for line in tokenize_file(example, backend=backend)]
+        for backend, result in results.items():
+            if result != results["chars"]:
                 test_error_count += 1
-                context = "Line index {}, token index {}\n".format(i, j)
-                error_msg = "  expected `{}`, but was `{}`".format(expected_output[i][j], token.text)
-                print(context, error_msg, sep="", file=sys.stderr)
-            try:
-                assert (token.t_type == expected_types[i][j])
-            except AssertionError:
-                test_error_count += 1
-                context = "Line index {}, token index {}\n".format(i, j)
-                error_msg = "  expected `{}`, but was `{}`".format(expected_types[i][j], token.t_type)
-                print(context, error_msg, sep="", file=sys.stderr)
-
-    time.sleep(0.005)
+                print("backend {} differs from chars on {}".format(backend, example), file=sys.stderr)
+
+    # every line with an error is reported
+    try:
+        tokenize_lines([": MOV R1, 1", "MOV R1, 2", "MOV [R1]: R2"])
+        test_error_count += 1
+        print("expected AssemblyError", file=sys.stderr)
+    except AssemblyError as e:
+        if [(d.msg, d.line) for d in e.diagnostics] != [("Missing label", 1), ("Invalid label", 3)]:
+            test_error_count += 1
+            print("errors were", e.diagnostics, file=sys.stderr)
 
     # delete the file afterwards
     print("deleting testfile:", filename)
@@ -0,0 +1,394 @@
+# Translates an assembled program into Python source ahead of time, for running it many times
+# The whole ROM becomes one generated function. Each basic block is straight-line code with the operands inlined,
+# the registers live in local variables, and branches jump to the target block through a binary search on the PC.
+
+import sys
+
+from emulator import (ALU_FUNCTIONS, Emulator, EmulatorError, HaltReason, KIND_ALU, KIND_BRANCH, KIND_CLEAR,
+                      KIND_HALT_EXIT, KIND_HLT, KIND_LOAD, KIND_NOP, KIND_POP, KIND_PUSH, KIND_STORE,
+                      MEMORY_SIZE, REGISTER_COUNT, ZERO_REGISTER, load_program)
+
+# indexes in the emulator registers, R0..R31, zero register, SP, PC
+SP_SLOT = REGISTER_COUNT + 1
+PC_SLOT = REGISTER_COUNT + 2
+REGISTER_SLOTS = REGISTER_COUNT + 3
+
+# the generated function returns (code, PC, steps), the code is a halt code or one of these
+HALT_CODES = {-1: HaltReason.HALT, -2: HaltReason.SUCCESS, -3: HaltReason.FAILURE}
+_HALT_RETURNS = {reason: code for code, reason in HALT_CODES.items()}
+STEP_LIMIT = 1  # close to the step limit at PC, see run
+NOT_TRANSLATED = 2  # PC is not the start of a block
+
+_ALU_CODES = {function: code for code, function in ALU_FUNCTIONS.items()}
+_INLINE_FUNCTIONS = {0: "{} + {}", 1: "({}) * ({})", 6: "({}) << (({}) & 31)", 10: "~({})", 11: "({}) & ({})",
+                     12: "({}) | ({})", 13: "({}) ^ ({})"}
+_CLOSED_FUNCTIONS = {10, 11, 12, 13}  # results of these can not leave the int32 range
+_BLOCK_ENDS = {KIND_HLT, KIND_HALT_EXIT, KIND_BRANCH}
+# instructions and blocks that may be inlined after a block, to save going through the dispatch
+INLINE_BUDGET = 16
+INLINE_DEPTH = 4
+_ALU_NAMESPACE = {"_alu_{}".format(code): f for code, f in ALU_FUNCTIONS.items()}
+_RESTART = "continue  # restart"  # jump back to the start of the outermost block, see loop_source
+
+
+def wrap(expr):
+    """Wraps a Python expression to signed 32 bit, see emulator.to_int32"""
+    return "(((({}) + 2147483648) & 4294967295) - 2147483648)".format(expr)
+
+
+def wrap_constant(n):
+    return ((n + 2**31) & 0xffffffff) - 2**31
+
+
+def term(coefficient, expr):
+    """Expression for coefficient * expr"""
+    if coefficient == 0 or expr == "0":
+        return "0"
+    if coefficient == 1:
+        return expr
+    if expr.lstrip("-").isdigit():
+        return str(coefficient * int(expr))
+    if coefficient == -1:
+        return "-({})".format(expr)
+    return "{} * ({})".format(coefficient, expr)
+
+
+def fold(expr):
+    """Evaluates an expression without registers at translation time"""
+    code = compile(expr, "<expression>", "eval")
+    if all(name.startswith("_alu_") for name in code.co_names):
+        return str(eval(code, dict(_ALU_NAMESPACE)))
+    return expr
+
+
+def _check_address(address, memory_size, pc):
+    """Address from an expression not wrapped to 32 bit, when it is not a valid address as is"""
+    address = wrap_constant(address)
+    if not 0 <= address < memory_size:
+        raise EmulatorError("Memory address {} out of range, at PC {}".format(address, pc))
+    return address
+
+
+class TranslatedEmulator(Emulator):
+    """
+    Same state and results as Emulator, with the program translated into Python source.
+    Blocks start at address 0, at each static branch target and after each branch or halt.
+    A dynamic branch (to a register) into the middle of a block makes a new block start there,
+    and the program is translated again.
+    """
+
+    def __init__(self, rom_signals, memory_size=MEMORY_SIZE):
+        super().__init__(rom_signals, memory_size)
+        self.leaders = self.find_leaders()
+        self.translate()
+
+    def find_leaders(self):
+        """Addresses where a block starts"""
+        leaders = {0}
+        for pc, (kind, operands) in enumerate(self.decoded):
+            if kind in _BLOCK_ENDS:
+                leaders.add(pc + 1)
+                if kind == KIND_BRANCH and operands[1] == ZERO_REGISTER:
+                    leaders.add(operands[2])
+        return set(pc for pc in leaders if 0 <= pc < len(self.decoded))
+
+    def translate(self):
+        """Generates and compiles the program function, the source is kept in self.source"""
+        self.used_registers = set()
+        starts = sorted(self.leaders)
+        self.block_ends = dict(zip(starts, starts[1:] + [len(self.decoded)]))
+        # most instructions run between two checks of the step limit, see block_source
+        self.max_run = max([INLINE_BUDGET] + [end - start for start, end in self.block_ends.items()])
+        blocks = [(start, self.loop_source(start, self.block_source(start))) for start in starts]
+        used = sorted(self.used_registers)
+        names = [self.register_name(i) for i in used]
+        lines = ["def program(r, m, pc, steps, limit):"]
+        lines += ["    {} = r[{}]".format(name, i) for name, i in zip(names, used)]
+        lines += ["    f = r[{}]".format(REGISTER_SLOTS), "    try:", "        while True:",
+                  "            if steps > limit: return {}, pc, steps".format(STEP_LIMIT)]
+        if len(blocks) > 0:
+            lines += ["            " + line for line in self.dispatch_source(blocks)]
+        lines += ["            return {}, pc, steps".format(NOT_TRANSLATED), "    finally:"]
+        lines += ["        r[{}] = {}".format(i, name) for name, i in zip(names, used)]
+        lines += ["        r[{}] = f".format(REGISTER_SLOTS), ""]
+        self.source = "\n".join(lines)
+        namespace = dict(_ALU_NAMESPACE, _check_address=_check_address)
+        exec(compile(self.source, "<translated program>", "exec"), namespace)
+        self.program_function = namespace["program"]
+
+    def dispatch_source(self, blocks):
+        """Binary search on pc over the sorted blocks, each block continues the loop or returns"""
+        if len(blocks) == 1:
+            start, body = blocks[0]
+            return ["if pc == {}:".format(start)] + ["    " + line for line in body]
+        middle = len(blocks) // 2
+        return ["if pc < {}:".format(blocks[middle][0])] + \
+            ["    " + line for line in self.dispatch_source(blocks[:middle])] + \
+            ["else:"] + ["    " + line for line in self.dispatch_source(blocks[middle:])]
+
+    def loop_source(self, start, lines):
+        """
+        A block jumping back to its own start becomes a loop, so the back-edge skips the dispatch.
+        Its other jumps leave the loop, and then continue the dispatch loop.
+        """
+        if all(line.strip() != _RESTART for line in lines):
+            return lines
+        loop = ["while True:", "    if steps > limit: return {}, {}, steps".format(STEP_LIMIT, start)]
+        for line in lines:
+            statement = line.strip()
+            if statement == "continue":
+                line = line.replace("continue", "break")
+            elif statement == _RESTART:
+                line = line.replace(_RESTART, "continue")  # pc is already the start
+            loop.append("    " + line)
+        return loop + ["continue"]
+
+    def block_source(self, start, budget=INLINE_BUDGET, path=()):
+        """
+        Statements of the block at start, which continue the dispatch loop with the next PC or return.
+        Short blocks following on statically are inlined, as long as they fit the budget of instructions.
+        """
+        end = self.block_ends[start]
+        lines = ["steps += {}".format(end - start)]
+        for pc in range(start, end):
+            kind, operands = self.decoded[pc]
+            if kind == KIND_BRANCH:
+                condition, a_reg, a_imm = operands
+                budget -= end - start
+                path += (start,)
+                test = {1: "f == 0", 2: "f < 0"}.get(condition)
+                if condition != 0 and test is None:
+                    # never taken, see emulator._branch
+                    return lines + self.jump(pc + 1, budget, path)
+                if a_reg == ZERO_REGISTER and wrap_constant(a_imm) == start:
+                    # a loop within the block
+                    lines = ["if steps > limit: return {}, {}, steps".format(STEP_LIMIT, start)] + lines
+                    if condition == 0:
+                        return ["while True:"] + ["    " + line for line in lines]
+                    return ["while True:"] + ["    " + line for line in lines + ["if not {}: break".format(test)]] + \
+                        self.jump(pc + 1, budget, path)
+                if a_reg != ZERO_REGISTER:
+                    target = ["pc = {}".format(self.value(a_reg, a_imm, pc)), "continue"]
+                else:
+                    target = self.jump(wrap_constant(a_imm), budget, path)
+                if condition == 0:
+                    return lines + target
+                return lines + ["if {}:".format(test)] + ["    " + line for line in target] + \
+                    self.jump(pc + 1, budget, path)
+            lines += self.instruction_source(pc, kind, operands)
+        if self.decoded[end - 1][0] not in _BLOCK_ENDS:
+            lines += self.jump(end, budget - (end - start), path + (start,))
+        return lines
+
+    def jump(self, address, budget, path):
+        """Statements going on to the block at address"""
+        if path[:1] == (address,):
+            return ["pc = {}".format(address), _RESTART]
+        if address in self.block_ends and address not in path and len(path) <= INLINE_DEPTH and \
+                self.block_ends[address] - address <= budget:
+            return self.block_source(address, budget, path)
+        return ["pc = {}".format(address), "continue"]
+
+    def register_name(self, register):
+        """Local variable for a register, PC is never read from its variable"""
+        register %= REGISTER_SLOTS
+        self.used_registers.add(register)
+        if register == SP_SLOT:
+            return "sp"
+        if register == PC_SLOT:
+            return "pc_register"
+        return "r{}".format(register)
+
+    def operand(self, register, immediate, pc):
+        """Expression for a register plus immediate operand, not wrapped to 32 bit"""
+        if register == ZERO_REGISTER:
+            return str(immediate)
+        if register % REGISTER_SLOTS == PC_SLOT:
+            return str(wrap_constant(pc + immediate))
+        expr = self.register_name(register)
+        if immediate != 0:
+            expr = "{} + {}".format(expr, immediate)
+        return expr
+
+    def value(self, register, immediate, pc):
+        """Expression for a register plus immediate operand, wrapped to 32 bit"""
+        if register == ZERO_REGISTER or immediate == 0:
+            return self.operand(register, immediate, pc)
+        return fold(wrap(self.operand(register, immediate, pc)))
+
+    def address(self, expr, pc):
+        """
+        Returns (statements checking a memory address, expression for the address),
+        from an expression not wrapped to 32 bit.
+        """
+        if expr.lstrip("-").isdigit():
+            if not 0 <= wrap_constant(int(expr)) < self.memory_size:
+                return ["_check_address({}, {}, {})".format(expr, self.memory_size, pc)], expr
+            return [], str(wrap_constant(int(expr)))
+        if expr.isidentifier():
+            # a register, already 32 bit
+            return ["if not 0 <= {0} < {1}: _check_address({0}, {1}, {2})".format(expr, self.memory_size, pc)], expr
+        return ["a = {}".format(expr),
+                "if not 0 <= a < {0}: a = _check_address(a, {0}, {1})".format(self.memory_size, pc)], "a"
+
+    def alu_result(self, operands, pc, wrapped=True):
+        """Expression for the result of the ALU, optionally left for address to wrap"""
+        target, a_reg, a_imm, b_reg, b_imm, coef_a, coef_b, offset, function, u = operands
+        code = _ALU_CODES[function]
+        if code in _INLINE_FUNCTIONS:
+            # the low 32 bits of these only depend on the low 32 bits of the operands, so one wrap at the end will do
+            a = term(coef_a, self.operand(a_reg, a_imm, pc))
+            b = term(coef_b, self.operand(b_reg, b_imm, pc))
+            if code == 0 and b == "0":
+                expr = a
+            elif code == 0 and b.startswith("-("):
+                expr = "{} - {}".format(a, b[1:])
+            else:
+                expr = _INLINE_FUNCTIONS[code].format(a, b)
+        else:
+            a = term(coef_a, self.value(a_reg, a_imm, pc))
+            b = term(coef_b, self.value(b_reg, b_imm, pc))
+            expr = "_alu_{}({}, {})".format(code, a, b)
+        if offset != 0:
+            expr = "{} + {}".format(expr, offset)
+        if not wrapped:
+            return fold(expr)
+        if offset == 0 and code in _CLOSED_FUNCTIONS and coef_a in (0, 1) and coef_b in (0, 1) and \
+                (a_imm == 0 or a_reg == ZERO_REGISTER) and (b_imm == 0 or b_reg == ZERO_REGISTER):
+            return fold(expr)
+        return fold(wrap(expr))
+
+    def instruction_source(self, pc, kind, operands):
+        """Statements for one instruction other than a branch, see the handlers in emulator"""
+        if kind == KIND_HLT:
+            return ["return {}, {}, steps".format(_HALT_RETURNS[HaltReason.HALT], pc)]
+        elif kind == KIND_NOP:
+            return []
+        elif kind == KIND_STORE:
+            a_reg, a_imm, b_reg, b_imm = operands
+            lines, a = self.address(self.operand(a_reg, a_imm, pc), pc)
+            return lines + ["m[{}] = {}".format(a, self.value(b_reg, b_imm, pc))]
+        elif kind == KIND_LOAD:
+            u, a_reg, a_imm = operands
+            lines, a = self.address(self.operand(a_reg, a_imm, pc), pc)
+            return lines + ["{} = m[{}]".format(self.register_name(u), a)]
+        elif kind == KIND_HALT_EXIT:
+            return ["return {}, {}, steps".format(_HALT_RETURNS[operands[0]], pc)]
+        elif kind == KIND_ALU:
+            target, a_reg, a_imm, b_reg, b_imm, coef_a, coef_b, offset, function, u = operands
+            names = "f" if target is None else "{} = f".format(self.register_name(target))
+            constant = a_imm + coef_b * b_imm + offset
+            if _ALU_CODES[function] == 0 and coef_a == 1 and a_reg != ZERO_REGISTER and \
+                    a_reg % REGISTER_SLOTS != PC_SLOT and b_reg == ZERO_REGISTER and -2**31 <= constant < 2**31:
+                # a register plus a constant, like MOV, INC and ADD with an immediate, can only overflow one way
+                lines = ["{} = {}".format(names, term(1, self.operand(a_reg, constant, pc)))]
+                if constant > 0:
+                    lines.append("if f > 2147483647: {} = f - 4294967296".format(names))
+                elif constant < 0:
+                    lines.append("if f < -2147483648: {} = f + 4294967296".format(names))
+                return lines
+            result = self.alu_result(operands, pc)
+            exact = self.alu_result(operands, pc, wrapped=False)
+            if _ALU_CODES[function] in _INLINE_FUNCTIONS and result == wrap(exact):
+                # exact in Python, a range check is cheaper than always wrapping and is rarely true
+                return ["{} = {}".format(names, exact),
+                        "if not -2147483648 <= f <= 2147483647: {} = {}".format(names, wrap("f"))]
+            return ["{} = {}".format(names, result)]
+        elif kind == KIND_CLEAR:
+            clear_registers, clear_memory = operands
+            lines = list()
+            if clear_registers:
+                lines += ["{} = 0".format(self.register_name(i)) for i in list(range(REGISTER_COUNT)) + [SP_SLOT]]
+            if clear_memory:
+                lines.append("m[:] = [0] * {}".format(self.memory_size))
+            return lines
+        elif kind == KIND_PUSH:
+            target, a_reg, a_imm, b_reg, b_imm, coef_a, coef_b, offset, function, u = operands
+            lines, a = self.address(self.operand(a_reg, a_imm, pc), pc)
+            # the ALU only takes the address, see emulator._push
+            alu_operands = (target, ZERO_REGISTER, a, ZERO_REGISTER, 0, coef_a, 0, offset, function, u)
+            if _ALU_CODES[function] == 0 and coef_a == 1 and -2**31 <= offset <= 2**31 - self.memory_size:
+                # a is a valid address, so a + offset stays in range
+                result = self.alu_result(alu_operands, pc, wrapped=False)
+            else:
+                result = self.alu_result(alu_operands, pc)
+            return lines + ["m[{}] = {}".format(a, self.value(b_reg, b_imm, pc)),
+                            "{} = {}".format(self.register_name(target), result)]
+        elif kind == KIND_POP:
+            target, a_reg, a_imm, b_reg, b_imm, coef_a, coef_b, offset, function, u = operands
+            alu_operands = (target, a_reg, a_imm, ZERO_REGISTER, 0, coef_a, 0, offset, function, u)
+            lines, a = self.address(self.alu_result(alu_operands, pc, wrapped=False), pc)
+            return lines + ["{} = {}".format(self.register_name(target), a),
+                            "{} = m[{}]".format(self.register_name(u), a)]
+        raise EmulatorError("Can not translate instruction kind {} at PC {}".format(kind, pc))
+
+    def run(self, max_steps=100_000_000):
+        """
+        Runs until the program halts, returns the HaltReason.
+        The last instructions before the step limit are left to the emulator, so the limit is exact.
+        """
+        # the flags are kept as the last ALU result
+        r = self.registers + [0 if self.zero else -1 if self.negative else 1]
+        address = self.pc
+        steps = self.steps
+        step_limit = steps + max_steps
+        near_limit = False
+        try:
+            while self.halt_reason is None and not near_limit:
+                code, address, steps = self.program_function(r, self.memory, address, steps,
+                                                             step_limit - self.max_run)
+                if code == NOT_TRANSLATED:
+                    if not 0 <= address < len(self.decoded):
+                        raise EmulatorError("PC {} outside program of {} instructions"
+                                            .format(address, len(self.decoded)))
+                    # a dynamic branch into the middle of a block
+                    self.leaders.add(address)
+                    self.translate()
+                elif code == STEP_LIMIT:
+                    near_limit = True
+                else:
+                    self.halt_reason = HALT_CODES[code]
+                    r[PC_SLOT] = address
+        finally:
+            self.registers[:] = r[:REGISTER_SLOTS]
+            self.zero = r[REGISTER_SLOTS] == 0
+            self.negative = r[REGISTER_SLOTS] < 0
+            self.pc = address
+            self.steps = steps
+        if near_limit:
+            return super().run(step_limit - steps)
+        return self.halt_reason
+
+
+def _test():
+    print("Running test on translator...")
+    import glob
+    test_error_count = 0
+    for filename in sorted(glob.glob("examples/demo_*.fal")):
+        if "fail" in filename:
+            continue
+        rom_signals = load_program(filename)
+        expected = Emulator(rom_signals)
+        expected.run()
+        translated = TranslatedEmulator(rom_signals)
+        translated.run()
+        # and stopped by the step limit halfway
+        limited = [Emulator(rom_signals), TranslatedEmulator(rom_signals)]
+        for emu in limited:
+            try:
+                emu.run(max_steps=expected.steps // 2)
+            except EmulatorError:
+                pass
+        for attribute in ("halt_reason", "registers", "memory", "zero", "negative", "pc", "steps"):
+            for reference, emu in ((expected, translated), tuple(limited)):
+                if getattr(reference, attribute) != getattr(emu, attribute):
+                    print("{}: {} differs from the emulator".format(filename, attribute), file=sys.stderr)
+                    test_error_count += 1
+    if test_error_count == 0:
+        print("All tests succeeded")
+    else:
+        print("{} test{} failed".format(test_error_count, "" if test_error_count == 1 else "s"))
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,124 @@
+# Watches the program file, and assembles it again each time it is saved
+# usage: python watch.py [-i SECONDS] [--cache] [input file]
+# Runs in one process, so the imports, opcode tables, PROM template and assembly cache stay loaded between runs.
+# The files included by the program are watched as well.
+
+import argparse
+import os
+import sys
+import time
+
+import constants
+import instrumentation
+from assembler import assemble
+from assembly_cache import AssemblyCache, cache_fingerprint
+from blueprint_import_export import SegmentedExport
+from exceptions import AssemblyError
+from include_cache import use_directory
+
+DEFAULT_POLL_INTERVAL = 0.05  # seconds
+MISSING_FILE_GRACE = 1.0  # seconds a removed file is waited for, editors remove files for a moment while saving
+
+PHASES = ["tokenize", "parse", "preprocessed", "encode", "blueprint", "export"]
+
+
+def file_state(filename):
+    """Modification time and size of a file, None if it is missing"""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def assemble_once(file_in, cache, export, included):
+    """
+    Assembles the file, prints the time of each phase. Errors are printed, and do not stop the watch.
+    The paths of the included files are added to the set included.
+    """
+    profiler = instrumentation.Profiler()
+    start = time.perf_counter()
+    try:
+        with instrumentation.hooked(profiler):
+            instruction_count = assemble(file_in, constants.DEFAULT_PREPROCESSED_FILE, constants.DEFAULT_OUTPUT_FILE,
+                                         cache, export, included=included)
+    except AssemblyError as e:
+        print(e, file=sys.stderr, flush=True)
+        print("Failed, {} not updated. Waiting for changes...".format(constants.DEFAULT_OUTPUT_FILE))
+        return False
+    except Exception as e:
+        print("Failed: {}: {}".format(type(e).__name__, e), file=sys.stderr, flush=True)
+        print("Waiting for changes...")
+        return False
+    total = time.perf_counter() - start
+    phases = profiler.phases
+    print("{} instructions in {:.1f} ms ({})".format(
+        instruction_count, total * 1e3,
+        ", ".join("{} {:.1f}".format(phase, phases[phase].seconds * 1e3) for phase in PHASES if phase in phases)))
+    return True
+
+
+def watch_assembly(file_in, cache, export, watched):
+    """
+    Assembles file_in, returns the files to watch, the program and the files it includes, and their states.
+    A failed assembly keeps watching the files watched before, as the includes may not have been all found.
+    """
+    # the states are taken first, a file saved while assembling is assembled again
+    included = set()
+    new_states = {f: file_state(f) for f in watched}
+    if assemble_once(file_in, cache, export, included):
+        watched = [file_in] + sorted(included)
+    else:
+        watched = list(dict.fromkeys(watched + sorted(included)))
+    return watched, [new_states[f] if f in new_states else file_state(f) for f in watched]
+
+
+def watch(file_in, interval=DEFAULT_POLL_INTERVAL, cache_file=None):
+    """
+    Assembles file_in, then again each time it changes, until interrupted.
+    The assembly cache is kept in memory, and also loaded from and saved to cache_file if given.
+    """
+    cache = AssemblyCache.load(cache_file) if cache_file is not None else AssemblyCache(None, cache_fingerprint())
+    export = SegmentedExport()
+    watched, states = watch_assembly(file_in, cache, export, [file_in])
+    print("Watching {}, Ctrl+C to stop".format(", ".join(watched)))
+    missing_since = None  # time a watched file went missing, while waiting for it to come back
+    try:
+        while True:
+            time.sleep(interval)
+            new_states = [file_state(f) for f in watched]
+            if new_states == states:
+                continue
+            if any(new is None and old is not None for new, old in zip(new_states, states)):
+                if missing_since is None:
+                    missing_since = time.perf_counter()
+                if time.perf_counter() - missing_since < MISSING_FILE_GRACE:
+                    continue
+            missing_since = None
+            new_watched, states = watch_assembly(file_in, cache, export, watched)
+            if new_watched != watched:
+                watched = new_watched
+                print("Watching {}".format(", ".join(watched)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cache_file is not None:
+            # the next launch starts warm as well
+            cache.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assembles a program file each time it is saved")
+    parser.add_argument("file_in", nargs="?", default=constants.DEFAULT_INPUT_FILE)
+    parser.add_argument("-i", "--interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="seconds between checks for changes, default {}".format(DEFAULT_POLL_INTERVAL))
+    parser.add_argument("--cache", action="store_true",
+                        help="start from the results of the previous run, and save them on exit, in "
+                             + constants.DEFAULT_CACHE_FILE)
+    args = parser.parse_args()
+    use_directory(constants.DEFAULT_INCLUDE_CACHE_DIR)
+    watch(args.file_in, args.interval, constants.DEFAULT_CACHE_FILE if args.cache else None)
+
+
+if __name__ == "__main__":
+    main()